@@ -5,3 +5,5 @@ class ChatConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'chat'
 
+    def ready(self):
+        from . import database  # noqa: F401  registers the connection_created hook
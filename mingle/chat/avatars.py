@@ -0,0 +1,147 @@
+"""
+Profile picture pipeline.
+
+An upload is streamed to storage in chunks under a fresh name, so the
+request never holds the whole image in memory. Once the profile change
+commits, a worker pool makes square WebP variants for each size in
+``CHAT_AVATAR_SIZES`` (``Profile.avatar_64``/``avatar_256``) and only
+then deletes the files the profile used before. The inbox serves the
+small variant and falls back to the original until it exists.
+
+``CHAT_AVATAR_WORKERS`` sizes the pool; 0 processes inline, which tests
+use. A variant is stored only if the profile still points at the
+original it was made from, so racing uploads can't cross-wire; whatever
+a job doesn't keep, even when it fails part way, is deleted.
+"""
+import io
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+
+ORIGINALS_DIR = 'profile_pics'
+VARIANTS_DIR = 'profile_pics/thumbs'
+# Profile.profile_picture's default; a placeholder, never processed or deleted
+DEFAULT_PICTURE = 'default.jpg'
+
+_executor = None
+
+
+def variant_field(size):
+    return f'avatar_{size}'
+
+
+def picture_names(profile):
+    """Every stored file the profile currently uses"""
+    names = [profile.profile_picture.name] + [
+        getattr(profile, variant_field(size)).name for size in settings.CHAT_AVATAR_SIZES
+    ]
+    return [name for name in names if name and name != DEFAULT_PICTURE]
+
+
+def store_original(uploaded_file):
+    """Save an upload under a unique name, chunk by chunk"""
+    ext = os.path.splitext(uploaded_file.name)[1].lower()[:10]
+    return default_storage.save(f'{ORIGINALS_DIR}/{uuid.uuid4().hex}{ext}', uploaded_file)
+
+
+def replace_picture(profile, uploaded_file, previous):
+    """
+    Point profile at a new upload and queue its variants. ``previous`` are
+    the profile's files from before the request (read them before form
+    validation assigns the upload); they are deleted once the variants
+    are ready. Call before saving profile.
+    """
+    original = store_original(uploaded_file)
+    profile.profile_picture = original  # a plain name, so save() doesn't store the upload again
+    for size in settings.CHAT_AVATAR_SIZES:
+        setattr(profile, variant_field(size), '')
+    transaction.on_commit(lambda: submit(process_picture, profile.pk, original, previous))
+
+
+def submit(job, *args):
+    global _executor
+    if not settings.CHAT_AVATAR_WORKERS:
+        return job(*args)
+    if _executor is None:
+        _executor = ThreadPoolExecutor(settings.CHAT_AVATAR_WORKERS, thread_name_prefix='avatars')
+    return _executor.submit(_run_job, job, *args)
+
+
+def _run_job(job, *args):
+    try:
+        job(*args)
+    except Exception as e:
+        print(f"Error in avatar job {job.__name__}{args}: {str(e)}")
+    finally:
+        # Pool threads hold their own connections; don't leave them open
+        connections.close_all()
+
+
+def render_variants(original):
+    """{size: WebP bytes} of square crops of the stored original"""
+    from PIL import Image, ImageOps
+
+    with default_storage.open(original, 'rb') as f:
+        image = Image.open(f)
+        image.draft('RGB', (max(settings.CHAT_AVATAR_SIZES),) * 2)  # JPEG: decode at reduced scale
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+
+    variants = {}
+    for size in settings.CHAT_AVATAR_SIZES:
+        buffer = io.BytesIO()
+        ImageOps.fit(image, (size, size), Image.LANCZOS).save(
+            buffer, 'WEBP', quality=settings.CHAT_AVATAR_QUALITY, method=4
+        )
+        variants[size] = buffer.getvalue()
+    return variants
+
+
+def process_picture(profile_id, original, stale=()):
+    from .models import Profile
+
+    stem = os.path.splitext(os.path.basename(original))[0]
+    names = {}
+    stored = 0
+    try:
+        for size, data in render_variants(original).items():
+            names[variant_field(size)] = default_storage.save(
+                f'{VARIANTS_DIR}/{stem}_{size}.webp', ContentFile(data)
+            )
+        stored = Profile.objects.filter(pk=profile_id, profile_picture=original).update(**names)
+    finally:
+        # The profile has moved past the stale files whether or not this worked
+        unused = list(stale)
+        if not stored:
+            # Variants made before a failure, or for an upload a newer one replaced
+            unused.extend(names.values())
+            if not Profile.objects.filter(pk=profile_id, profile_picture=original).exists():
+                unused.append(original)
+        delete_files(unused)
+
+
+def delete_files(names):
+    for name in names:
+        if name and name != DEFAULT_PICTURE:
+            default_storage.delete(name)
+
+
+def delete_in_background(names):
+    if names:
+        transaction.on_commit(lambda: submit(delete_files, names))
+
+
+def avatar_url(profile, request=None, size=None):
+    """URL of the variant closest to ``size`` (the smallest by default), else the original"""
+    sizes = sorted(settings.CHAT_AVATAR_SIZES)
+    size = next((s for s in sizes if size is None or s >= size), sizes[-1])
+    name = getattr(profile, variant_field(size)).name or profile.profile_picture.name
+    if not name:
+        return None
+    url = default_storage.url(name)
+    return request.build_absolute_uri(url) if request else url
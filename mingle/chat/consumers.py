@@ -1,18 +1,382 @@
-import json
+import asyncio
+import time
 from datetime import timezone
 
 from channels.generic.websocket import AsyncWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from asgiref.sync import sync_to_async
-from django.utils.timezone import now
-from .models import Message, Group, GroupMember, GroupMessage, Profile
+from django.db import transaction
+from .models import Message, Conversation, Group, GroupMember, GroupMessage
+from .persistence import message_queue, group_message_queue
+from .ids import assign_message_id, next_message_id
+from . import presence
+from .receipts import read_receipts
+from .message_cache import cache_direct_message, cache_group_message
+from .serializers import serialize_message, serialize_group_message
+from .wire import JSON_CODEC, InvalidFrame, encode_frames, negotiate
+from .rooms import dm_room_name, group_room_name, user_room_name
+from .membership import group_access, group_access_by_id, load_group
 from django.utils import timezone
 import pytz
 
 User = get_user_model()
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+class WireProtocolMixin:
+    """Sends and parses frames in the encoding negotiated on connect (see chat.wire)"""
+
+    codec = JSON_CODEC
+
+    async def accept_negotiated(self):
+        self.codec = negotiate(self.scope)
+        await self.accept(subprotocol=self.codec.subprotocol)
+
+    async def send_payload(self, payload):
+        await self.send(**self.codec.encode(payload))
+
+    async def send_frames(self, frames, build_payload):
+        """Forward frames pre-encoded by the sender; encode build_payload() if the event has none"""
+        if frames is not None:
+            await self.send(**frames[self.codec.name])
+        else:
+            await self.send_payload(build_payload())
+
+    def decode_frame(self, text_data=None, bytes_data=None):
+        return self.codec.decode(text_data, bytes_data)
+
+
+class OptimisticDeliveryMixin(WireProtocolMixin):
+    """
+    Broadcast-before-persist support (CHAT_OPTIMISTIC_DELIVERY).
+
+    The message is fanned out with a server-assigned Snowflake id, then
+    written in the background. Once the write settles the room gets a
+    ``message_status`` event carrying the same ``message_id`` and the
+    sender's ``client_msg_id`` so clients can confirm or retract it.
+    """
+
+    def persist_in_background(self, persist, room, client_msg_id, message_id):
+        if not hasattr(self, '_pending_writes'):
+            self._pending_writes = set()
+        task = asyncio.ensure_future(self._persist_and_report(persist, room, client_msg_id, message_id))
+        # Hold a reference so the task isn't garbage collected mid-write
+        self._pending_writes.add(task)
+        task.add_done_callback(self._pending_writes.discard)
+
+    async def _persist_and_report(self, persist, room, client_msg_id, message_id):
+        try:
+            await persist
+            status = "ack"
+        except Exception as e:
+            print(f"Error persisting message {message_id}: {str(e)}")
+            status = "persist_failed"
+
+        await self.channel_layer.group_send(
+            room,
+            {
+                "type": "message_status",
+                "room": room,
+                "status": status,
+                "message_id": message_id,
+                "client_msg_id": client_msg_id,
+                "sender_id": self.user.id
+            }
+        )
+
+    def message_status_payload(self, event):
+        return {
+            "type": event["status"],
+            "message_id": event["message_id"],
+            "client_msg_id": event["client_msg_id"],
+            "sender_id": event["sender_id"]
+        }
+
+    async def message_status(self, event):
+        try:
+            await self.send_payload(self.message_status_payload(event))
+        except Exception as e:
+            print(f"Error sending message status: {str(e)}")
+
+
+class PresenceMixin:
+    """Registers the socket with the presence service (see chat.presence)"""
+
+    @sync_to_async
+    def set_presence(self, online):
+        if online:
+            presence.user_connected(self.user.id, self.channel_name)
+        else:
+            presence.user_disconnected(self.user.id, self.channel_name)
+
+    async def heartbeat(self):
+        # Any inbound frame counts; explicit {"type": "heartbeat"} frames keep idle sockets alive
+        last = getattr(self, '_last_heartbeat', 0)
+        if time.monotonic() - last >= settings.CHAT_PRESENCE_TTL / 3:
+            self._last_heartbeat = time.monotonic()
+            await sync_to_async(presence.user_heartbeat)(self.user.id, self.channel_name)
+
+
+class DirectMessageMixin(OptimisticDeliveryMixin):
+    """Sending, persisting and read receipts for 1:1 messages"""
+
+    async def deliver_direct_message(self, other_user, room, content, client_msg_id=None):
+        optimistic = settings.CHAT_OPTIMISTIC_DELIVERY
+        new_conversation = await self.is_new_conversation(other_user, room)
+
+        if optimistic:
+            message_id = next_message_id()
+            timestamp = timezone.now()
+            read = False
+        else:
+            saved_message = await self.persist_message(
+                sender=self.user,
+                receiver=other_user,
+                content=content
+            )
+            message_id = saved_message.id
+            timestamp = saved_message.timestamp
+            read = saved_message.read
+
+        event = {
+            "type": "chat_message",
+            "message_id": message_id,
+            "client_msg_id": client_msg_id,
+            "message": content,
+            "sender": self.user.username,
+            "sender_id": self.user.id,
+            "receiver_id": other_user.id,
+            "timestamp": timestamp.isoformat(),
+            "read": read
+        }
+        # Encoded once here rather than once per member socket. Stream
+        # sockets name the conversation after the other side of the pair.
+        payload = self.chat_message_payload(event)
+        event["frames"] = encode_frames(payload)
+        event["stream_frames"] = {
+            "sender": encode_frames(dict(payload, conversation=f"dm:{other_user.id}")),
+            "receiver": encode_frames(dict(payload, conversation=f"dm:{self.user.id}"))
+        }
+        await self.channel_layer.group_send(room, event)
+
+        if new_conversation:
+            # Stream sockets only join rooms they knew about at connect time;
+            # hand them the first message of a brand new pair directly
+            for user_id in {self.user.id, other_user.id}:
+                await self.channel_layer.group_send(
+                    user_room_name(user_id),
+                    dict(event, type="conversation_started", room=room)
+                )
+
+        if optimistic:
+            self.persist_in_background(
+                self.persist_message(
+                    sender=self.user,
+                    receiver=other_user,
+                    content=content,
+                    message_id=message_id,
+                    timestamp=timestamp
+                ),
+                room,
+                client_msg_id,
+                message_id
+            )
+
+    async def is_new_conversation(self, other_user, room):
+        """True if the pair has never talked. Checked once per room per socket."""
+        if not hasattr(self, '_known_rooms'):
+            self._known_rooms = set()
+        if room in self._known_rooms:
+            return False
+        self._known_rooms.add(room)
+        low, high = Conversation.pair(self.user.id, other_user.id)
+        return not await Conversation.objects.filter(user_low_id=low, user_high_id=high).aexists()
+
+    def chat_message_payload(self, event):
+        return {
+            "message_id": event.get("message_id"),
+            "client_msg_id": event.get("client_msg_id"),
+            "message": event["message"],
+            "sender": event["sender"],
+            "sender_id": event["sender_id"],
+            "receiver_id": event["receiver_id"],
+            "timestamp": event["timestamp"]
+        }
+
+    async def chat_message(self, event):
+        try:
+            # Only send if it's a proper chat message
+            if "message" in event and "sender" in event:
+                await self.send_frames(event.get("frames"), lambda: self.chat_message_payload(event))
+        except Exception as e:
+            print(f"Error sending message: {str(e)}")
+
+    async def persist_message(self, sender, receiver, content, message_id=None, timestamp=None):
+        if settings.CHAT_WRITE_BEHIND:
+            message = await message_queue.submit(Message(
+                id=message_id,
+                sender=sender,
+                receiver=receiver,
+                content=content,
+                timestamp=timestamp or timezone.now()
+            ))
+        else:
+            message = await self.save_message(
+                sender=sender, receiver=receiver, content=content,
+                message_id=message_id, timestamp=timestamp
+            )
+        # Write through to the hot conversation cache once the row exists
+        await sync_to_async(cache_direct_message)(serialize_message(message))
+        return message
+
+    @sync_to_async
+    def save_message(self, sender, receiver, content, message_id=None, timestamp=None):
+        ist = pytz.timezone('Asia/Kolkata')
+        now = (timestamp or timezone.now()).astimezone(ist)
+
+        with transaction.atomic():
+            message = Message.objects.create(
+                id=assign_message_id(message_id),
+                sender=sender,
+                receiver=receiver,
+                content=content,
+                timestamp=now
+            )
+            Conversation.record_message(message)
+        return message
+
+    async def submit_read_receipt(self, other_user, data):
+        """Queue a receipt for other_user's messages up to data['upto'] (all if absent)"""
+        upto = data.get('upto')
+        await read_receipts.submit(self.user.id, other_user.id, int(upto) if upto is not None else None)
+
+    def read_upto_payload(self, event):
+        return {
+            "type": "read_upto",
+            "reader_id": event["reader_id"],
+            "upto": event["upto"],
+            "read_at": event["read_at"]
+        }
+
+    async def read_upto(self, event):
+        try:
+            await self.send_payload(self.read_upto_payload(event))
+        except Exception as e:
+            print(f"Error sending read receipt: {str(e)}")
+
+
+class GroupMessageMixin(OptimisticDeliveryMixin):
+    """Sending and persisting group messages"""
+
+    async def deliver_group_message(self, group, room, content, client_msg_id=None):
+        optimistic = settings.CHAT_OPTIMISTIC_DELIVERY
+
+        if optimistic:
+            message_id = next_message_id()
+            timestamp = timezone.now()
+        else:
+            # Save message to database
+            saved_message = await self.persist_group_message(
+                group=group,
+                sender=self.user,
+                content=content
+            )
+            message_id = saved_message.id
+            timestamp = saved_message.timestamp
+
+        # Prepare the message data for broadcasting
+        message_data = {
+            "type": "group_message",
+            "message_id": message_id,
+            "client_msg_id": client_msg_id,
+            "message": content,
+            "content": content,  # Send both for compatibility
+            "sender": self.user.username,
+            "sender_id": self.user.id,
+            "group_id": group.id,
+            "group_slug": group.slug,
+            "timestamp": timestamp.isoformat(),
+            # Remove read status since GroupMessage doesn't track it
+        }
+        # Encoded once here rather than once per member socket
+        payload = self.group_message_payload(message_data)
+        message_data["frames"] = encode_frames(payload)
+        message_data["stream_frames"] = encode_frames(dict(payload, conversation=f"group:{group.id}"))
+
+        await self.channel_layer.group_send(room, message_data)
+
+        if optimistic:
+            self.persist_in_background(
+                self.persist_group_message(
+                    group=group,
+                    sender=self.user,
+                    content=content,
+                    message_id=message_id,
+                    timestamp=timestamp
+                ),
+                room,
+                client_msg_id,
+                message_id
+            )
+
+    async def group_is_live(self, group_id):
+        """False once deletion was requested; the cached entry is dropped then, so
+        this only reads the DB on a cache miss"""
+        return await sync_to_async(load_group)(group_id) is not None
+
+    def group_message_payload(self, event):
+        return {
+            "message_id": event.get("message_id"),
+            "client_msg_id": event.get("client_msg_id"),
+            "message": event["message"],
+            "content": event["message"],  # For consistency
+            "sender": event["sender"],
+            "sender_id": event["sender_id"],
+            "group_slug": event["group_slug"],
+            "timestamp": event["timestamp"]
+        }
+
+    async def group_message(self, event):
+        try:
+            await self.send_frames(event.get("frames"), lambda: self.group_message_payload(event))
+        except Exception as e:
+            print(f"Error sending group message: {str(e)}")
+
+    async def persist_group_message(self, group, sender, content, message_id=None, timestamp=None):
+        if settings.CHAT_WRITE_BEHIND:
+            message = await group_message_queue.submit(GroupMessage(
+                id=message_id,
+                group=group,
+                sender=sender,
+                content=content,
+                timestamp=timestamp or timezone.now()
+            ))
+        else:
+            message = await self.save_group_message(
+                group=group, sender=sender, content=content,
+                message_id=message_id, timestamp=timestamp
+            )
+        await sync_to_async(cache_group_message)(serialize_group_message(message))
+        return message
+
+    @sync_to_async
+    def save_group_message(self, group, sender, content, message_id=None, timestamp=None):
+        ist = pytz.timezone('Asia/Kolkata')
+        now = (timestamp or timezone.now()).astimezone(ist)
+
+        with transaction.atomic():
+            message = GroupMessage.objects.create(
+                id=assign_message_id(message_id),
+                group=group,
+                sender=sender,
+                content=content,
+                timestamp=now
+            )
+            group.record_message(message)
+        return message
+
+
+class ChatConsumer(PresenceMixin, DirectMessageMixin, AsyncWebsocketConsumer):
     async def connect(self):
         try:
             self.user = self.scope["user"]
@@ -23,10 +387,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
             print(f"Connection attempt by {self.user.username}")
 
             self.other_user_id = self.scope['url_route']['kwargs']['user_id']
-            self.other_user = await sync_to_async(User.objects.get)(id=self.other_user_id)
+            # Accounts pending deletion no longer take messages
+            self.other_user = await sync_to_async(User.objects.get)(id=self.other_user_id, is_active=True)
 
-            user_ids = sorted([self.user.id, self.other_user.id])
-            self.room_group_name = f"chat_{user_ids[0]}_{user_ids[1]}"
+            self.room_group_name = dm_room_name(self.user.id, self.other_user.id)
             print(f"Creating room: {self.room_group_name}")
 
             await self.channel_layer.group_add(
@@ -34,10 +398,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
 
-            await self.accept()  # Connection accepted without sending a message
+            await self.accept_negotiated()  # Connection accepted without sending a message
             print(f"WebSocket connection established for {self.user.username}")
 
-            await self.set_last_seen(online=True)
+            await self.set_presence(online=True)
 
         except User.DoesNotExist:
             print(f"User {self.other_user_id} not found")
@@ -49,7 +413,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
     async def disconnect(self, close_code):
         try:
             print(f"Disconnecting {self.user.username}, code: {close_code}")
-            await self.set_last_seen(online=False)
+            await self.set_presence(online=False)
 
             if hasattr(self, 'room_group_name'):
                 await self.channel_layer.group_discard(
@@ -59,13 +423,17 @@ class ChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             print(f"Disconnection error: {str(e)}")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            data = self.decode_frame(text_data, bytes_data)
+            await self.heartbeat()
+
+            if data.get('type') == 'heartbeat':
+                return
 
             # Handle read receipts
             if data.get('type') == 'read_receipt':
-                await self.mark_messages_as_read(self.user, self.other_user)
+                await self.submit_read_receipt(self.other_user, data)
                 return
 
             message = data.get("content", "").strip()
@@ -77,80 +445,24 @@ class ChatConsumer(AsyncWebsocketConsumer):
             if len(message) > 1000:
                 return
 
-            if self.user.is_authenticated:
-                saved_message = await self.save_message(
-                    sender=self.user,
-                    receiver=self.other_user,
-                    content=message
-                )
-
-                # If this is a read receipt
-                if data.get('type') == 'read_receipt':
-                    await self.mark_messages_as_read(self.user, self.other_user)
-                    return
-
-            await self.channel_layer.group_send(
+            await self.deliver_direct_message(
+                self.other_user,
                 self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": message,
-                    "sender": self.user.username,
-                    "sender_id": self.user.id,
-                    "receiver_id": self.other_user.id,
-                    "timestamp": saved_message.timestamp.isoformat(),
-                    "read": saved_message.read
-                }
+                message,
+                client_msg_id=data.get("client_msg_id")
             )
 
-        except json.JSONDecodeError:
-            print("Invalid JSON received")
+        except InvalidFrame:
+            print("Invalid frame received")
         except Exception as e:
             print(f"Error in receive: {str(e)}")
 
-    async def chat_message(self, event):
-        try:
-            # Only send if it's a proper chat message
-            if "message" in event and "sender" in event:
-                await self.send(text_data=json.dumps({
-                    "message": event["message"],
-                    "sender": event["sender"],
-                    "sender_id": event["sender_id"],
-                    "receiver_id": event["receiver_id"],
-                    "timestamp": event["timestamp"]
-                }))
-        except Exception as e:
-            print(f"Error sending message: {str(e)}")
+    async def account_deleted(self, event):
+        # Either side of this conversation is gone
+        await self.close(code=4004)
 
-    @sync_to_async
-    def save_message(self, sender, receiver, content):
-        ist = pytz.timezone('Asia/Kolkata')
-        now = timezone.now().astimezone(ist)
 
-        return Message.objects.create(
-            sender=sender,
-            receiver=receiver,
-            content=content,
-            timestamp=now
-        )
-
-    @sync_to_async
-    def set_last_seen(self, online):
-        profile, created = Profile.objects.get_or_create(user=self.user)
-        profile.last_seen = now() if not online else None
-        profile.save()
-
-    @sync_to_async
-    def mark_messages_as_read(self, sender, receiver):
-        """Mark all messages from this sender as read"""
-        Message.objects.filter(
-            sender=sender,
-            receiver=receiver,
-            read=False
-        ).update(read=True, read_at=now)
-
-
-
-class GroupChatConsumer(AsyncWebsocketConsumer):
+class GroupChatConsumer(GroupMessageMixin, AsyncWebsocketConsumer):
     async def connect(self):
         try:
             self.user = self.scope["user"]
@@ -161,19 +473,17 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
             print(f"Group connection attempt by {self.user.username}")
 
             self.group_slug = self.scope['url_route']['kwargs']['group_slug']
-            self.group = await sync_to_async(Group.objects.get)(slug=self.group_slug)
-
-            is_member = await sync_to_async(GroupMember.objects.filter(
-                group=self.group,
-                user=self.user
-            ).exists)()
+            access = await sync_to_async(group_access)(self.group_slug, self.user)
+            if access is None:
+                raise Group.DoesNotExist
+            self.group = access.instance()
 
-            if not is_member:
+            if not access.is_member:
                 print(f"User {self.user.username} not in group {self.group_slug}")
                 await self.close(code=4003)
                 return
 
-            self.room_group_name = f'group_{self.group_slug}'
+            self.room_group_name = group_room_name(self.group.id)
             print(f"Creating group room: {self.room_group_name}")
 
             await self.channel_layer.group_add(
@@ -181,7 +491,7 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
                 self.channel_name
             )
 
-            await self.accept()  # No automatic message sent
+            await self.accept_negotiated()  # No automatic message sent
             print(f"Group WebSocket connection established for {self.user.username}")
 
         except Group.DoesNotExist:
@@ -202,63 +512,277 @@ class GroupChatConsumer(AsyncWebsocketConsumer):
         except Exception as e:
             print(f"Group disconnection error: {str(e)}")
 
-    async def receive(self, text_data):
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            data = json.loads(text_data)
+            data = self.decode_frame(text_data, bytes_data)
             message = data.get("content", "").strip()
 
             if not message or len(message) > 1000:
                 return
+            if not await self.group_is_live(self.group.id):
+                await self.leave_group(4004)
+                return
 
-            # Save message to database
-            saved_message = await self.save_group_message(
-                group=self.group,
-                sender=self.user,
-                content=message
-            )
-
-            # Prepare the message data for broadcasting
-            message_data = {
-                "type": "group_message",
-                "message": message,
-                "content": message,  # Send both for compatibility
-                "sender": self.user.username,
-                "sender_id": self.user.id,
-                "group_slug": self.group_slug,
-                "timestamp": saved_message.timestamp.isoformat(),
-                # Remove read status since GroupMessage doesn't track it
-            }
-
-            await self.channel_layer.group_send(
+            await self.deliver_group_message(
+                self.group,
                 self.room_group_name,
-                message_data
+                message,
+                client_msg_id=data.get("client_msg_id")
             )
 
         except Exception as e:
             print(f"Error in group receive: {str(e)}")
 
-    async def group_message(self, event):
+    async def leave_group(self, close_code):
+        if not hasattr(self, 'room_group_name'):
+            return  # Already left, e.g. told at request time and again after the purge
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        del self.room_group_name
+        await self.close(code=close_code)
+
+    async def membership_revoked(self, event):
+        if self.user.id in event["user_ids"]:
+            print(f"Membership of {self.user.username} in group {self.group_slug} revoked")
+            await self.leave_group(4003)
+
+    async def group_deleted(self, event):
+        print(f"Group {self.group_slug} deleted")
+        await self.leave_group(4004)
+
+    async def group_renamed(self, event):
         try:
-            await self.send(text_data=json.dumps({
-                "message": event["message"],
-                "content": event["message"],  # For consistency
-                "sender": event["sender"],
-                "sender_id": event["sender_id"],
+            self.group_slug = self.group.slug = event["group_slug"]
+            self.group.name = event["name"]
+            await self.send_payload({
+                "type": "group_renamed",
                 "group_slug": event["group_slug"],
-                "timestamp": event["timestamp"]
-            }))
+                "name": event["name"]
+            })
         except Exception as e:
-            print(f"Error sending group message: {str(e)}")
+            print(f"Error sending group rename: {str(e)}")
 
-    @sync_to_async
-    def save_group_message(self, group, sender, content):
-        ist = pytz.timezone('Asia/Kolkata')
-        now = timezone.now().astimezone(ist)
 
-        return GroupMessage.objects.create(
-            group=group,
-            sender=sender,
-            content=content,
-            timestamp=now
-        )
+class StreamConsumer(PresenceMixin, DirectMessageMixin, GroupMessageMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user carrying every conversation.
+
+    On connect the channel joins the room of each existing DM and each group
+    the user belongs to, plus the user's own ``user_{id}`` room. Frames in
+    both directions name their conversation as ``dm:<user_id>`` or
+    ``group:<group_id>``.
+    """
+
+    async def connect(self):
+        try:
+            self.user = self.scope["user"]
+            if not self.user.is_authenticated:
+                await self.close(code=4001)
+                return
+
+            self.peers, self.member_groups = await self.load_subscriptions()
+
+            # room name -> conversation key
+            self.rooms = {user_room_name(self.user.id): None}
+            for peer_id in self.peers:
+                self.rooms[dm_room_name(self.user.id, peer_id)] = f"dm:{peer_id}"
+            for group in self.member_groups.values():
+                self.rooms[group_room_name(group.id)] = f"group:{group.id}"
+
+            for room in self.rooms:
+                await self.channel_layer.group_add(room, self.channel_name)
+
+            await self.accept_negotiated()
+            print(f"Stream connection established for {self.user.username} ({len(self.rooms)} rooms)")
+
+            await self.set_presence(online=True)
+
+        except Exception as e:
+            print(f"Stream connection error: {str(e)}")
+            await self.close(code=4000)
+
+    async def disconnect(self, close_code):
+        try:
+            print(f"Disconnecting stream for {self.user.username}, code: {close_code}")
+            if hasattr(self, 'rooms'):
+                await self.set_presence(online=False)
+                for room in self.rooms:
+                    await self.channel_layer.group_discard(room, self.channel_name)
+        except Exception as e:
+            print(f"Stream disconnection error: {str(e)}")
+
+    async def receive(self, text_data=None, bytes_data=None):
+        try:
+            data = self.decode_frame(text_data, bytes_data)
+            await self.heartbeat()
+
+            if data.get('type') == 'heartbeat':
+                return
+
+            kind, _, target = data.get("conversation", "").partition(":")
+            target = int(target)
+
+            if kind == "dm":
+                other_user = await self.get_peer(target)
+                if other_user is None:
+                    return
+                room = dm_room_name(self.user.id, other_user.id)
+                if room not in self.rooms:
+                    # First message to a new peer; subscribe to hear replies
+                    self.rooms[room] = f"dm:{other_user.id}"
+                    await self.channel_layer.group_add(room, self.channel_name)
+
+                if data.get('type') == 'read_receipt':
+                    await self.submit_read_receipt(other_user, data)
+                    return
+
+                message = data.get("content", "").strip()
+                if not message or len(message) > 1000:
+                    return
+                await self.deliver_direct_message(other_user, room, message, data.get("client_msg_id"))
+
+            elif kind == "group":
+                group = self.member_groups.get(target)
+                if group is None:
+                    return
+
+                message = data.get("content", "").strip()
+                if not message or len(message) > 1000:
+                    return
+                if not await self.group_is_live(group.id):
+                    await self.drop_group(group.id, "group_deleted")
+                    return
+                await self.deliver_group_message(
+                    group, group_room_name(group.id), message, data.get("client_msg_id")
+                )
 
+        except ValueError:
+            print("Invalid stream frame received")
+        except Exception as e:
+            print(f"Error in stream receive: {str(e)}")
+
+    def dm_key(self, event):
+        other_id = event["receiver_id"] if event["sender_id"] == self.user.id else event["sender_id"]
+        return f"dm:{other_id}"
+
+    async def chat_message(self, event):
+        try:
+            side = "sender" if event["sender_id"] == self.user.id else "receiver"
+            await self.send_frames(
+                event.get("stream_frames", {}).get(side),
+                lambda: dict(self.chat_message_payload(event), conversation=self.dm_key(event))
+            )
+        except Exception as e:
+            print(f"Error sending stream message: {str(e)}")
+
+    async def group_message(self, event):
+        try:
+            await self.send_frames(
+                event.get("stream_frames"),
+                lambda: dict(self.group_message_payload(event), conversation=f"group:{event['group_id']}")
+            )
+        except Exception as e:
+            print(f"Error sending stream group message: {str(e)}")
+
+    async def message_status(self, event):
+        try:
+            payload = self.message_status_payload(event)
+            payload["conversation"] = self.rooms.get(event["room"])
+            await self.send_payload(payload)
+        except Exception as e:
+            print(f"Error sending stream message status: {str(e)}")
+
+    async def read_upto(self, event):
+        try:
+            other_id = event["reader_id"] if event["reader_id"] != self.user.id else event["peer_id"]
+            payload = self.read_upto_payload(event)
+            payload["conversation"] = f"dm:{other_id}"
+            await self.send_payload(payload)
+        except Exception as e:
+            print(f"Error sending stream read receipt: {str(e)}")
+
+    async def conversation_started(self, event):
+        room = event["room"]
+        if room in self.rooms:
+            return  # Already subscribed, the room copy was delivered
+        self.rooms[room] = self.dm_key(event)
+        await self.channel_layer.group_add(room, self.channel_name)
+        await self.chat_message(event)
+
+    async def drop_group(self, group_id, reason):
+        room = group_room_name(group_id)
+        self.member_groups.pop(group_id, None)
+        if self.rooms.pop(room, None) is None:
+            return
+        await self.channel_layer.group_discard(room, self.channel_name)
+        await self.send_payload({"type": reason, "conversation": f"group:{group_id}"})
+
+    async def membership_revoked(self, event):
+        if self.user.id in event["user_ids"]:
+            await self.drop_group(event["group_id"], "membership_revoked")
+
+    async def group_deleted(self, event):
+        await self.drop_group(event["group_id"], "group_deleted")
+
+    async def account_deleted(self, event):
+        user_id = event["user_id"]
+        if user_id == self.user.id:
+            await self.close(code=4001)
+            return
+        self.peers.pop(user_id, None)
+        if self.rooms.pop(dm_room_name(self.user.id, user_id), None) is None:
+            return
+        await self.channel_layer.group_discard(dm_room_name(self.user.id, user_id), self.channel_name)
+        await self.send_payload({"type": "account_deleted", "conversation": f"dm:{user_id}"})
+
+    async def group_renamed(self, event):
+        group = self.member_groups.get(event["group_id"])
+        if group is None:
+            return
+        group.slug = event["group_slug"]
+        group.name = event["name"]
+        await self.send_payload({
+            "type": "group_renamed",
+            "conversation": f"group:{group.id}",
+            "group_slug": group.slug,
+            "name": group.name
+        })
+
+    async def membership_granted(self, event):
+        group_id = event["group_id"]
+        room = group_room_name(group_id)
+        if self.user.id not in event["user_ids"] or room in self.rooms:
+            return
+        access = await sync_to_async(group_access_by_id)(group_id, self.user)
+        if access is None or not access.is_member:
+            return  # Revoked again before we got here
+        group = access.instance()
+        self.member_groups[group.id] = group
+        self.rooms[room] = f"group:{group.id}"
+        await self.channel_layer.group_add(room, self.channel_name)
+        await self.send_payload({
+            "type": "membership_granted",
+            "conversation": f"group:{group.id}",
+            "group_slug": group.slug,
+            "name": group.name
+        })
+
+    async def get_peer(self, user_id):
+        if user_id not in self.peers:
+            self.peers[user_id] = await User.objects.filter(id=user_id, is_active=True).only('id', 'username').afirst()
+        return self.peers[user_id]
+
+    @sync_to_async
+    def load_subscriptions(self):
+        peer_ids = set()
+        for low, high in Conversation.for_user(self.user).values_list('user_low_id', 'user_high_id'):
+            peer_ids.add(high if low == self.user.id else low)
+        peer_ids.discard(self.user.id)
+
+        peers = {u.id: u for u in User.objects.filter(id__in=peer_ids, is_active=True).only('id', 'username')}
+        # Through the membership cache, like every other group authorization
+        groups = {}
+        for group_id in GroupMember.objects.filter(user=self.user).values_list('group_id', flat=True):
+            access = group_access_by_id(group_id, self.user)
+            if access is not None and access.is_member:
+                groups[group_id] = access.instance()
+        return peers, groups
@@ -0,0 +1,30 @@
+"""
+Database connection tuning.
+
+Every new SQLite connection gets ``CHAT_SQLITE_PRAGMAS``:
+
+* ``journal_mode=WAL`` lets readers run while a write is in progress.
+  It is persisted in the database file, so any connection, even a
+  ``manage.py`` command, switches the file over for good; it is only set
+  with ``CHAT_SQLITE_WAL=1``, keeping the tracked ``db.sqlite3`` as is.
+* ``synchronous=NORMAL`` is crash safe under WAL and skips the fsync on
+  every commit, so it comes with WAL.
+* ``busy_timeout`` makes a writer wait for the lock instead of failing
+  at once with "database is locked".
+* ``mmap_size`` serves reads from memory-mapped pages.
+"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def tune_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.connection.cursor()
+    try:
+        for pragma, value in settings.CHAT_SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+    finally:
+        cursor.close()
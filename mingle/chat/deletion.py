@@ -0,0 +1,186 @@
+"""
+Background deletion of accounts and groups.
+
+Deleting a heavy user or a large group through the ORM makes Django's
+collector load every related message and membership before it deletes
+anything, which times out the request and holds the write lock. Instead
+the request only marks the target (``User.is_active = False``,
+``Group.pending_delete = True``), which hides it at once, and queues a
+``DeletionJob``. A worker then purges the dependent tables with raw
+``DELETE ... WHERE id IN (SELECT id ... LIMIT n)`` statements of
+``CHAT_DELETION_BATCH_SIZE`` rows, each in its own short transaction,
+recording progress on the job after each batch. Once only the target row
+is left, the ORM deletes it, and caches and live sockets are told.
+
+Jobs are idempotent, so an interrupted one can simply be run again:
+``manage.py run_deletion_jobs`` resumes whatever a restart left behind.
+``CHAT_DELETION_WORKERS`` sizes the per-process pool; 0 runs jobs inline
+on commit, which tests use.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import connection, connections, models, transaction
+from django.utils import timezone
+
+from .membership import account_deleted, group_deleted, invalidate_group, membership_revoked
+from .message_cache import get_message_cache, invalidate_user
+from .models import Conversation, DeletionJob, Group, GroupMember, GroupMessage, Message
+from .rooms import dm_room_name, group_room_name
+from .user_index import user_index
+
+User = get_user_model()
+
+_executor = None
+
+
+def schedule_deletion(kind, target_id, requested_by=None):
+    """Queue a job to purge the target once the current transaction commits"""
+    job = DeletionJob.objects.create(kind=kind, target_id=target_id, requested_by=requested_by)
+    transaction.on_commit(lambda: submit(job.pk))
+    return job
+
+
+def hide_group(group_id, slug=None):
+    Group.objects.filter(pk=group_id).update(pending_delete=True)
+    invalidate_group(group_id, slug)
+    # Connected sockets leave now rather than once the purge has finished
+    group_deleted(group_id)
+
+
+def request_group_deletion(group_id, slug, requested_by=None):
+    hide_group(group_id, slug)
+    get_message_cache().invalidate(group_room_name(group_id))
+    return schedule_deletion(DeletionJob.GROUP, group_id, requested_by)
+
+
+def request_account_deletion(user):
+    User.objects.filter(pk=user.pk).update(is_active=False)
+    # Groups the user created go with them; hide those now too
+    for group_id, slug in Group.objects.filter(created_by=user).values_list('id', 'slug'):
+        hide_group(group_id, slug)
+    invalidate_user(user)
+    # update() sends no post_save; drop the name from search and close the
+    # account's and its peers' sockets now rather than once it is purged
+    transaction.on_commit(lambda: user_index.remove(user.pk))
+    account_deleted(user.pk, peer_ids(user.pk))
+    return schedule_deletion(DeletionJob.USER, user.pk, user)
+
+
+def peer_ids(user_id):
+    return {
+        high if low == user_id else low
+        for low, high in Conversation.objects.filter(
+            models.Q(user_low_id=user_id) | models.Q(user_high_id=user_id)
+        ).values_list('user_low_id', 'user_high_id')
+    }
+
+
+def submit(job_id):
+    global _executor
+    if not settings.CHAT_DELETION_WORKERS:
+        return run_job(job_id)
+    if _executor is None:
+        _executor = ThreadPoolExecutor(settings.CHAT_DELETION_WORKERS, thread_name_prefix='deletion')
+    return _executor.submit(_run_in_worker, job_id)
+
+
+def _run_in_worker(job_id):
+    try:
+        run_job(job_id)
+    finally:
+        # Pool threads hold their own connections; don't leave them open
+        connections.close_all()
+
+
+def run_job(job_id):
+    job = DeletionJob.objects.get(pk=job_id)
+    if job.status == DeletionJob.DONE:
+        return job
+    _update(job, status=DeletionJob.RUNNING, error='')
+    try:
+        if job.kind == DeletionJob.GROUP:
+            purge_group(job, job.target_id)
+        else:
+            purge_user(job, job.target_id)
+    except Exception as e:
+        print(f"Error in deletion job {job.pk} ({job.kind} {job.target_id}): {str(e)}")
+        _update(job, status=DeletionJob.FAILED, error=str(e))
+        return job
+    _update(job, status=DeletionJob.DONE, stage='', finished_at=timezone.now())
+    return job
+
+
+def _update(job, **fields):
+    fields['updated_at'] = timezone.now()
+    DeletionJob.objects.filter(pk=job.pk).update(**fields)
+    for name, value in fields.items():
+        setattr(job, name, value)
+
+
+def delete_in_batches(job, model, where, params):
+    """Delete ``model`` rows matching the SQL ``where`` clause, one bounded batch per transaction"""
+    table = connection.ops.quote_name(model._meta.db_table)
+    sql = f"DELETE FROM {table} WHERE id IN (SELECT id FROM {table} WHERE {where} LIMIT %s)"
+    batch_size = settings.CHAT_DELETION_BATCH_SIZE
+    _update(job, stage=model._meta.db_table)
+    while True:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(sql, [*params, batch_size])
+                deleted = cursor.rowcount
+            if deleted:
+                DeletionJob.objects.filter(pk=job.pk).update(
+                    deleted_rows=models.F('deleted_rows') + deleted, updated_at=timezone.now()
+                )
+                job.deleted_rows += deleted
+        if deleted < batch_size:
+            return
+
+
+def purge_group(job, group_id):
+    # The group's last_message would otherwise point at purged rows
+    Group.objects.filter(pk=group_id).update(last_message=None)
+    delete_in_batches(job, GroupMessage, 'group_id = %s', [group_id])
+    delete_in_batches(job, GroupMember, 'group_id = %s', [group_id])
+
+    with transaction.atomic():
+        # Only the row itself is left to collect; post_delete invalidates the membership cache
+        Group.objects.filter(pk=group_id).delete()
+        group_deleted(group_id)
+    get_message_cache().invalidate(group_room_name(group_id))
+
+
+def purge_user(job, user_id):
+    for group_id in Group.objects.filter(created_by_id=user_id).values_list('id', flat=True):
+        purge_group(job, group_id)
+
+    peers = peer_ids(user_id)
+    # Inboxes first, so peers stop seeing the conversation straight away
+    delete_in_batches(job, Conversation, 'user_low_id = %s OR user_high_id = %s', [user_id, user_id])
+    delete_in_batches(job, Message, 'sender_id = %s OR receiver_id = %s', [user_id, user_id])
+
+    # Messages in other people's groups; their last-message columns are re-derived after
+    touched = set(GroupMessage.objects.filter(sender_id=user_id).values_list('group_id', flat=True).distinct())
+    Group.objects.filter(last_message__sender_id=user_id).update(last_message=None)
+    delete_in_batches(job, GroupMessage, 'sender_id = %s', [user_id])
+    for group_id in touched:
+        Group(pk=group_id).refresh_last_message()
+
+    memberships = list(GroupMember.objects.filter(user_id=user_id).values_list('group_id', flat=True))
+    delete_in_batches(job, GroupMember, 'user_id = %s', [user_id])
+    with transaction.atomic():
+        for group_id in memberships:
+            invalidate_group(group_id)  # raw deletes send no signals
+            Group(pk=group_id).refresh_member_count()
+            membership_revoked(group_id, [user_id])
+        # Only the user and profile rows are left for the collector
+        User.objects.filter(pk=user_id).delete()
+        account_deleted(user_id, peers)
+
+    get_message_cache().invalidate(
+        *[dm_room_name(user_id, peer_id) for peer_id in peers],
+        *[group_room_name(group_id) for group_id in touched]
+    )
+
@@ -0,0 +1,139 @@
+"""
+Streaming conversation export.
+
+History is read with a server-side ``iterator(chunk_size=...)`` and
+encoded as NDJSON or CSV into roughly ``BUFFER_SIZE`` byte chunks,
+optionally gzipped on the fly, so memory stays flat however long the
+conversation is.
+
+Under ASGI, Django buffers a synchronous streaming iterator whole before
+sending it. ``streaming_body`` hands ASGI requests an async iterator
+instead, which pulls one chunk at a time on the request's sync thread
+(the thread that owns the DB cursor).
+"""
+import csv
+import io
+import itertools
+import json
+import zlib
+from datetime import timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.db import models
+from django.http import StreamingHttpResponse
+
+from .models import Message, GroupMessage
+
+CHUNK_SIZE = 2000
+BUFFER_SIZE = 64 * 1024
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+DM_FIELDS = ('id', 'timestamp', 'sender_id', 'sender', 'receiver_id', 'content')
+GROUP_FIELDS = ('id', 'timestamp', 'sender_id', 'sender', 'group_id', 'content')
+
+
+def direct_message_rows(user, other_user):
+    """Both sides of a DM, oldest first"""
+    usernames = {user.id: user.username, other_user.id: other_user.username}
+    rows = Message.objects.filter(
+        models.Q(sender=user, receiver=other_user) | models.Q(sender=other_user, receiver=user)
+    ).order_by('timestamp', 'id').values_list('id', 'timestamp', 'sender_id', 'receiver_id', 'content')
+    for message_id, timestamp, sender_id, receiver_id, content in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield (message_id, _isoformat(timestamp), sender_id, usernames.get(sender_id), receiver_id, content)
+
+
+def group_message_rows(group_id):
+    rows = GroupMessage.objects.filter(group_id=group_id).order_by('timestamp', 'id').values_list(
+        'id', 'timestamp', 'sender_id', 'sender__username', 'group_id', 'content'
+    )
+    for message_id, timestamp, sender_id, sender, group_id, content in rows.iterator(chunk_size=CHUNK_SIZE):
+        yield (message_id, _isoformat(timestamp), sender_id, sender, group_id, content)
+
+
+def _isoformat(timestamp):
+    return timestamp.astimezone(dt_timezone.utc).isoformat()
+
+
+def encode_ndjson(fields, rows):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), ensure_ascii=False) + '\n'
+
+
+def encode_csv(fields, rows):
+    line = io.StringIO()
+    writer = csv.writer(line)
+    for values in itertools.chain([fields], rows):
+        writer.writerow(values)
+        yield line.getvalue()
+        line.seek(0)
+        line.truncate()
+
+
+ENCODERS = {
+    'ndjson': encode_ndjson,
+    'csv': encode_csv,
+}
+
+
+def buffered(lines, size=BUFFER_SIZE):
+    """Join encoded lines into chunks of about ``size`` bytes"""
+    buffer = []
+    length = 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        length += len(data)
+        if length >= size:
+            yield b''.join(buffer)
+            buffer = []
+            length = 0
+    if buffer:
+        yield b''.join(buffer)
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export_chunks(fields, rows, fmt, gzip=False):
+    chunks = buffered(ENCODERS[fmt](fields, rows))
+    return gzipped(chunks) if gzip else chunks
+
+
+_DONE = object()
+
+
+async def _aiterate(iterator):
+    # thread_sensitive keeps every step on the thread that owns the DB connection
+    step = sync_to_async(next, thread_sensitive=True)
+    while True:
+        chunk = await step(iterator, _DONE)
+        if chunk is _DONE:
+            return
+        yield chunk
+
+
+def streaming_body(request, chunks):
+    if isinstance(request, ASGIRequest):
+        return _aiterate(iter(chunks))
+    return chunks
+
+
+def export_response(request, name, fields, rows, fmt, gzip=False):
+    filename = f"{name}.{fmt}.gz" if gzip else f"{name}.{fmt}"
+    response = StreamingHttpResponse(
+        streaming_body(request, export_chunks(fields, rows, fmt, gzip=gzip)),
+        content_type='application/gzip' if gzip else f"{FORMATS[fmt]}; charset=utf-8"
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
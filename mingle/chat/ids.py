@@ -0,0 +1,73 @@
+"""
+Snowflake-style message ids.
+
+53-bit layout: 41 bits of milliseconds since ``EPOCH_MS``, 5 bits of node
+id (``CHAT_NODE_ID``) and a 7 bit per-millisecond sequence. Ids from one
+node are strictly increasing, and ids from different nodes sort by time
+to within a millisecond, so they can be used directly as message primary
+keys and handed to clients before the row is written. Staying within 53
+bits keeps them exact as JavaScript numbers.
+
+They share the primary key space with the database's autoincrement ids,
+and one Snowflake row pushes the next autoincrement value past every
+later Snowflake id, so mixing the two breaks time order (which the read
+watermark and the keyset cursors rely on). Once ``CHAT_SNOWFLAKE_IDS`` or
+``CHAT_OPTIMISTIC_DELIVERY`` is on, every insert path takes its id from
+``assign_message_id``, and it has to stay on for that database.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+NODE_BITS = 5
+SEQUENCE_BITS = 7
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+
+
+class SnowflakeGenerator:
+    def __init__(self, node_id):
+        if not 0 <= node_id < (1 << NODE_BITS):
+            raise ValueError(f"node_id must fit in {NODE_BITS} bits")
+        self.node_id = node_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self):
+        with self._lock:
+            now_ms = max(int(time.time() * 1000), self._last_ms)  # never step back
+            if now_ms == self._last_ms:
+                self._sequence = (self._sequence + 1) & MAX_SEQUENCE
+                if self._sequence == 0:
+                    # Sequence exhausted for this millisecond, borrow the next one
+                    now_ms += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now_ms
+            return ((now_ms - EPOCH_MS) << (NODE_BITS + SEQUENCE_BITS)) \
+                | (self.node_id << SEQUENCE_BITS) \
+                | self._sequence
+
+
+_generator = None
+
+
+def next_message_id():
+    global _generator
+    if _generator is None:
+        _generator = SnowflakeGenerator(settings.CHAT_NODE_ID)
+    return _generator.next_id()
+
+
+def snowflake_ids_enabled():
+    return settings.CHAT_SNOWFLAKE_IDS or settings.CHAT_OPTIMISTIC_DELIVERY
+
+
+def assign_message_id(message_id=None):
+    """The id to insert a message with: ``message_id`` if given, a Snowflake
+    id when they are enabled, otherwise None for the database to pick"""
+    if message_id is None and snowflake_ids_enabled():
+        return next_message_id()
+    return message_id
@@ -0,0 +1,222 @@
+"""
+Hybrid channel layer.
+
+A ``RedisChannelLayer`` that skips Redis for channels living in this
+process. Consumer channels are process-specific (``specific.<client
+prefix>!...``), so the layer can tell its own channels apart. Messages to
+those channels are put straight into the receive buffer the Redis layer
+already reads from, with no serialization or network hop. Only channels
+owned by other processes go through Redis.
+
+``group_send`` fetches the group's members in one pipelined round trip,
+delivers to local members in memory and only writes to Redis for remote
+members. Those are written the way channels_redis writes a group: one
+script call per Redis shard covering every remote channel on it, one
+message per process. A room whose members are all on this process costs
+no Redis writes.
+
+``group_send_many`` sends one message to several groups as one batch: a
+channel in more than one of them gets it once, and the remote channels
+of every group share the per-shard script calls.
+
+channels_redis reads Redis for all of this process's channels from
+whichever ``receive`` holds its receive lock, parked in a BRPOP. A local
+delivery to that very channel would sit in the buffer until some Redis
+message arrived, so the lock holder races its Redis read against a
+wakeup set by local deliveries to the channel it is receiving for.
+
+With ``"hosts": []`` the layer never touches Redis. Groups are then kept
+in memory, which suits development, tests and single-process
+deployments.
+
+Relies on ``receive_buffer``, ``client_prefix`` and
+``_map_channel_keys_to_connection`` from channels_redis (pinned in
+requirements.txt).
+"""
+import asyncio
+import contextvars
+import time
+from collections import defaultdict
+
+from channels.exceptions import ChannelFull
+from channels_redis.core import RedisChannelLayer
+
+
+# The channel the current receive() task is waiting on, for receive_single
+_receiving = contextvars.ContextVar('receiving', default=None)
+
+# channels_redis' group send: add each message to its channel key unless full
+SEND_MANY_LUA = """
+    local over_capacity = 0
+    local current_time = ARGV[#ARGV - 1]
+    local expiry = ARGV[#ARGV]
+    for i=1,#KEYS do
+        if redis.call('ZCOUNT', KEYS[i], '-inf', '+inf') < tonumber(ARGV[i + #KEYS]) then
+            redis.call('ZADD', KEYS[i], current_time, ARGV[i])
+            redis.call('EXPIRE', KEYS[i], expiry)
+        else
+            over_capacity = over_capacity + 1
+        end
+    end
+    return over_capacity
+"""
+
+
+class HybridChannelLayer(RedisChannelLayer):
+    def __init__(self, hosts=None, **kwargs):
+        self.local_only = hosts is not None and not hosts
+        super().__init__(hosts=hosts or None, **kwargs)
+        self.local_groups = defaultdict(dict)  # group -> {channel: added_at}, local_only mode
+        self.local_wakeups = {}  # channel -> Event, for a receive parked in Redis
+
+    def is_local(self, channel):
+        return "!" in channel and self.non_local_name(channel).endswith(self.client_prefix + "!")
+
+    def deliver_local(self, channel, message):
+        buffer = self.receive_buffer[channel]
+        if buffer.qsize() >= self.get_capacity(channel):
+            raise ChannelFull()
+        # Each recipient gets its own top-level dict, as a deserialized copy would be
+        buffer.put_nowait(dict(message))
+        wakeup = self.local_wakeups.get(channel)
+        if wakeup is not None:
+            wakeup.set()
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        if self.local_only or self.is_local(channel):
+            self.deliver_local(channel, message)
+        else:
+            await super().send(channel, message)
+
+    async def receive(self, channel):
+        if not self.local_only:
+            token = _receiving.set(channel)
+            try:
+                return await super().receive(channel)
+            finally:
+                _receiving.reset(token)
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        buffer = self.receive_buffer[channel]
+        try:
+            return await buffer.get()
+        finally:
+            if buffer.empty() and self.receive_buffer.get(channel) is buffer:
+                del self.receive_buffer[channel]
+
+    async def receive_single(self, channel):
+        """
+        Called by the receive lock holder. Returns early, with no message
+        and an empty channel list (which the caller's buffering loop
+        skips), if a local message reaches the waiting channel first.
+        """
+        waiting = _receiving.get()
+        if self.local_only or waiting is None or "!" not in channel:
+            return await super().receive_single(channel)
+        if not self.receive_buffer[waiting].empty():
+            return [], None
+
+        wakeup = self.local_wakeups[waiting] = asyncio.Event()
+        redis = asyncio.ensure_future(super().receive_single(channel))
+        woken = asyncio.ensure_future(wakeup.wait())
+        try:
+            await asyncio.wait([redis, woken], return_when=asyncio.FIRST_COMPLETED)
+            if not redis.done():
+                # Safe to abandon: channels_redis restores half-read messages from its backup queue
+                redis.cancel()
+                try:
+                    await redis
+                except asyncio.CancelledError:
+                    pass
+            if redis.cancelled():
+                return [], None
+            return redis.result()
+        finally:
+            woken.cancel()
+            if not redis.done():
+                redis.cancel()
+            if self.local_wakeups.get(waiting) is wakeup:
+                del self.local_wakeups[waiting]
+
+    async def group_add(self, group, channel):
+        if not self.local_only:
+            return await super().group_add(group, channel)
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.local_groups[group][channel] = time.time()
+
+    async def group_discard(self, group, channel):
+        if not self.local_only:
+            return await super().group_discard(group, channel)
+        members = self.local_groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.local_groups[group]
+
+    async def group_members(self, group):
+        if self.local_only:
+            cutoff = time.time() - self.group_expiry
+            members = self.local_groups.get(group, {})
+            return [channel for channel, added_at in members.items() if added_at > cutoff]
+
+        key = self._group_key(group)
+        pipe = self.connection(self.consistent_hash(group)).pipeline()
+        pipe.zremrangebyscore(key, min=0, max=int(time.time()) - self.group_expiry)
+        pipe.zrange(key, 0, -1)
+        _, members = await pipe.execute()
+        return [member.decode("utf8") for member in members]
+
+    async def group_send(self, group, message):
+        await self.group_send_many([group], message)
+
+    async def group_send_many(self, groups, message):
+        for group in groups:
+            assert self.valid_group_name(group), "Group name not valid"
+        channels = {}
+        for members in await asyncio.gather(*(self.group_members(group) for group in groups)):
+            channels.update(dict.fromkeys(members))
+
+        remote = []
+        for channel in channels:
+            if self.local_only or self.is_local(channel):
+                try:
+                    self.deliver_local(channel, message)
+                except ChannelFull:
+                    pass  # as with Redis, a full channel just misses group messages
+            else:
+                remote.append(channel)
+
+        if remote:
+            await self.send_many(remote, message)
+
+    async def send_many(self, channels, message):
+        """
+        Write message to remote channels in one pipelined expiry sweep and
+        one script call per Redis shard. Channels of the same process share
+        a Redis key and so get one copy. Full channels miss the message.
+        """
+        connection_keys, key_messages, key_capacities = self._map_channel_keys_to_connection(channels, message)
+
+        async def send_to_shard(index, keys):
+            connection = self.connection(index)
+            now = time.time()
+            pipe = connection.pipeline()
+            for key in keys:
+                pipe.zremrangebyscore(key, min=0, max=int(now) - int(self.expiry))
+            await pipe.execute()
+            await connection.eval(
+                SEND_MANY_LUA, len(keys), *keys,
+                *[key_messages[key] for key in keys],
+                *[key_capacities[key] for key in keys],
+                now, self.expiry
+            )
+
+        await asyncio.gather(*(send_to_shard(index, keys) for index, keys in connection_keys.items()))
+
+    async def flush(self):
+        self.receive_buffer.clear()
+        self.local_groups.clear()
+        if not self.local_only:
+            await super().flush()
@@ -0,0 +1,379 @@
+"""
+WebSocket load generator.
+
+A fleet of clients logs in with real sessions (so every socket goes
+through AuthMiddlewareStack), then opens ChatConsumer sockets for
+``dm_pairs`` pairs of users and GroupChatConsumer sockets for ``groups``
+groups of ``group_size`` members. Every socket sends ``rate`` messages per
+second for ``duration`` seconds. Received frames are matched to their
+send time by ``client_msg_id`` for end-to-end delivery latency. The DB
+write rate comes from counting the rows written until every message has
+landed.
+
+By default clients connect to the websocket routes in this process, over
+whatever channel layer is configured. Given a ``ws://host:port`` URL they
+connect to a running Daphne worker instead, which must share this
+process' database so the sessions are valid.
+
+``run_load`` returns a JSON-serializable report with sorted, rounded
+values, so reports from two commits can be diffed directly.
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import struct
+import time
+from importlib import import_module
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from channels.auth import AuthMiddlewareStack
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import Client
+from django.utils.module_loading import import_string
+
+from .membership import invalidate_group
+from .models import Group, GroupMember, GroupMessage, Message
+from .routing import websocket_urlpatterns
+
+User = get_user_model()
+
+PREFIX = 'loadtest'
+
+
+def percentiles(values):
+    """Nearest-rank p50/p95/p99 and max, in the unit given"""
+    if not values:
+        return {'p50': None, 'p95': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def rank(p):
+        return round(values[max(0, int(len(values) * p + 0.5) - 1)], 3)
+
+    return {'p50': rank(0.50), 'p95': rank(0.95), 'p99': rank(0.99), 'max': round(values[-1], 3)}
+
+
+class InProcessSocket:
+    """A client socket driven straight through the ASGI websocket stack"""
+
+    application = None
+
+    def __init__(self, path, session_key):
+        if InProcessSocket.application is None:
+            InProcessSocket.application = AuthMiddlewareStack(URLRouter(websocket_urlpatterns))
+        cookie = f"{settings.SESSION_COOKIE_NAME}={session_key}".encode()
+        self.communicator = WebsocketCommunicator(self.application, path, headers=[
+            (b'cookie', cookie), (b'origin', b'http://localhost'), (b'host', b'localhost'),
+        ])
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect(timeout=10)
+        return connected
+
+    async def send(self, payload):
+        await self.communicator.send_to(text_data=json.dumps(payload))
+
+    async def receive(self):
+        """The next frame, or None once the server closed the socket"""
+        # No timeout: a timed out receive_output cancels the consumer
+        message = await self.communicator.receive_output(timeout=None)
+        if message['type'] != 'websocket.send':
+            return None
+        return json.loads(message.get('text') or message['bytes'])
+
+    async def close(self):
+        try:
+            await self.communicator.disconnect(timeout=5)
+        except Exception:
+            pass
+
+
+class DaphneSocket:
+    """
+    A minimal RFC 6455 client over asyncio streams, for loading a running
+    server. (autobahn's asyncio client can't be used here: daphne has
+    already bound txaio to Twisted in this process.)
+    """
+
+    def __init__(self, base_url, path, session_key):
+        self.url = urlparse(base_url.rstrip('/') + path)
+        self.session_key = session_key
+        self.writer = None
+
+    async def connect(self):
+        host, port = self.url.hostname, self.url.port or 80
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        self.writer.write((
+            f"GET {self.url.path} HTTP/1.1\r\n"
+            f"Host: {self.url.netloc}\r\n"
+            f"Origin: http://{self.url.netloc}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            f"Cookie: {settings.SESSION_COOKIE_NAME}={self.session_key}\r\n\r\n"
+        ).encode())
+        response = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), 10)
+        return response.split(b' ', 2)[1] == b'101'
+
+    async def send(self, payload):
+        self._write_frame(0x1, json.dumps(payload).encode())
+        await self.writer.drain()
+
+    def _write_frame(self, opcode, data):
+        # Client frames are always masked
+        mask = os.urandom(4)
+        length = len(data)
+        if length < 126:
+            header = struct.pack('!BB', 0x80 | opcode, 0x80 | length)
+        elif length < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 0x80 | 126, length)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 0x80 | 127, length)
+        self.writer.write(header + mask + bytes(b ^ mask[i % 4] for i, b in enumerate(data)))
+
+    async def receive(self):
+        while True:
+            try:
+                first, second = await self.reader.readexactly(2)
+                length = second & 0x7f
+                if length == 126:
+                    length, = struct.unpack('!H', await self.reader.readexactly(2))
+                elif length == 127:
+                    length, = struct.unpack('!Q', await self.reader.readexactly(8))
+                data = await self.reader.readexactly(length)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return None
+            opcode = first & 0x0f
+            if opcode == 0x8:
+                return None
+            if opcode == 0x9:
+                self._write_frame(0xa, data)  # pong
+            elif opcode in (0x1, 0x2):
+                return json.loads(data)
+
+    async def close(self):
+        if self.writer is not None:
+            try:
+                self._write_frame(0x8, struct.pack('!H', 1000))
+                await self.writer.drain()
+                self.writer.close()
+            except Exception:
+                pass
+
+
+def create_fleet(dm_pairs, groups, group_size):
+    """
+    Users with logged-in sessions, the DM pairs and groups they talk in.
+    Users are shared between the DM and group workloads.
+    """
+    count = max(2 * dm_pairs, group_size)
+    users = [User.objects.create_user(f"{PREFIX}_{i}") for i in range(count)]
+
+    sessions = {}
+    for user in users:
+        client = Client()
+        client.force_login(user)
+        sessions[user.id] = client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    fleet_groups = []
+    for g in range(groups):
+        members = users[:group_size]
+        group = Group.objects.create(name=f"{PREFIX} {g}", slug=f"{PREFIX}-{g}", created_by=members[0])
+        GroupMember.objects.bulk_create([
+            GroupMember(group=group, user=user, is_admin=i == 0) for i, user in enumerate(members)
+        ])
+        invalidate_group(group.id)
+        group.refresh_member_count()
+        fleet_groups.append((group.slug, [user.id for user in members]))
+
+    return {
+        'sessions': sessions,
+        'dm_pairs': [(users[2 * i].id, users[2 * i + 1].id) for i in range(dm_pairs)],
+        'groups': fleet_groups,
+    }
+
+
+def delete_fleet(fleet):
+    store = import_module(settings.SESSION_ENGINE).SessionStore()
+    for session_key in fleet['sessions'].values():
+        store.delete(session_key)
+    User.objects.filter(id__in=fleet['sessions']).delete()
+
+
+def count_rows(user_ids):
+    return Message.objects.filter(sender_id__in=user_ids).count() + \
+        GroupMessage.objects.filter(sender_id__in=user_ids).count()
+
+
+class LoadRun:
+    def __init__(self, fleet, rate, duration, drain, url=None, seed=0):
+        self.fleet = fleet
+        self.rate = rate
+        self.duration = duration
+        self.drain = drain
+        self.url = url
+        self.random = random.Random(seed)
+        self.sent = {}  # client_msg_id -> (kind, send time)
+        self.expected = {'dm': 0, 'group': 0}
+        self.latencies = {'dm': [], 'group': []}
+        self.connect_ms = []
+        self.failed = 0
+
+    def socket(self, path, user_id):
+        session_key = self.fleet['sessions'][user_id]
+        if self.url:
+            return DaphneSocket(self.url, path, session_key)
+        return InProcessSocket(path, session_key)
+
+    def plan(self):
+        """(kind, user_id, path, receivers per message) for every socket"""
+        sockets = []
+        for a, b in self.fleet['dm_pairs']:
+            sockets.append(('dm', a, f"/ws/chat/{b}/", 1))
+            sockets.append(('dm', b, f"/ws/chat/{a}/", 1))
+        for slug, member_ids in self.fleet['groups']:
+            for user_id in member_ids:
+                sockets.append(('group', user_id, f"/ws/group/{slug}/", len(member_ids) - 1))
+        return sockets
+
+    async def open(self, kind, user_id, path):
+        socket = self.socket(path, user_id)
+        start = time.perf_counter()
+        try:
+            connected = await socket.connect()
+        except Exception:
+            connected = False
+        if not connected:
+            self.failed += 1
+            return None
+        self.connect_ms.append((time.perf_counter() - start) * 1000)
+        return socket
+
+    async def receive_loop(self, socket, user_id):
+        while True:
+            frame = await socket.receive()
+            if frame is None:
+                return
+            entry = self.sent.get(frame.get('client_msg_id'))
+            # Skip acks and the sender's own echo
+            if entry is None or 'type' in frame or frame.get('sender_id') == user_id:
+                continue
+            kind, sent_at = entry
+            self.latencies[kind].append((time.perf_counter() - sent_at) * 1000)
+
+    async def send_loop(self, socket, index, kind, receivers, started):
+        offset = self.random.random() / self.rate  # spread sockets over the first interval
+        for seq in range(int(self.rate * self.duration)):
+            delay = started + offset + seq / self.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            client_msg_id = f"{index}:{seq}"
+            self.sent[client_msg_id] = (kind, time.perf_counter())
+            self.expected[kind] += receivers
+            await socket.send({'message': 'load', 'content': f"load {client_msg_id}", 'client_msg_id': client_msg_id})
+
+    def delivered(self):
+        return sum(len(latencies) for latencies in self.latencies.values())
+
+    async def run(self):
+        plan = self.plan()
+        sockets = await asyncio.gather(*(self.open(kind, user_id, path) for kind, user_id, path, _ in plan))
+        live = [(socket, spec) for socket, spec in zip(sockets, plan) if socket is not None]
+        readers = [asyncio.ensure_future(self.receive_loop(socket, spec[1])) for socket, spec in live]
+
+        user_ids = list(self.fleet['sessions'])
+        rows_before = await sync_to_async(count_rows)(user_ids)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            self.send_loop(socket, index, kind, receivers, started)
+            for index, (socket, (kind, _, _, receivers)) in enumerate(live)
+        ))
+        send_elapsed = time.perf_counter() - started
+
+        # Let deliveries and writes catch up
+        sent = len(self.sent)
+        deadline = time.perf_counter() + self.drain
+        rows = 0
+        while True:
+            rows = await sync_to_async(count_rows)(user_ids) - rows_before
+            if rows >= sent and self.delivered() >= sum(self.expected.values()):
+                break
+            if time.perf_counter() > deadline:
+                break
+            await asyncio.sleep(0.05)
+        write_elapsed = time.perf_counter() - started
+
+        for reader in readers:
+            reader.cancel()
+        await asyncio.gather(*readers, return_exceptions=True)
+        await asyncio.gather(*(socket.close() for socket, _ in live))
+
+        return self.report(len(live), sent, send_elapsed, rows, write_elapsed)
+
+    def report(self, opened, sent, send_elapsed, rows, write_elapsed):
+        sent_by_kind = {'dm': 0, 'group': 0}
+        for kind, _ in self.sent.values():
+            sent_by_kind[kind] += 1
+
+        report = {
+            'connections': {
+                'opened': opened,
+                'failed': self.failed,
+                'connect_ms': percentiles(self.connect_ms),
+            },
+            'db': {
+                'rows_written': rows,
+                'rows_expected': sent,
+                'writes_per_sec': round(rows / write_elapsed, 1) if write_elapsed else None,
+            },
+            'throughput': {
+                'sent_per_sec': round(sent / send_elapsed, 1) if send_elapsed else None,
+                'delivered_per_sec': round(self.delivered() / write_elapsed, 1) if write_elapsed else None,
+            },
+        }
+        for kind in ('dm', 'group'):
+            report[kind] = {
+                'sent': sent_by_kind[kind],
+                'expected': self.expected[kind],
+                'delivered': len(self.latencies[kind]),
+                'lost': self.expected[kind] - len(self.latencies[kind]),
+                'latency_ms': percentiles(self.latencies[kind]),
+            }
+        return report
+
+
+def describe_target(url=None):
+    """Settings that shape the results, recorded in the report"""
+    if url:
+        return {'target': url}
+    layer = settings.CHANNEL_LAYERS['default']
+    backend = import_string(layer['BACKEND'])
+    return {
+        'target': 'in-process',
+        'channel_layer': f"{backend.__module__}.{backend.__qualname__}",
+        'channel_layer_hosts': len(layer.get('CONFIG', {}).get('hosts', [])),
+        'database': settings.DATABASES['default']['ENGINE'],
+        'optimistic_delivery': settings.CHAT_OPTIMISTIC_DELIVERY,
+        'write_behind': settings.CHAT_WRITE_BEHIND,
+    }
+
+
+async def run_load(dm_pairs=10, groups=2, group_size=10, rate=1.0, duration=10.0, drain=5.0, url=None, seed=0):
+    fleet = await sync_to_async(create_fleet)(dm_pairs, groups, group_size)
+    try:
+        report = await LoadRun(fleet, rate, duration, drain, url=url, seed=seed).run()
+    finally:
+        await sync_to_async(delete_fleet)(fleet)
+    report['config'] = dict(
+        describe_target(url),
+        dm_pairs=dm_pairs, groups=groups, group_size=group_size,
+        rate=rate, duration=duration, seed=seed,
+    )
+    return report
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import models
+
+from chat.avatars import DEFAULT_PICTURE, process_picture, variant_field
+from chat.models import Profile
+
+
+class Command(BaseCommand):
+    help = "Make the missing thumbnail variants for profile pictures uploaded before they existed"
+
+    def handle(self, *args, **options):
+        missing = models.Q()
+        for size in settings.CHAT_AVATAR_SIZES:
+            missing |= models.Q(**{variant_field(size): ''})
+        profiles = Profile.objects.filter(missing).exclude(profile_picture__in=['', DEFAULT_PICTURE]) \
+            .exclude(profile_picture__isnull=True) \
+            .values_list('id', 'profile_picture')
+
+        done = failed = 0
+        for profile_id, original in profiles.iterator():
+            try:
+                # Nothing is stale: the original stays in use
+                process_picture(profile_id, original)
+                done += 1
+            except Exception as e:
+                failed += 1
+                self.stderr.write(f"Profile {profile_id} ({original}): {str(e)}")
+
+        self.stdout.write(self.style.SUCCESS(f"Made variants for {done} profiles, {failed} failed"))
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.models import Group, member_count_subquery
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized last-message and member-count columns on Group"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        updated = Group.objects.update(member_count=member_count_subquery())
+        self.stdout.write(f"Refreshed member counts for {updated} groups")
+
+        group_ids = list(Group.objects.values_list('id', flat=True).order_by('id'))
+        for start in range(0, len(group_ids), batch_size):
+            batch = group_ids[start:start + batch_size]
+            with transaction.atomic():
+                for group_id in batch:
+                    Group(pk=group_id).refresh_last_message()
+            self.stdout.write(f"Backfilled last message for {min(start + batch_size, len(group_ids))}/{len(group_ids)} groups")
+
+        self.stdout.write(self.style.SUCCESS("Group stats backfill complete"))
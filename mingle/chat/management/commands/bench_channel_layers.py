@@ -0,0 +1,174 @@
+import asyncio
+import multiprocessing
+import statistics
+import time
+import uuid
+
+from channels.layers import channel_layers
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chat.layers import HybridChannelLayer
+from chat.routing import websocket_urlpatterns
+
+User = get_user_model()
+
+LAYERS = {
+    'in-memory': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+    'hybrid': {'BACKEND': 'chat.layers.HybridChannelLayer', 'CONFIG': {'hosts': [('127.0.0.1', 6379)]}},
+    'hybrid (no redis)': {'BACKEND': 'chat.layers.HybridChannelLayer', 'CONFIG': {'hosts': []}},
+    'redis': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [('127.0.0.1', 6379)]}},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure ChatConsumer send -> receive round trips on each channel layer, then "
+        "group sends to members spread over several processes sharing one Redis"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=500)
+        parser.add_argument('--layers', nargs='+', choices=list(LAYERS), default=list(LAYERS))
+        parser.add_argument('--processes', type=int, default=4,
+                            help="Receiving processes for the group send case; 0 skips it")
+        parser.add_argument('--members', type=int, default=50, help="Group members per receiving process")
+        parser.add_argument('--group-messages', type=int, default=200)
+
+    def handle(self, *args, **options):
+        sender, _ = User.objects.get_or_create(username='bench_sender')
+        receiver, _ = User.objects.get_or_create(username='bench_receiver')
+        try:
+            self.stdout.write(f"{'layer':<20}{'p50 ms':>9}{'p99 ms':>9}{'msgs/sec':>10}")
+            for name in options['layers']:
+                unreachable = self._unreachable_redis(LAYERS[name])
+                if unreachable:
+                    self.stdout.write(f"{name:<20}skipped (redis unreachable: {unreachable})")
+                    continue
+                with override_settings(CHANNEL_LAYERS={'default': LAYERS[name]}):
+                    channel_layers.backends = {}
+                    try:
+                        latencies = asyncio.run(self._round_trips(sender, receiver, options['messages']))
+                    finally:
+                        channel_layers.backends = {}
+                latencies.sort()
+                p99 = latencies[int(len(latencies) * 0.99) - 1]
+                self.stdout.write(
+                    f"{name:<20}{statistics.median(latencies):>9.3f}{p99:>9.3f}"
+                    f"{len(latencies) / (sum(latencies) / 1000):>10.0f}"
+                )
+        finally:
+            User.objects.filter(username__in=['bench_sender', 'bench_receiver']).delete()
+
+        if options['processes']:
+            self._group_sends(options)
+
+    def _group_sends(self, options):
+        hosts = LAYERS['hybrid']['CONFIG']['hosts']
+        unreachable = self._unreachable_redis(LAYERS['hybrid'])
+        processes, members, messages = options['processes'], options['members'], options['group_messages']
+        self.stdout.write(f"\ngroup send to {processes} processes x {members} members")
+        self.stdout.write(f"{'strategy':<20}{'send ms':>9}{'deliveries/sec':>16}")
+        if unreachable:
+            self.stdout.write(f"{'':<20}skipped (redis unreachable: {unreachable})")
+            return
+
+        # Forked before any event loop exists, so each receiver starts clean
+        context = multiprocessing.get_context('fork')
+        for strategy in ('per-channel send', 'group_send'):
+            group = f"bench-{uuid.uuid4().hex}"
+            ready, done = context.Queue(), context.Queue()
+            receivers = [
+                context.Process(target=_receive_group, args=(hosts, group, members, messages, ready, done))
+                for _ in range(processes)
+            ]
+            for receiver in receivers:
+                receiver.start()
+            try:
+                for _ in receivers:
+                    ready.get(timeout=30)
+                start = time.time()
+                send_ms = asyncio.run(self._send_group(hosts, group, strategy, messages))
+                finished = max(done.get(timeout=60) for _ in receivers)
+            finally:
+                for receiver in receivers:
+                    receiver.join(timeout=5)
+                    if receiver.is_alive():
+                        receiver.terminate()
+            deliveries = processes * members * messages
+            self.stdout.write(f"{strategy:<20}{send_ms:>9.3f}{deliveries / (finished - start):>16.0f}")
+
+    async def _send_group(self, hosts, group, strategy, messages):
+        """Average ms per group send from a process with no members of its own"""
+        layer = HybridChannelLayer(hosts=hosts)
+        try:
+            start = time.perf_counter()
+            for i in range(messages):
+                message = {'type': 'group.message', 'n': i}
+                if strategy == 'group_send':
+                    await layer.group_send(group, message)
+                else:
+                    # What group_send did before: one Redis send per remote channel
+                    channels = await layer.group_members(group)
+                    await asyncio.gather(*(
+                        super(HybridChannelLayer, layer).send(channel, message) for channel in channels
+                    ))
+            return (time.perf_counter() - start) / messages * 1000
+        finally:
+            await layer.connection(layer.consistent_hash(group)).delete(layer._group_key(group))
+            await layer.close_pools()
+
+    def _unreachable_redis(self, layer):
+        import redis
+
+        for host, port in layer.get('CONFIG', {}).get('hosts', []):
+            try:
+                redis.Redis(host=host, port=port, socket_connect_timeout=1).ping()
+            except redis.exceptions.ConnectionError as e:
+                return str(e)
+        return None
+
+    async def _round_trips(self, sender, receiver, messages):
+        """Sender posts over one socket, the receiver's socket gets it; returns per-message ms"""
+        application = URLRouter(websocket_urlpatterns)
+        sending = WebsocketCommunicator(application, f"/ws/chat/{receiver.id}/")
+        sending.scope['user'] = sender
+        receiving = WebsocketCommunicator(application, f"/ws/chat/{sender.id}/")
+        receiving.scope['user'] = receiver
+        await sending.connect()
+        await receiving.connect()
+        try:
+            latencies = []
+            for i in range(messages):
+                start = time.perf_counter()
+                await sending.send_json_to({'content': f"ping {i}"})
+                await receiving.receive_json_from(timeout=5)
+                latencies.append((time.perf_counter() - start) * 1000)
+                await sending.receive_json_from(timeout=5)  # sender's own echo
+            return latencies
+        finally:
+            await sending.disconnect()
+            await receiving.disconnect()
+
+
+def _receive_group(hosts, group, members, messages, ready, done):
+    """Receiving process: join members to the group, report when all messages arrived"""
+    async def run():
+        layer = HybridChannelLayer(hosts=hosts, capacity=messages + 100)
+        channels = [await layer.new_channel() for _ in range(members)]
+        for channel in channels:
+            await layer.group_add(group, channel)
+        ready.put(True)
+
+        async def drain(channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+
+        await asyncio.gather(*(drain(channel) for channel in channels))
+        done.put(time.time())
+        await layer.close_pools()
+
+    asyncio.run(run())
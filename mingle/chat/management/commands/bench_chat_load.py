@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+from channels.layers import channel_layers
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chat.loadtest import run_load
+
+LAYERS = {
+    'memory': {'BACKEND': 'channels.layers.InMemoryChannelLayer'},
+    'redis': {'BACKEND': 'channels_redis.core.RedisChannelLayer', 'CONFIG': {'hosts': [('127.0.0.1', 6379)]}},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the DM and group websocket paths with a fleet of logged-in clients and "
+        "print a JSON report of delivery latency, loss and DB write rate"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dm-pairs', type=int, default=50)
+        parser.add_argument('--groups', type=int, default=5)
+        parser.add_argument('--group-size', type=int, default=20)
+        parser.add_argument('--rate', type=float, default=1.0, help="Messages per second per socket")
+        parser.add_argument('--duration', type=float, default=10.0, help="Seconds of sending")
+        parser.add_argument('--drain', type=float, default=5.0,
+                            help="Seconds to wait for outstanding deliveries and writes")
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--layer', choices=['settings'] + list(LAYERS), default='settings',
+                            help="Channel layer for in-process runs")
+        parser.add_argument('--url', help="ws:// address of a running Daphne worker to load instead")
+        parser.add_argument('--output', help="Also write the report to this file")
+
+    def handle(self, *args, **options):
+        layers = {'default': LAYERS[options['layer']]} if options['layer'] != 'settings' else None
+        with override_settings(**({'CHANNEL_LAYERS': layers} if layers else {})):
+            channel_layers.backends = {}
+            try:
+                report = asyncio.run(run_load(
+                    dm_pairs=options['dm_pairs'],
+                    groups=options['groups'],
+                    group_size=options['group_size'],
+                    rate=options['rate'],
+                    duration=options['duration'],
+                    drain=options['drain'],
+                    url=options['url'],
+                    seed=options['seed'],
+                ))
+            finally:
+                channel_layers.backends = {}
+
+        output = json.dumps(report, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+        self.stdout.write(output)
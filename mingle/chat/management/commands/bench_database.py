@@ -0,0 +1,134 @@
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction
+from django.test import override_settings
+
+from chat.models import Message
+
+User = get_user_model()
+
+CONFIGS = ['sqlite', 'sqlite-tuned', 'postgres', 'postgres-pool']
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare concurrent message write throughput across database configurations. "
+        "SQLite runs against scratch files; PostgreSQL uses the POSTGRES_* variables "
+        "and must already be migrated."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--writers', type=int, default=16,
+                            help="Threads writing at once, each with its own connection")
+        parser.add_argument('--configs', nargs='+', choices=CONFIGS, default=CONFIGS)
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as scratch:
+            self.stdout.write(f"{'config':<16}{'msgs/sec':>10}{'p99 ms':>9}{'errors':>8}")
+            for name in options['configs']:
+                alias = f"bench_{name.replace('-', '_')}"
+                database, pragmas = self._config(name, scratch)
+                if database is None:
+                    self.stdout.write(f"{name:<16}skipped ({pragmas})")
+                    continue
+
+                connections.settings[alias] = connections.configure_settings({'default': database})['default']
+                try:
+                    with override_settings(CHAT_SQLITE_PRAGMAS=pragmas):
+                        if database['ENGINE'].endswith('sqlite3'):
+                            call_command('migrate', database=alias, verbosity=0)
+                        elapsed, latencies, errors = self._run(alias, options)
+                finally:
+                    connections[alias].close()
+                    del connections.settings[alias]
+
+                latencies.sort()
+                p99 = latencies[int(len(latencies) * 0.99) - 1] if latencies else 0
+                self.stdout.write(f"{name:<16}{len(latencies) / elapsed:>10.0f}{p99:>9.2f}{errors:>8}")
+
+    def _config(self, name, scratch):
+        """Database settings and SQLite pragmas for a config, or (None, reason) to skip it"""
+        if name.startswith('sqlite'):
+            tuned = name == 'sqlite-tuned'
+            return {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': os.path.join(scratch, f'{name}.sqlite3'),
+                'CONN_MAX_AGE': 60 if tuned else 0,
+                'OPTIONS': {'transaction_mode': 'IMMEDIATE'} if tuned else {},
+            # Scratch files, so WAL is safe to turn on whatever CHAT_SQLITE_WAL says
+            }, dict(settings.CHAT_SQLITE_PRAGMAS, journal_mode='WAL', synchronous='NORMAL') if tuned else {}
+
+        try:
+            import psycopg  # noqa: F401
+        except ImportError:
+            return None, "psycopg is not installed"
+        if 'POSTGRES_DB' not in os.environ:
+            return None, "POSTGRES_DB is not set"
+
+        database = {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ['POSTGRES_DB'],
+            'USER': os.environ.get('POSTGRES_USER', 'mingle'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': 60,
+            'OPTIONS': {},
+        }
+        if name == 'postgres-pool':
+            database['CONN_MAX_AGE'] = 0
+            database['OPTIONS']['pool'] = {'min_size': 2, 'max_size': 20, 'timeout': 10}
+        return database, {}
+
+    def _run(self, alias, options):
+        # bulk_create skips the post_save profile hook, which writes to 'default'
+        sender, receiver = User.objects.using(alias).bulk_create([
+            User(username='bench_sender'), User(username='bench_receiver')
+        ])
+        counter = iter(range(options['messages']))
+        lock = threading.Lock()
+        latencies = []
+        errors = 0
+
+        def writer():
+            nonlocal errors
+            connection = connections[alias]
+            try:
+                while True:
+                    with lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    start = time.perf_counter()
+                    try:
+                        with transaction.atomic(using=alias):
+                            Message.objects.using(alias).create(
+                                sender_id=sender.id, receiver_id=receiver.id, content=f"load {i}"
+                            )
+                    except Exception:
+                        errors += 1
+                        continue
+                    finally:
+                        # What close_old_connections does around each consumer DB call
+                        connection.close_if_unusable_or_obsolete()
+                    latencies.append((time.perf_counter() - start) * 1000)
+            finally:
+                connection.close()
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(options['writers']) as pool:
+                for _ in range(options['writers']):
+                    pool.submit(writer)
+            return time.perf_counter() - start, latencies, errors
+        finally:
+            User.objects.using(alias).filter(username__in=['bench_sender', 'bench_receiver']).delete()
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.consumers import GroupChatConsumer
+from chat.wire import encode_frames
+
+
+class Command(BaseCommand):
+    help = "Time delivering one group message to N member sockets, encoding per socket vs once per send"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 5000])
+        parser.add_argument('--messages', type=int, default=50)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"{'members':>8}{'per-socket ms':>16}{'encode-once ms':>16}{'speedup':>9}")
+        for size in options['sizes']:
+            members = [self._member() for _ in range(size)]
+            per_socket = asyncio.run(self._deliver(members, options['messages'], pre_encode=False))
+            once = asyncio.run(self._deliver(members, options['messages'], pre_encode=True))
+            self.stdout.write(f"{size:>8}{per_socket:>16.3f}{once:>16.3f}{per_socket / once:>8.1f}x")
+
+    def _member(self):
+        consumer = GroupChatConsumer()
+
+        async def send(text_data=None, bytes_data=None):
+            pass
+
+        consumer.send = send
+        return consumer
+
+    def _event(self, i):
+        content = f"Message {i}: are we still on for the release review at four?"
+        return {
+            "type": "group_message",
+            "message_id": 123456789012345 + i,
+            "client_msg_id": "0f8fad5b-d9cb-469f-a165-70867728950e",
+            "message": content,
+            "content": content,
+            "sender": "alice",
+            "sender_id": 1,
+            "group_id": 7,
+            "group_slug": "release-team",
+            "timestamp": timezone.now().isoformat(),
+        }
+
+    async def _deliver(self, members, messages, pre_encode):
+        """Average ms per message, including the sender's encoding when pre_encode is set"""
+        start = time.perf_counter()
+        for i in range(messages):
+            event = self._event(i)
+            if pre_encode:
+                payload = members[0].group_message_payload(event)
+                event["frames"] = encode_frames(payload)
+                event["stream_frames"] = encode_frames(dict(payload, conversation="group:7"))
+            for member in members:
+                await member.group_message(event)
+        return (time.perf_counter() - start) / messages * 1000
@@ -0,0 +1,67 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from chat.membership import ADDED, add_group_members
+from chat.models import Group, GroupMember
+
+User = get_user_model()
+
+PREFIX = 'bench_members'
+
+
+class Command(BaseCommand):
+    help = (
+        "Time adding N members to a group: one exists() query per id (the old add_members) "
+        "vs add_group_members' chunked validation and conflict-skipping insert"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        count = options['members']
+        try:
+            owner = User.objects.create(username=f'{PREFIX}_owner', password='!')
+            users = User.objects.bulk_create([
+                User(username=f'{PREFIX}_{i}', password='!') for i in range(count)
+            ], batch_size=1000)
+            ids = [str(user.id) for user in users]  # as the add-member dialog posts them
+
+            self.stdout.write(f"{'strategy':<24}{'members':>9}{'ms':>10}{'queries':>9}")
+            self._report('per-id exists()', count, lambda group: self._legacy(group, ids), owner, 1)
+            self._report('add_group_members', count, lambda group: add_group_members(group.id, ids), owner, 2)
+
+            group = Group.objects.get(slug=f'{PREFIX}-2')
+            # Re-adding the same ids plus one unknown: nothing is inserted and nothing fails
+            start = time.perf_counter()
+            results = add_group_members(group.id, ids + ['0'])
+            self.stdout.write(
+                f"re-add: {sum(1 for status in results.values() if status == ADDED)} added, "
+                f"{len(results) - 1} already members in {(time.perf_counter() - start) * 1000:.1f}ms"
+            )
+        finally:
+            User.objects.filter(username__startswith=f'{PREFIX}_').delete()
+
+    def _legacy(self, group, ids):
+        GroupMember.objects.bulk_create([
+            GroupMember(group=group, user_id=user_id)
+            for user_id in ids
+            if User.objects.filter(id=user_id).exists()
+        ])
+
+    def _report(self, name, count, add, owner, n):
+        group = Group.objects.create(name=f'{PREFIX} {n}', slug=f'{PREFIX}-{n}', created_by=owner)
+        queries = []
+
+        def count_query(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_query), transaction.atomic():
+            add(group)
+        elapsed = (time.perf_counter() - start) * 1000
+        self.stdout.write(f"{name:<24}{count:>9}{elapsed:>10.1f}{len(queries):>9}")
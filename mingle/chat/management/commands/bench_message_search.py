@@ -0,0 +1,79 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from chat.models import Message
+from chat.search import search_messages
+
+User = get_user_model()
+
+WORDS = (
+    "meeting lunch deploy release invoice weekend coffee standup review budget "
+    "flight hotel birthday party deadline report design bug ticket server "
+    "database launch holiday dinner project client contract migration sprint demo"
+).split()
+# Real text has a long tail of rare words; these keep queries selective
+RARE_WORDS = [f"{word}{i}" for i in range(2000) for word in ('ref', 'tag')]
+
+
+class Command(BaseCommand):
+    help = "Seed synthetic direct messages and compare indexed search against a LIKE scan"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000)
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--batch-size', type=int, default=10000)
+        parser.add_argument('--queries', type=int, default=20)
+        parser.add_argument('--keep', action='store_true', help="Leave the seeded rows in place")
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        users = [
+            User.objects.get_or_create(username=f'bench_search_{i}')[0]
+            for i in range(options['users'])
+        ]
+        try:
+            self._seed(users, rng, options)
+            terms = [rng.choice(RARE_WORDS) for _ in range(options['queries'])]
+
+            indexed = self._time(lambda user, term: search_messages(user, term, 50), users, terms, rng)
+            scan = self._time(lambda user, term: list(Message.objects.filter(
+                models.Q(sender=user) | models.Q(receiver=user), content__icontains=term
+            ).order_by('-timestamp').values('id')[:50]), users, terms, rng)
+
+            self._report('fts', indexed)
+            self._report('like scan', scan)
+            self.stdout.write(f"speedup: {scan / indexed:.1f}x")
+        finally:
+            if not options['keep']:
+                User.objects.filter(username__startswith='bench_search_').delete()
+
+    def _seed(self, users, rng, options):
+        start = time.perf_counter()
+        remaining = options['messages']
+        while remaining:
+            count = min(options['batch_size'], remaining)
+            batch = []
+            for _ in range(count):
+                sender, receiver = rng.sample(users, 2)
+                words = [rng.choice(WORDS) for _ in range(rng.randint(3, 15))]
+                words.insert(rng.randrange(len(words)), rng.choice(RARE_WORDS))
+                content = ' '.join(words)
+                batch.append(Message(sender=sender, receiver=receiver, content=content))
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            remaining -= count
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"seeded {options['messages']} messages in {elapsed:.1f}s")
+
+    def _time(self, run, users, terms, rng):
+        start = time.perf_counter()
+        for term in terms:
+            run(rng.choice(users), term)
+        return (time.perf_counter() - start) / len(terms)
+
+    def _report(self, label, per_query):
+        self.stdout.write(f"{label:>10}: {per_query * 1000:.1f} ms/query")
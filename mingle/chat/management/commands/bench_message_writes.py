@@ -0,0 +1,62 @@
+import asyncio
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from chat.consumers import ChatConsumer
+from chat.models import Message
+from chat.persistence import WriteBehindQueue, write_messages
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = "Compare message insert throughput of the direct and write-behind persistence paths"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help="Number of simulated sockets sending at once")
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--flush-ms', type=int, default=5)
+
+    def handle(self, *args, **options):
+        sender, _ = User.objects.get_or_create(username='bench_sender')
+        receiver, _ = User.objects.get_or_create(username='bench_receiver')
+
+        try:
+            consumer = ChatConsumer()
+            direct = asyncio.run(self._run(
+                lambda i: consumer.save_message(sender=sender, receiver=receiver, content=f"direct {i}"),
+                options
+            ))
+            self._report('direct', options['messages'], direct)
+
+            queue = WriteBehindQueue(
+                write_messages,
+                batch_size=options['batch_size'],
+                flush_interval=options['flush_ms'],
+            )
+            batched = asyncio.run(self._run(
+                lambda i: queue.submit(Message(sender=sender, receiver=receiver, content=f"batched {i}")),
+                options
+            ))
+            self._report('write-behind', options['messages'], batched)
+            self.stdout.write(f"speedup: {direct / batched:.2f}x")
+        finally:
+            User.objects.filter(username__in=['bench_sender', 'bench_receiver']).delete()
+
+    async def _run(self, send, options):
+        counter = iter(range(options['messages']))
+
+        async def sender_loop():
+            for i in counter:
+                await send(i)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender_loop() for _ in range(options['concurrency'])))
+        return time.perf_counter() - start
+
+    def _report(self, label, count, elapsed):
+        self.stdout.write(f"{label:>12}: {count} msgs in {elapsed:.2f}s ({count / elapsed:.0f} msgs/sec)")
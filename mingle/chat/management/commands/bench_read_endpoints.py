@@ -0,0 +1,233 @@
+import json
+import random
+import statistics
+import time
+import tracemalloc
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, models, transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from chat.membership import invalidate_group
+from chat.message_cache import reset_message_cache
+from chat.models import Conversation, Group, GroupMember, GroupMessage, Message, Profile, member_count_subquery
+from chat.user_index import user_index
+
+User = get_user_model()
+
+PREFIX = 'bench_read'
+WORDS = (
+    "meeting lunch deploy release invoice weekend coffee standup review budget "
+    "flight hotel birthday party deadline report design bug ticket server"
+).split()
+
+
+def skewed(rng, mean, cap):
+    """Pareto-distributed count with roughly the given mean, at least 1"""
+    alpha = 1.5  # mean of paretovariate(alpha) is alpha / (alpha - 1) = 3
+    return max(1, min(cap, int(rng.paretovariate(alpha) * mean / 3)))
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic, seedable dataset and benchmark the inbox read endpoints "
+        "through the test client: wall time, query count and peak memory per call"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--partners', type=int, default=8, help="Mean DM partners per user (skewed)")
+        parser.add_argument('--pair-messages', type=int, default=30, help="Mean messages per DM pair (skewed)")
+        parser.add_argument('--groups', type=int, default=100)
+        parser.add_argument('--group-size', type=int, default=15, help="Mean group size (skewed)")
+        parser.add_argument('--group-messages', type=int, default=100, help="Mean messages per group (skewed)")
+        parser.add_argument('--repeat', type=int, default=20, help="Timed calls per endpoint")
+        parser.add_argument('--json', action='store_true', help="Print the results as JSON")
+        parser.add_argument('--keep', action='store_true', help="Leave the seeded rows in place")
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        try:
+            start = time.perf_counter()
+            counts = self._seed(rng, options)
+            if not options['json']:
+                self.stdout.write(
+                    f"seeded {counts['users']} users, {counts['messages']} DMs in {counts['pairs']} pairs, "
+                    f"{counts['group_messages']} messages in {counts['groups']} groups "
+                    f"in {time.perf_counter() - start:.1f}s"
+                )
+            results = self._bench(options['repeat'])
+        finally:
+            if not options['keep']:
+                User.objects.filter(username__startswith=f'{PREFIX}_').delete()
+            reset_message_cache()
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2, sort_keys=True))
+            return
+        self.stdout.write(
+            f"{'endpoint':<28}{'p50 ms':>9}{'p95 ms':>9}{'queries':>9}{'peak KiB':>10}{'body KiB':>10}"
+        )
+        for name, result in results.items():
+            self.stdout.write(
+                f"{name:<28}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['queries']:>9}"
+                f"{result['peak_kib']:>10.1f}{result['body_kib']:>10.1f}"
+            )
+
+    def _seed(self, rng, options):
+        now = timezone.now()
+
+        def timestamp():
+            return now - timedelta(seconds=rng.randrange(30 * 24 * 3600))
+
+        # bulk_create skips the profile and username index signals, so do their work here
+        users = User.objects.bulk_create([
+            User(username=f'{PREFIX}_{i}', password='!') for i in range(options['users'])
+        ])
+        Profile.objects.bulk_create([Profile(user=user) for user in users])
+        if user_index.warmed:
+            for user in users:
+                user_index.add(user.id, user.username)
+
+        pairs = set()
+        for user in users:
+            for _ in range(skewed(rng, options['partners'], len(users) - 1)):
+                peer = rng.choice(users)
+                if peer is not user:
+                    pairs.add(Conversation.pair(user.id, peer.id))
+
+        message_count = 0
+        conversations = []
+        for low, high in sorted(pairs):
+            count = skewed(rng, options['pair_messages'], 50 * options['pair_messages'])
+            stamps = sorted(timestamp() for _ in range(count))
+            unread_from = count - rng.randrange(min(count, 5) + 1)  # the newest few are unread
+            batch = []
+            for i, stamp in enumerate(stamps):
+                sender, receiver = (low, high) if rng.random() < 0.5 else (high, low)
+                batch.append(Message(
+                    sender_id=sender, receiver_id=receiver, timestamp=stamp, read=i < unread_from,
+                    content=' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+                ))
+            with transaction.atomic():
+                Message.objects.bulk_create(batch)
+            message_count += count
+            last = batch[-1]
+            unread = batch[unread_from:]
+            conversations.append(Conversation(
+                user_low_id=low, user_high_id=high, last_message=last,
+                last_message_preview=last.content[:100], last_activity=last.timestamp,
+                low_unread=sum(1 for message in unread if message.receiver_id == low),
+                high_unread=sum(1 for message in unread if message.receiver_id == high),
+            ))
+        Conversation.objects.bulk_create(conversations, batch_size=1000)
+
+        group_message_count = 0
+        for g in range(options['groups']):
+            members = rng.sample(users, min(len(users), 1 + skewed(rng, options['group_size'], len(users))))
+            group = Group.objects.create(name=f'{PREFIX} {g}', slug=f'{PREFIX}-{g}', created_by=members[0])
+            GroupMember.objects.bulk_create([
+                GroupMember(group=group, user=user, is_admin=i == 0) for i, user in enumerate(members)
+            ])
+            count = skewed(rng, options['group_messages'], 50 * options['group_messages'])
+            batch = [
+                GroupMessage(
+                    group=group, sender=rng.choice(members), timestamp=timestamp(),
+                    content=' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 12)))
+                ) for _ in range(count)
+            ]
+            with transaction.atomic():
+                GroupMessage.objects.bulk_create(batch)
+            last = max(batch, key=lambda message: (message.timestamp, message.id))
+            Group.objects.filter(pk=group.pk).update(
+                member_count=member_count_subquery(),
+                last_message=last,
+                last_message_preview=last.content[:100],
+                last_message_sender=last.sender.username,
+                last_message_time=last.timestamp
+            )
+            invalidate_group(group.id)
+            group_message_count += count
+
+        return {
+            'users': len(users), 'pairs': len(pairs), 'messages': message_count,
+            'groups': options['groups'], 'group_messages': group_message_count,
+        }
+
+    def _bench(self, repeat):
+        # The busiest inbox exercises the endpoints hardest
+        user_id = max(
+            User.objects.filter(username__startswith=f'{PREFIX}_').values_list('id', flat=True),
+            key=lambda candidate: Conversation.objects.filter(
+                models.Q(user_low_id=candidate) | models.Q(user_high_id=candidate)
+            ).count()
+        )
+        user = User.objects.get(id=user_id)
+        peer = Conversation.for_user(user).first().other_user(user)
+        group = Group.objects.filter(members__user=user).order_by('-member_count').first() \
+            or Group.objects.filter(slug__startswith=f'{PREFIX}-').order_by('-member_count').first()
+        GroupMember.objects.get_or_create(group=group, user=user)
+        invalidate_group(group.id)
+
+        client = Client()
+        client.force_login(user)
+
+        def next_page(url):
+            return f"{url}?cursor={client.get(url).json()['next_cursor']}"
+
+        messages_url = reverse('chat:get_messages', args=[peer.id])
+        group_messages_url = reverse('chat:get_group_messages', args=[group.slug])
+        endpoints = {
+            'get_users': reverse('chat:get_users'),
+            'get_groups': reverse('chat:get_groups'),
+            'get_messages': messages_url,
+            'get_messages (page 2)': next_page(messages_url),
+            'get_group_messages': group_messages_url,
+            'get_group_messages (page 2)': next_page(group_messages_url),
+            'search_users': f"{reverse('chat:search_users')}?query={PREFIX}_1",
+            'get_non_members': reverse('chat:get_non_members', args=[group.slug]),
+        }
+
+        results = {}
+        for name, url in endpoints.items():
+            response = client.get(url)  # warm up caches, as in steady state
+            if response.status_code != 200:
+                raise RuntimeError(f"{name} returned {response.status_code}: {response.content[:200]}")
+
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+
+            # Counted and traced on separate calls so neither skews the timings.
+            # (CaptureQueriesContext can't see through request_started resetting the log.)
+            queries = []
+
+            def count_query(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            with connection.execute_wrapper(count_query):
+                client.get(url)
+            tracemalloc.start()
+            try:
+                client.get(url)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+            timings.sort()
+            results[name] = {
+                'p50_ms': round(statistics.median(timings), 3),
+                'p95_ms': round(timings[max(0, int(len(timings) * 0.95 + 0.5) - 1)], 3),
+                'queries': len(queries),
+                'peak_kib': round(peak / 1024, 1),
+                'body_kib': round(len(response.content) / 1024, 1),
+            }
+        return results
@@ -0,0 +1,66 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.consumers import StreamConsumer
+from chat.wire import JSON_CODEC, MSGPACK_CODEC
+
+
+class Command(BaseCommand):
+    help = "Compare frame size and encode/decode time of the JSON and msgpack wire protocols"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def handle(self, *args, **options):
+        now = timezone.now().isoformat()
+        content = "Are we still on for the release review at four? I'll bring the notes."
+        consumer = StreamConsumer()
+        events = {
+            'chat_message': dict(consumer.chat_message_payload({
+                'message_id': 123456789012345, 'client_msg_id': '0f8fad5b-d9cb-469f-a165-70867728950e',
+                'message': content, 'sender': 'alice', 'sender_id': 1, 'receiver_id': 2,
+                'timestamp': now, 'read': False,
+            }), conversation='dm:2'),
+            'group_message': dict(consumer.group_message_payload({
+                'message_id': 123456789012346, 'client_msg_id': '7c9e6679-7425-40de-944b-e07fc1f90ae7',
+                'message': content, 'sender': 'alice', 'sender_id': 1, 'group_slug': 'release-team',
+                'timestamp': now,
+            }), conversation='group:7'),
+            'message_status': dict(consumer.message_status_payload({
+                'status': 'ack', 'message_id': 123456789012345,
+                'client_msg_id': '0f8fad5b-d9cb-469f-a165-70867728950e', 'sender_id': 1,
+            }), conversation='dm:2'),
+            'read_upto': dict(consumer.read_upto_payload({
+                'reader_id': 2, 'upto': 123456789012345, 'read_at': now,
+            }), conversation='dm:2'),
+        }
+
+        iterations = options['iterations']
+        self.stdout.write(f"{'event':<16}{'json B':>8}{'msgpack B':>11}{'saved':>8}"
+                          f"{'json enc/dec us':>18}{'msgpack enc/dec us':>21}")
+        for name, payload in events.items():
+            json_frame = JSON_CODEC.encode(payload)['text_data'].encode()
+            msgpack_frame = MSGPACK_CODEC.encode(payload)['bytes_data']
+            json_times = self._time(JSON_CODEC, payload, iterations, 'text_data')
+            msgpack_times = self._time(MSGPACK_CODEC, payload, iterations, 'bytes_data')
+            self.stdout.write(
+                f"{name:<16}{len(json_frame):>8}{len(msgpack_frame):>11}"
+                f"{1 - len(msgpack_frame) / len(json_frame):>8.0%}"
+                f"{json_times[0]:>10.2f}/{json_times[1]:<7.2f}"
+                f"{msgpack_times[0]:>13.2f}/{msgpack_times[1]:<7.2f}"
+            )
+
+    def _time(self, codec, payload, iterations, field):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            frame = codec.encode(payload)
+        encoded = time.perf_counter() - start
+
+        data = frame[field]
+        start = time.perf_counter()
+        for _ in range(iterations):
+            codec.decode(**{field: data})
+        decoded = time.perf_counter() - start
+        return encoded / iterations * 1e6, decoded / iterations * 1e6
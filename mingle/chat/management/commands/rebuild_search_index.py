@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from chat.search import install_postgres_search, install_sqlite_fts
+
+
+class Command(BaseCommand):
+    help = (
+        "Recreate the message search index: SQLite's FTS5 tables and sync triggers, "
+        "rebuilt from scratch, or PostgreSQL's generated search_vector columns and GIN indexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        connection = connections[options['database']]
+        if connection.vendor == 'sqlite':
+            install_sqlite_fts(connection)
+        elif connection.vendor == 'postgresql':
+            install_postgres_search(connection)
+        else:
+            raise CommandError(f"No message search index for {connection.vendor} databases")
+        self.stdout.write(self.style.SUCCESS("Message search index rebuilt"))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from chat.deletion import run_job
+from chat.models import DeletionJob
+
+
+class Command(BaseCommand):
+    help = "Run deletion jobs left pending, running or failed, e.g. by a worker restart"
+
+    def handle(self, *args, **options):
+        job_ids = list(
+            DeletionJob.objects.exclude(status=DeletionJob.DONE).order_by('id').values_list('id', flat=True)
+        )
+        for job_id in job_ids:
+            job = run_job(job_id)
+            self.stdout.write(f"Job {job.id} ({job.kind} {job.target_id}): {job.status}, {job.deleted_rows} rows deleted")
+
+        self.stdout.write(self.style.SUCCESS(f"Ran {len(job_ids)} deletion jobs"))
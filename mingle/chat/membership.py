@@ -0,0 +1,299 @@
+"""
+Group metadata and membership cache.
+
+Each group is cached as one entry holding its metadata and a
+``{user_id: is_admin}`` member map, plus a ``slug -> group_id`` entry.
+Entries are versioned. Changing a group or its members bumps the group's
+generation, so readers simply stop seeing the old entry and a concurrent
+reload can't resurrect it. Generations are bumped immediately and again
+on commit, so a reader that loaded inside the window before the commit
+also misses.
+
+post_save/post_delete on Group and GroupMember invalidate
+automatically. Bulk writes, which send no signals, must call
+``invalidate_group`` themselves.
+
+Groups awaiting deletion (``pending_delete``) are treated as missing.
+
+Uses the ``CHAT_MEMBERSHIP_CACHE`` alias of Django's CACHES. With more
+than one worker process (``CHAT_WORKER_PROCESSES``) it has to be shared:
+a per-process cache would keep authorizing a removed member on the other
+workers until its entry expired. ``check_shared_cache`` refuses to start
+in that setup.
+
+Connected sockets learn about membership changes through control events
+sent over the channel layer once the change commits:
+
+* ``membership_revoked`` and ``group_deleted`` go to the group room; the
+  affected sockets leave the room and group sockets are closed.
+* ``group_renamed`` goes to the group room. Rooms are keyed by group id,
+  so sockets stay where they are and only update the slug they report.
+* ``membership_granted`` lists the new members and goes to their
+  ``user_{id}`` rooms so their stream sockets join the group room. It is
+  one message for the whole batch, sent with the layer's
+  ``group_send_many``.
+* ``account_deleted`` goes to the deleted user's own room and the rooms
+  of their DMs. chat.deletion sends it, like ``group_deleted``, when the
+  deletion is requested and again once the purge is done.
+
+``add_group_members`` is the one way to add members in bulk: it checks
+all requested ids with a few ``id__in`` queries, inserts in chunks
+skipping rows that already exist, and reports what happened to each id.
+"""
+import asyncio
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.http import Http404
+
+from .models import Group, GroupMember
+from .rooms import dm_room_name, group_room_name, user_room_name
+
+GROUP_FIELDS = ('id', 'name', 'slug', 'description', 'created_by_id', 'avatar')
+
+
+def _cache():
+    return caches[settings.CHAT_MEMBERSHIP_CACHE]
+
+
+def check_shared_cache():
+    """Raise unless every worker sees the same membership cache"""
+    if settings.CHAT_WORKER_PROCESSES > 1 and isinstance(_cache(), LocMemCache):
+        raise ImproperlyConfigured(
+            f"CHAT_MEMBERSHIP_CACHE ('{settings.CHAT_MEMBERSHIP_CACHE}') is per process but "
+            f"{settings.CHAT_WORKER_PROCESSES} workers run; use a shared backend such as RedisCache"
+        )
+
+
+def _generation_key(group_id):
+    return f'membership:gen:{group_id}'
+
+
+def _slug_key(slug):
+    return f'membership:slug:{slug}'
+
+
+def _generation(group_id):
+    return _cache().get(_generation_key(group_id), 0)
+
+
+def _bump(group_id):
+    cache = _cache()
+    cache.add(_generation_key(group_id), 0, timeout=None)
+    try:
+        cache.incr(_generation_key(group_id))
+    except ValueError:
+        cache.set(_generation_key(group_id), 1, timeout=None)
+
+
+def invalidate_group(group_id, slug=None):
+    _bump(group_id)
+    if slug:
+        _cache().delete(_slug_key(slug))
+    transaction.on_commit(lambda: _bump(group_id))
+
+
+def _send_on_commit(room, event):
+    def send():
+        try:
+            async_to_sync(get_channel_layer().group_send)(room, event)
+        except Exception as e:
+            print(f"Error sending {event['type']} to {room}: {str(e)}")
+    transaction.on_commit(send)
+
+
+def membership_revoked(group_id, user_ids):
+    _send_on_commit(group_room_name(group_id), {
+        "type": "membership_revoked",
+        "group_id": group_id,
+        "user_ids": list(user_ids)
+    })
+
+
+def _send_many_on_commit(rooms, event):
+    async def send_all(layer):
+        if hasattr(layer, 'group_send_many'):
+            await layer.group_send_many(rooms, event)
+            return
+        # Other layers (InMemoryChannelLayer in tests) send room by room
+        results = await asyncio.gather(*(layer.group_send(room, event) for room in rooms), return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            print(f"Error sending {event['type']} to {len(errors)}/{len(rooms)} rooms: {str(errors[0])}")
+
+    def send():
+        try:
+            async_to_sync(send_all)(get_channel_layer())
+        except Exception as e:
+            print(f"Error sending {event['type']}: {str(e)}")
+    if rooms:
+        transaction.on_commit(send)
+
+
+def membership_granted(group_id, user_ids):
+    user_ids = sorted(set(user_ids))
+    _send_many_on_commit(
+        [user_room_name(user_id) for user_id in user_ids],
+        {"type": "membership_granted", "group_id": group_id, "user_ids": user_ids}
+    )
+
+
+def account_deleted(user_id, peer_ids):
+    _send_many_on_commit(
+        [user_room_name(user_id)] + [dm_room_name(user_id, peer_id) for peer_id in set(peer_ids)],
+        {"type": "account_deleted", "user_id": user_id}
+    )
+
+
+def group_renamed(group_id, slug, name):
+    _send_on_commit(group_room_name(group_id), {
+        "type": "group_renamed",
+        "group_id": group_id,
+        "group_slug": slug,
+        "name": name
+    })
+
+
+def group_deleted(group_id):
+    _send_on_commit(group_room_name(group_id), {"type": "group_deleted", "group_id": group_id})
+
+
+MEMBER_CHUNK_SIZE = 500
+
+ADDED = 'added'
+ALREADY_MEMBER = 'already_member'
+UNKNOWN = 'unknown'
+
+
+def _chunks(items, size=MEMBER_CHUNK_SIZE):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def add_group_members(group_id, user_ids, admin_ids=()):
+    """
+    Add ``user_ids`` to the group and return ``{id: ADDED | ALREADY_MEMBER
+    | UNKNOWN}`` in request order. Ids that aren't integers or don't name
+    a user are UNKNOWN and keyed by their string form. Users in
+    ``admin_ids`` are added as admins. Refreshes the member count,
+    invalidates the cache and tells the new members' sockets.
+    """
+    results = {}
+    requested = []
+    for raw in user_ids:
+        try:
+            if isinstance(raw, bool):
+                raise ValueError(raw)
+            user_id = int(raw)
+        except (TypeError, ValueError):
+            results[str(raw)] = UNKNOWN
+            continue
+        if user_id not in results:
+            results[user_id] = None
+            requested.append(user_id)
+
+    with transaction.atomic():
+        known = set()
+        members = set()
+        for chunk in _chunks(requested):
+            known.update(User.objects.filter(id__in=chunk, is_active=True).values_list('id', flat=True))
+            members.update(
+                GroupMember.objects.filter(group_id=group_id, user_id__in=chunk).values_list('user_id', flat=True)
+            )
+        added = [user_id for user_id in requested if user_id in known and user_id not in members]
+        admin_ids = {int(user_id) for user_id in admin_ids}
+        for chunk in _chunks(added):
+            # A concurrent add of the same user is skipped, not an error
+            GroupMember.objects.bulk_create([
+                GroupMember(group_id=group_id, user_id=user_id, is_admin=user_id in admin_ids)
+                for user_id in chunk
+            ], ignore_conflicts=True)
+
+        if added:
+            invalidate_group(group_id)  # bulk_create sends no signals
+            Group(pk=group_id).refresh_member_count()
+            membership_granted(group_id, added)
+
+    for user_id in requested:
+        results[user_id] = ALREADY_MEMBER if user_id in members else ADDED if user_id in known else UNKNOWN
+    return results
+
+
+class GroupAccess:
+    """Cached metadata of a group plus one user's role in it"""
+
+    def __init__(self, group, members, user_id):
+        self.group = group
+        self.id = group['id']
+        self.slug = group['slug']
+        self.name = group['name']
+        self.description = group['description']
+        self.members = members
+        self.is_member = user_id in members
+        self.is_admin = members.get(user_id, False)
+
+    def instance(self):
+        """A Group built from the cached fields, for FKs and pk-only methods"""
+        return Group.from_db('default', GROUP_FIELDS, [self.group[field] for field in GROUP_FIELDS])
+
+
+def load_group(group_id):
+    cache = _cache()
+    key = f'membership:group:{group_id}:{_generation(group_id)}'
+    entry = cache.get(key)
+    if entry is None:
+        group = Group.objects.filter(id=group_id, pending_delete=False).values(*GROUP_FIELDS).first()
+        if group is None:
+            return None
+        members = dict(GroupMember.objects.filter(group_id=group_id).values_list('user_id', 'is_admin'))
+        entry = {'group': group, 'members': members}
+        cache.set(key, entry, settings.CHAT_MEMBERSHIP_CACHE_TTL)
+    return entry
+
+
+def group_id_for_slug(slug, refresh=False):
+    cache = _cache()
+    group_id = None if refresh else cache.get(_slug_key(slug))
+    if group_id is None:
+        group_id = Group.objects.filter(slug=slug, pending_delete=False).values_list('id', flat=True).first()
+        if group_id is None:
+            return None
+        cache.set(_slug_key(slug), group_id, settings.CHAT_MEMBERSHIP_CACHE_TTL)
+    return group_id
+
+
+def group_access_by_id(group_id, user):
+    """Like group_access, for callers that hold the group id"""
+    entry = load_group(group_id)
+    if entry is None:
+        return None
+    return GroupAccess(entry['group'], entry['members'], user.id)
+
+
+def group_access(slug, user):
+    """
+    The group with ``slug`` and ``user``'s role in it, or None if no such
+    group exists. Only touches the DB on a cache miss.
+    """
+    for refresh in (False, True):
+        group_id = group_id_for_slug(slug, refresh=refresh)
+        if group_id is None:
+            return None
+        entry = load_group(group_id)
+        # A stale slug entry can point at a renamed or deleted group
+        if entry is not None and entry['group']['slug'] == slug:
+            return GroupAccess(entry['group'], entry['members'], user.id)
+    return None
+
+
+def group_access_or_404(slug, user):
+    access = group_access(slug, user)
+    if access is None:
+        raise Http404("No Group matches the given query.")
+    return access
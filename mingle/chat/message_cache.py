@@ -0,0 +1,275 @@
+"""
+Hot conversation cache.
+
+Holds the newest ``CHAT_MESSAGE_CACHE_SIZE`` serialized messages of
+recently opened conversations, keyed by room name (``chat_{a}_{b}``,
+``group_{id}``), so a first-page load doesn't go to the DB.
+
+* The first-page view fills a conversation from the DB on a miss.
+* The consumers write through every persisted message, but only into
+  conversations that are already cached. A partial history is never
+  cached.
+* Every key carries a version that appends and invalidations bump. A fill
+  that raced with either is dropped rather than storing a page that is
+  missing the newest message. The in-memory cache only tracks versions of
+  keys that are cached or have a fill in flight, so writes to uncached
+  conversations leave nothing behind.
+* A fill can load a message that was committed but not yet written
+  through, so appends skip messages whose id is already cached.
+
+``CHAT_MESSAGE_CACHE_BACKEND`` selects ``'memory'`` (per process, LRU
+bounded by ``CHAT_MESSAGE_CACHE_CONVERSATIONS``) or ``'redis'`` (shared,
+bounded by ``CHAT_MESSAGE_CACHE_TTL`` and Redis' own eviction).
+"""
+import json
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from django.conf import settings
+
+from .pagination import encode_cursor
+from .rooms import dm_room_name, group_room_name
+
+
+class InMemoryMessageCache:
+    def __init__(self, size, max_conversations):
+        self.size = size
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> messages, newest first
+        self._versions = {}  # only for keys in _entries or _filling
+        self._filling = {}  # key -> fills started by version() and not yet finished
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            messages = self._entries.get(key)
+            if messages is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return list(messages)
+
+    def version(self, key):
+        """Start a fill of ``key``; pass the result to fill(), or call abandon()"""
+        with self._lock:
+            self._filling[key] = self._filling.get(key, 0) + 1
+            return self._versions.setdefault(key, 0)
+
+    def fill(self, key, messages, version):
+        with self._lock:
+            self._end_fill(key)
+            if self._versions.get(key, 0) != version:
+                self._forget(key)
+                return
+            self._entries[key] = list(messages[:self.size])
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_conversations:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget(evicted)
+
+    def abandon(self, key):
+        """A fill started by version() that won't happen"""
+        with self._lock:
+            self._end_fill(key)
+            self._forget(key)
+
+    def append(self, key, message):
+        with self._lock:
+            self._bump(key)
+            messages = self._entries.get(key)
+            if messages is not None and not any(cached['id'] == message['id'] for cached in messages):
+                messages.insert(0, message)
+                del messages[self.size:]
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._bump(key)
+                self._entries.pop(key, None)
+                self._forget(key)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'conversations': len(self._entries)}
+
+    def _bump(self, key):
+        # Nothing to protect for a key that is neither cached nor being filled
+        if key in self._versions:
+            self._versions[key] += 1
+
+    def _end_fill(self, key):
+        count = self._filling.pop(key, 0) - 1
+        if count > 0:
+            self._filling[key] = count
+
+    def _forget(self, key):
+        if key not in self._entries and key not in self._filling:
+            self._versions.pop(key, None)
+
+
+class RedisMessageCache:
+    """
+    One list per conversation (``messages:<room>``, newest first) holding
+    JSON messages, a ``messages:<room>:v`` version counter and global
+    ``messages:hits`` / ``messages:misses`` counters.
+    """
+
+    HITS_KEY = 'messages:hits'
+    MISSES_KEY = 'messages:misses'
+
+    # Bump the version, then push onto the list only if it is cached and
+    # doesn't hold the message yet (a fill may have loaded it already)
+    APPEND_LUA = """
+        redis.call('INCR', KEYS[2])
+        redis.call('EXPIRE', KEYS[2], ARGV[3])
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            return 0
+        end
+        local id = tonumber(ARGV[2])
+        for _, cached in ipairs(redis.call('LRANGE', KEYS[1], 0, -1)) do
+            if cjson.decode(cached)['id'] == id then
+                return 0
+            end
+        end
+        redis.call('LPUSH', KEYS[1], ARGV[1])
+        redis.call('LTRIM', KEYS[1], 0, tonumber(ARGV[4]) - 1)
+        return 1
+    """
+
+    def __init__(self, size, ttl, url):
+        import redis
+
+        self.size = size
+        self.ttl = ttl
+        self.redis = redis.Redis.from_url(url)
+        self._append = self.redis.register_script(self.APPEND_LUA)
+
+    def _key(self, key):
+        return f'messages:{key}'
+
+    def _version_key(self, key):
+        return f'messages:{key}:v'
+
+    def get(self, key):
+        messages = self.redis.lrange(self._key(key), 0, -1)
+        self.redis.incr(self.HITS_KEY if messages else self.MISSES_KEY)
+        if not messages:
+            return None
+        return [json.loads(message) for message in messages]
+
+    def version(self, key):
+        return int(self.redis.get(self._version_key(key)) or 0)
+
+    def fill(self, key, messages, version):
+        import redis
+
+        if not messages:
+            return
+        with self.redis.pipeline() as pipe:
+            try:
+                pipe.watch(self._version_key(key))
+                if int(pipe.get(self._version_key(key)) or 0) != version:
+                    return
+                pipe.multi()
+                pipe.delete(self._key(key))
+                pipe.rpush(self._key(key), *[json.dumps(m) for m in messages[:self.size]])
+                pipe.expire(self._key(key), self.ttl)
+                pipe.execute()
+            except redis.WatchError:
+                pass
+
+    def append(self, key, message):
+        self._append(
+            keys=[self._key(key), self._version_key(key)],
+            args=[json.dumps(message), message['id'], self.ttl, self.size]
+        )
+
+    def abandon(self, key):
+        pass  # version keys expire on their own
+
+    def invalidate(self, *keys):
+        if not keys:
+            return
+        pipe = self.redis.pipeline()
+        for key in keys:
+            pipe.incr(self._version_key(key))
+            pipe.expire(self._version_key(key), self.ttl)
+            pipe.delete(self._key(key))
+        pipe.execute()
+
+    def stats(self):
+        hits, misses = self.redis.mget(self.HITS_KEY, self.MISSES_KEY)
+        return {'hits': int(hits or 0), 'misses': int(misses or 0)}
+
+
+_cache = None
+
+
+def get_message_cache():
+    global _cache
+    if _cache is None:
+        size = settings.CHAT_MESSAGE_CACHE_SIZE
+        if settings.CHAT_MESSAGE_CACHE_BACKEND == 'redis':
+            _cache = RedisMessageCache(size, settings.CHAT_MESSAGE_CACHE_TTL, settings.CHAT_MESSAGE_CACHE_REDIS_URL)
+        else:
+            _cache = InMemoryMessageCache(size, settings.CHAT_MESSAGE_CACHE_CONVERSATIONS)
+    return _cache
+
+
+def reset_message_cache():
+    global _cache
+    _cache = None
+
+
+def first_page(key, limit, load):
+    """
+    Serve a newest-first page of ``limit`` serialized messages from the cache,
+    filling it with ``load(n)`` on a miss. Returns ``(messages, next_cursor)``,
+    or None when the request is larger than what the cache holds.
+    """
+    cache = get_message_cache()
+    if limit >= cache.size:
+        return None
+    messages = cache.get(key)
+    if messages is None:
+        version = cache.version(key)
+        try:
+            messages = load(cache.size)
+        except Exception:
+            cache.abandon(key)
+            raise
+        cache.fill(key, messages, version)
+
+    # Fewer than cache.size messages means this is the whole conversation
+    page = messages[:limit]
+    next_cursor = None
+    if len(messages) > limit:
+        edge = page[-1]
+        next_cursor = encode_cursor(datetime.fromisoformat(edge['timestamp']), edge['id'])
+    return page, next_cursor
+
+
+def cache_direct_message(message):
+    get_message_cache().append(dm_room_name(message['sender_id'], message['receiver_id']), message)
+
+
+def cache_group_message(message):
+    get_message_cache().append(group_room_name(message['group_id']), message)
+
+
+def invalidate_user(user):
+    """Drop every cached conversation holding messages from or to ``user``"""
+    from .models import Conversation, GroupMessage
+
+    keys = [
+        dm_room_name(low, high)
+        for low, high in Conversation.for_user(user).values_list('user_low_id', 'user_high_id')
+    ]
+    keys += [
+        group_room_name(group_id)
+        for group_id in GroupMessage.objects.filter(sender=user).values_list('group_id', flat=True).distinct()
+    ]
+    get_message_cache().invalidate(*keys)
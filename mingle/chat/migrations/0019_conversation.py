@@ -0,0 +1,34 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:13
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0018_message_sender_receiver_timestamp_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_preview', models.CharField(blank=True, max_length=100)),
+                ('last_activity', models.DateTimeField(default=django.utils.timezone.now)),
+                ('low_unread', models.PositiveIntegerField(default=0)),
+                ('high_unread', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_activity'], name='chat_conver_user_lo_d5527e_idx'), models.Index(fields=['user_high', '-last_activity'], name='chat_conver_user_hi_362425_idx')],
+                'unique_together': {('user_low', 'user_high')},
+            },
+        ),
+    ]
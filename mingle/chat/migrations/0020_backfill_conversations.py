@@ -0,0 +1,49 @@
+from django.db import migrations, models
+
+
+def backfill_conversations(apps, schema_editor):
+    Message = apps.get_model('chat', 'Message')
+    Conversation = apps.get_model('chat', 'Conversation')
+
+    # One aggregate per directed pair, folded into unordered pairs below
+    directed = Message.objects.values('sender_id', 'receiver_id').annotate(
+        last_id=models.Max('id'),
+        unread=models.Count('id', filter=models.Q(read=False)),
+    )
+
+    pairs = {}
+    for row in directed:
+        low = min(row['sender_id'], row['receiver_id'])
+        high = max(row['sender_id'], row['receiver_id'])
+        entry = pairs.setdefault((low, high), {'last_id': 0, 'low_unread': 0, 'high_unread': 0})
+        entry['last_id'] = max(entry['last_id'], row['last_id'])
+        if row['receiver_id'] == low:
+            entry['low_unread'] += row['unread']
+        else:
+            entry['high_unread'] += row['unread']
+
+    last_messages = Message.objects.in_bulk([entry['last_id'] for entry in pairs.values()])
+
+    Conversation.objects.bulk_create([
+        Conversation(
+            user_low_id=low,
+            user_high_id=high,
+            last_message_id=entry['last_id'],
+            last_message_preview=last_messages[entry['last_id']].content[:100],
+            last_activity=last_messages[entry['last_id']].timestamp,
+            low_unread=entry['low_unread'],
+            high_unread=entry['high_unread'],
+        )
+        for (low, high), entry in pairs.items()
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0019_conversation'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:17
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0021_group_last_message_member_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='groupmessage',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0022_message_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='last_seen',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
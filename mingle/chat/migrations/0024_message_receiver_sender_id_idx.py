@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-18 17:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0023_profile_last_seen_nullable'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_messag_receive_71134e_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['receiver', 'sender', 'id'], name='chat_messag_receive_0ff59f_idx'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from chat.search import install_sqlite_fts
+    install_sqlite_fts(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    from chat.search import uninstall_sqlite_fts
+    uninstall_sqlite_fts(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0024_message_receiver_sender_id_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.5 on 2026-10-18 18:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0026_message_unread_partial_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_256',
+            field=models.ImageField(blank=True, upload_to='profile_pics/thumbs/'),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='avatar_64',
+            field=models.ImageField(blank=True, upload_to='profile_pics/thumbs/'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+from django.db import migrations
+
+
+def install(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from chat.search import install_postgres_search
+    install_postgres_search(schema_editor.connection)
+
+
+def uninstall(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    from chat.search import uninstall_postgres_search
+    uninstall_postgres_search(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0028_deletion_jobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(install, uninstall),
+    ]
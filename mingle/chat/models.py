@@ -1,10 +1,11 @@
 from django.db import models, IntegrityError
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import User
 from django.utils import timezone
 from django.utils.text import slugify
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.db.models.signals import pre_save
+from django.db.models.signals import post_delete
 
 
 class Message(models.Model):
@@ -13,14 +14,19 @@ class Message(models.Model):
     content = models.TextField()
     read = models.BooleanField(default=False)
     read_at = models.DateTimeField(null=True, blank=True)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         indexes = [
-            models.Index(fields=['sender', 'receiver']),
-            models.Index(fields=['receiver', 'sender']),
+            models.Index(fields=['sender', 'receiver', 'timestamp']),
+            models.Index(fields=['receiver', 'sender', 'id']),
             models.Index(fields=['timestamp']),
-            models.Index(fields=['read']),
+            # Only unread rows are indexed; read ones are the vast majority
+            models.Index(
+                fields=['receiver', 'sender', 'id'],
+                condition=models.Q(read=False),
+                name='chat_message_unread_idx'
+            ),
         ]
 
     def mark_as_read(self):
@@ -33,19 +39,131 @@ class Message(models.Model):
         return f"{self.sender.username} -> {self.receiver.username}: {self.content[:50]}"
 
 
+def message_order(message):
+    """Sort key matching the message lists: timestamp, then id"""
+    return message.timestamp, message.pk
+
+
+def is_older_than(message, time_field):
+    """Matches denormalized rows whose last message sorts before ``message``.
+    Writes can land out of order (write-behind batches, concurrent sends),
+    so the last one to commit isn't necessarily the newest."""
+    return models.Q(**{f'{time_field}__lt': message.timestamp}) | models.Q(
+        **{time_field: message.timestamp, 'last_message__lt': message.pk}
+    )
+
+
+def if_newer(model, newer, values):
+    """UPDATE expressions that set ``values`` only on rows matching ``newer``"""
+    return {
+        name: models.Case(
+            models.When(newer, then=models.Value(value)),
+            default=models.F(name),
+            output_field=model._meta.get_field(name)
+        )
+        for name, value in values.items()
+    }
+
+
+class Conversation(models.Model):
+    """
+    Denormalized inbox row, one per user pair.
+
+    ``user_low`` always holds the smaller user id so a pair maps to exactly
+    one row. Kept up to date by the chat consumer and the read-receipt views
+    so the inbox never has to scan ``Message``.
+    """
+    user_low = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    user_high = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    last_message = models.ForeignKey(Message, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_activity = models.DateTimeField(default=timezone.now)
+    low_unread = models.PositiveIntegerField(default=0)
+    high_unread = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('user_low', 'user_high')
+        indexes = [
+            models.Index(fields=['user_low', '-last_activity']),
+            models.Index(fields=['user_high', '-last_activity']),
+        ]
+
+    @staticmethod
+    def pair(user_a_id, user_b_id):
+        return min(user_a_id, user_b_id), max(user_a_id, user_b_id)
+
+    @classmethod
+    def for_user(cls, user):
+        return cls.objects.filter(
+            models.Q(user_low=user) | models.Q(user_high=user)
+        ).order_by('-last_activity')
+
+    @classmethod
+    def record_message(cls, message):
+        """Bump the pair's row for a newly saved message. Call inside a transaction."""
+        cls.record_messages([message])
+
+    @classmethod
+    def record_messages(cls, messages):
+        """Like record_message, but one UPDATE per pair for a batch in send order"""
+        pairs = {}
+        for message in messages:
+            low, high = cls.pair(message.sender_id, message.receiver_id)
+            entry = pairs.setdefault((low, high), {'low_unread': 0, 'high_unread': 0, 'last': message})
+            entry['last'] = max(entry['last'], message, key=message_order)
+            entry['low_unread' if message.receiver_id == low else 'high_unread'] += 1
+
+        for (low, high), entry in pairs.items():
+            conversation, _ = cls.objects.select_for_update().get_or_create(
+                user_low_id=low, user_high_id=high
+            )
+            last = entry['last']
+            # Counters always move; the preview only if no newer message got there first
+            newer = models.Q(last_message__isnull=True) | is_older_than(last, 'last_activity')
+            cls.objects.filter(pk=conversation.pk).update(
+                **if_newer(cls, newer, {
+                    'last_message': last.pk,
+                    'last_message_preview': last.content[:100],
+                    'last_activity': last.timestamp,
+                }),
+                low_unread=models.F('low_unread') + entry['low_unread'],
+                high_unread=models.F('high_unread') + entry['high_unread']
+            )
+
+    @classmethod
+    def mark_read(cls, reader_id, peer_id, count=None):
+        """Lower the reader's unread counter by count, or reset it when count is None"""
+        low, high = cls.pair(reader_id, peer_id)
+        unread_field = 'low_unread' if reader_id == low else 'high_unread'
+        value = 0 if count is None else Greatest(models.F(unread_field) - count, 0)
+        cls.objects.filter(user_low_id=low, user_high_id=high).update(**{unread_field: value})
+
+    def other_user(self, user):
+        return self.user_high if self.user_low_id == user.id else self.user_low
+
+    def unread_for(self, user):
+        return self.low_unread if self.user_low_id == user.id else self.high_unread
+
+    def __str__(self):
+        return f"{self.user_low_id} <-> {self.user_high_id}"
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     profile_picture = models.ImageField(upload_to='profile_pics/', default='default.jpg', null=True, blank=True)
+    # Square WebP variants made off the request by chat.avatars
+    avatar_64 = models.ImageField(upload_to='profile_pics/thumbs/', blank=True)
+    avatar_256 = models.ImageField(upload_to='profile_pics/thumbs/', blank=True)
     bio = models.TextField(blank=True)
     phone_number = models.CharField(max_length=15, blank=True, null=True)
-    last_seen = models.DateTimeField(auto_now=True)
+    # Written in batches by chat.presence when the user's last socket closes
+    last_seen = models.DateTimeField(null=True, blank=True)
 
     def is_online(self):
-        """User is online if last_seen is None (actively connected)
-        or was seen less than 5 minutes ago"""
-        if self.last_seen is None:
-            return True
-        return (timezone.now() - self.last_seen).total_seconds() < 300  # 5 minute threshold
+        """User is online while any of their sockets is heartbeating.
+        Use chat.presence.online_user_ids for more than one user."""
+        from .presence import is_online
+        return is_online(self.user_id)
 
 
 class Group(models.Model):
@@ -55,6 +173,14 @@ class Group(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     avatar = models.ImageField(upload_to='group_avatars/', null=True, blank=True)
     slug = models.SlugField(unique=True, blank=True)
+    # Denormalized for the group list, maintained on send and membership changes
+    last_message = models.ForeignKey('GroupMessage', related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    last_message_preview = models.CharField(max_length=100, blank=True)
+    last_message_sender = models.CharField(max_length=150, blank=True)
+    last_message_time = models.DateTimeField(null=True, blank=True)
+    member_count = models.PositiveIntegerField(default=0)
+    # Set when deletion is requested; the group is hidden until chat.deletion purges it
+    pending_delete = models.BooleanField(default=False)
 
     def save(self, *args, **kwargs):
         if not self.slug:
@@ -64,6 +190,38 @@ class Group(models.Model):
                 self.slug = f"{self.slug}-{Group.objects.filter(slug__startswith=self.slug).count()}"
         super().save(*args, **kwargs)
 
+    def record_message(self, message):
+        """Store message as the group's latest unless a newer one already is.
+        Call inside the insert's transaction."""
+        Group.objects.filter(
+            models.Q(last_message_time__isnull=True) | is_older_than(message, 'last_message_time'),
+            pk=self.pk
+        ).update(
+            last_message=message,
+            last_message_preview=message.content[:100],
+            last_message_sender=message.sender.username,
+            last_message_time=message.timestamp
+        )
+
+    def refresh_last_message(self):
+        """Re-derive the denormalized last message, e.g. after messages were purged"""
+        last = GroupMessage.objects.filter(group_id=self.pk) \
+            .select_related('sender') \
+            .order_by('-timestamp', '-id') \
+            .first()
+        Group.objects.filter(pk=self.pk).update(
+            last_message=last,
+            last_message_preview=last.content[:100] if last else '',
+            last_message_sender=last.sender.username if last else '',
+            last_message_time=last.timestamp if last else None
+        )
+
+    def refresh_member_count(self):
+        """Recount members in SQL. Update-only, so the membership cache is untouched."""
+        Group.objects.filter(pk=self.pk).update(
+            member_count=member_count_subquery()
+        )
+
     def __str__(self):
         return self.name
 
@@ -78,11 +236,19 @@ class GroupMember(models.Model):
         unique_together = ('group', 'user')
 
 
+def member_count_subquery():
+    """Correlated member count for updating Group.member_count in SQL"""
+    return Coalesce(models.Subquery(
+        GroupMember.objects.filter(group=models.OuterRef('pk'))
+        .values('group').annotate(count=models.Count('id')).values('count')
+    ), 0)
+
+
 class GroupMessage(models.Model):
     group = models.ForeignKey(Group, related_name='messages', on_delete=models.CASCADE)
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(default=timezone.now)
 
     class Meta:
         indexes = [
@@ -94,6 +260,43 @@ class GroupMessage(models.Model):
         return f"{self.sender.username} in {self.group.name}: {self.content[:50]}"
 
 
+class DeletionJob(models.Model):
+    """
+    A user or group being purged in the background by chat.deletion.
+    ``target_id`` is a plain id, not a foreign key, since the job outlives
+    its target.
+    """
+    USER = 'user'
+    GROUP = 'group'
+    KINDS = [(USER, 'User'), (GROUP, 'Group')]
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    kind = models.CharField(max_length=10, choices=KINDS)
+    target_id = models.BigIntegerField()
+    requested_by = models.ForeignKey(User, related_name='+', null=True, blank=True, on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    # Name of the table being purged, and rows deleted so far across all of them
+    stage = models.CharField(max_length=50, blank=True)
+    deleted_rows = models.PositiveBigIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(default=timezone.now)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status']),
+        ]
+
+    def __str__(self):
+        return f"delete {self.kind} {self.target_id}: {self.status}"
+
+
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
     if created:
@@ -113,14 +316,34 @@ def save_user_profile(sender, instance, **kwargs):
         Profile.objects.create(user=instance)
 
 
-@receiver(pre_save, sender=Profile)
-def delete_old_profile_picture(sender, instance, **kwargs):
-    if instance.pk:  # Only for existing instances
-        try:
-            old_instance = Profile.objects.get(pk=instance.pk)
-            if (old_instance.profile_picture and
-                old_instance.profile_picture != instance.profile_picture and
-                not old_instance.profile_picture.name.endswith('profile_pics/default.png')):
-                old_instance.profile_picture.delete(save=False)
-        except Profile.DoesNotExist:
-            pass
\ No newline at end of file
+@receiver(post_save, sender=User)
+def index_username(sender, instance, **kwargs):
+    from .user_index import user_index
+    if not instance.is_active:
+        user_index.remove(instance.id)
+    elif user_index.warmed:
+        user_index.add(instance.id, instance.username)
+
+
+@receiver(post_delete, sender=User)
+def unindex_username(sender, instance, **kwargs):
+    from .user_index import user_index
+    user_index.remove(instance.id)
+
+
+@receiver([post_save, post_delete], sender=GroupMember)
+def invalidate_group_membership(sender, instance, **kwargs):
+    from .membership import invalidate_group
+    invalidate_group(instance.group_id)
+
+
+@receiver([post_save, post_delete], sender=Group)
+def invalidate_group_metadata(sender, instance, **kwargs):
+    from .membership import invalidate_group
+    invalidate_group(instance.id, instance.slug)
+
+
+@receiver(post_delete, sender=Profile)
+def delete_profile_pictures(sender, instance, **kwargs):
+    from .avatars import delete_in_background, picture_names
+    delete_in_background(picture_names(instance))
@@ -0,0 +1,86 @@
+import base64
+from datetime import datetime
+
+from django.db import models
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(timestamp, pk):
+    """Opaque keyset cursor pointing at a single (timestamp, id) row"""
+    raw = f"{timestamp.isoformat()}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        timestamp, pk = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(str(e))
+
+
+def page_size(request):
+    try:
+        limit = int(request.GET.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def is_cursor_request(request):
+    return bool(request.GET.get('before') or request.GET.get('after'))
+
+
+def paginate_by_timestamp(queryset, request):
+    """
+    Keyset pagination over (timestamp, id).
+
+    Pages are always returned newest-first. ``?before=<cursor>`` walks back
+    into older history, ``?after=<cursor>`` fetches what arrived since. The
+    returned ``next_cursor`` continues in the same direction and is None once
+    there is nothing left.
+    """
+    limit = page_size(request)
+    before = request.GET.get('before')
+    after = request.GET.get('after')
+
+    if after:
+        timestamp, pk = decode_cursor(after)
+        queryset = queryset.filter(
+            models.Q(timestamp__gt=timestamp) |
+            models.Q(timestamp=timestamp, id__gt=pk)
+        ).order_by('timestamp', 'id')
+    else:
+        if before:
+            timestamp, pk = decode_cursor(before)
+            queryset = queryset.filter(
+                models.Q(timestamp__lt=timestamp) |
+                models.Q(timestamp=timestamp, id__lt=pk)
+            )
+        queryset = queryset.order_by('-timestamp', '-id')
+
+    rows = list(queryset[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        edge = rows[-1]
+        next_cursor = encode_cursor(_field(edge, 'timestamp'), _field(edge, 'id'))
+
+    if after:
+        rows.reverse()
+
+    return rows, next_cursor
+
+
+def _field(row, name):
+    # Rows may be model instances or values() dicts
+    return row[name] if isinstance(row, dict) else getattr(row, name)
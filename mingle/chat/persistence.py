@@ -0,0 +1,150 @@
+"""
+Write-behind persistence for chat messages.
+
+Consumers hand unsaved Message/GroupMessage instances to a per-process
+queue. A single worker task drains it, writing each batch with one
+``bulk_create`` inside one transaction, and resolves the callers' futures
+once the batch has committed so they can broadcast. A batch is flushed when
+it reaches ``CHAT_WRITE_BATCH_SIZE`` or ``CHAT_WRITE_FLUSH_MS`` after its
+first message arrived, whichever comes first. When ``CHAT_WRITE_QUEUE_SIZE``
+messages are pending, ``submit`` waits, pushing back on the sockets.
+
+Queues are bound to an event loop. When ``submit`` runs on a new one, what
+the old loop's queue still held is written first, so none of it is lost.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from .ids import assign_message_id
+from .models import Message, Conversation, GroupMessage, message_order
+
+
+def _assign_ids(messages):
+    for message in messages:
+        message.id = assign_message_id(message.id)
+
+
+def write_messages(messages):
+    """Insert direct messages and update their conversations in one transaction"""
+    _assign_ids(messages)
+    with transaction.atomic():
+        saved = Message.objects.bulk_create(messages)
+        Conversation.record_messages(saved)
+    return saved
+
+
+def write_group_messages(messages):
+    """Insert group messages and update each group's last message in one transaction"""
+    _assign_ids(messages)
+    with transaction.atomic():
+        saved = GroupMessage.objects.bulk_create(messages)
+        latest = {}
+        for message in saved:
+            current = latest.get(message.group_id, message)
+            latest[message.group_id] = max(current, message, key=message_order)
+        for message in latest.values():
+            message.group.record_message(message)
+    return saved
+
+
+class WriteBehindQueue:
+    def __init__(self, writer, batch_size=None, flush_interval=None, max_pending=None):
+        self.writer = writer
+        self.batch_size = batch_size or settings.CHAT_WRITE_BATCH_SIZE
+        self.flush_interval = (flush_interval or settings.CHAT_WRITE_FLUSH_MS) / 1000
+        self.max_pending = max_pending or settings.CHAT_WRITE_QUEUE_SIZE
+        self._queue = None
+        self._worker = None
+        self._loop = None
+        self._collecting = []
+
+    def _ensure_worker(self):
+        """Start a worker on the running loop if needed. Returns whatever the
+        previous loop's queue still held, which the caller has to write."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker is not None and not self._worker.done():
+            return []
+        leftovers = self._take_leftovers(loop)
+        # Queues and tasks are bound to the loop that created them
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._collecting = []
+        self._worker = loop.create_task(self._run(self._queue))
+        return leftovers
+
+    def _take_leftovers(self, loop):
+        if self._queue is None:
+            return []
+        leftovers = []
+        if self._loop is not loop and (self._loop.is_closed() or not self._loop.is_running()):
+            # Its worker will never run again, including the batch it had started
+            leftovers.extend(self._collecting)
+        # A worker still running on its own loop writes its current batch and then stops
+        while True:
+            try:
+                leftovers.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return leftovers
+
+    async def submit(self, instance):
+        """Queue an unsaved instance; returns it saved once its batch commits"""
+        leftovers = self._ensure_worker()
+        if leftovers:
+            await self._write(leftovers)
+        future = self._loop.create_future()
+        await self._queue.put((instance, future))
+        return await future
+
+    async def _collect(self, queue):
+        self._collecting = batch = [await queue.get()]
+        deadline = self._loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        self._collecting = []
+        return batch
+
+    async def _write(self, batch):
+        instances = [instance for instance, _ in batch]
+        try:
+            saved = await sync_to_async(self.writer)(instances)
+        except Exception as e:
+            for _, future in batch:
+                _settle(future, error=e)
+            return
+        for (_, future), instance in zip(batch, saved):
+            _settle(future, result=instance)
+
+    async def _run(self, queue):
+        while self._queue is queue:
+            await self._write(await self._collect(queue))
+
+
+def _settle(future, result=None, error=None):
+    """Resolve a submit() future from whichever loop is flushing its batch"""
+    def settle():
+        if not future.done():
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    loop = future.get_loop()
+    if loop.is_closed():
+        return  # Nothing is left to await it
+    if loop is asyncio.get_running_loop():
+        settle()
+    else:
+        loop.call_soon_threadsafe(settle)
+
+
+message_queue = WriteBehindQueue(write_messages)
+group_message_queue = WriteBehindQueue(write_group_messages)
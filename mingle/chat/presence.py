@@ -0,0 +1,224 @@
+"""
+Presence tracking.
+
+Each open socket registers a connection under its user with an expiry that
+is pushed forward by heartbeats. A user is online while at least one of
+their connections is unexpired, so several tabs are reference counted and a
+crashed process simply stops heartbeating and ages out after
+``CHAT_PRESENCE_TTL`` seconds.
+
+When a user's last connection closes, their last-seen time is parked in
+the backend. Those times are written to ``Profile.last_seen`` in one bulk
+UPDATE at most every ``CHAT_PRESENCE_FLUSH_SECONDS``, never through
+``Profile.save()``. Connects, disconnects and heartbeats flush when the
+interval has passed; ``start_periodic_flush`` (called from asgi.py) adds a
+timer so quiet periods flush too, and flushes everything once more when
+the process exits.
+
+``CHAT_PRESENCE_BACKEND`` selects ``'memory'`` (single process) or
+``'redis'`` (shared between workers, using ``CHAT_PRESENCE_REDIS_URL``).
+"""
+import atexit
+import threading
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections, models
+from django.utils import timezone
+
+
+def flush_last_seen(last_seen):
+    """Write {user_id: datetime} to Profile.last_seen in a single UPDATE"""
+    if not last_seen:
+        return 0
+    from .models import Profile
+
+    return Profile.objects.filter(user_id__in=last_seen.keys()).update(
+        last_seen=models.Case(
+            *[models.When(user_id=user_id, then=models.Value(seen)) for user_id, seen in last_seen.items()],
+            output_field=models.DateTimeField()
+        )
+    )
+
+
+class InMemoryPresenceBackend:
+    def __init__(self, ttl, flush_interval):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._connections = {}  # user_id -> {connection_id: expires_at}
+        self._pending_last_seen = {}
+        self._last_flush = time.monotonic()
+
+    def connect(self, user_id, connection_id):
+        with self._lock:
+            self._connections.setdefault(user_id, {})[connection_id] = time.monotonic() + self.ttl
+            self._pending_last_seen.pop(user_id, None)
+
+    heartbeat = connect
+
+    def disconnect(self, user_id, connection_id):
+        with self._lock:
+            connections = self._connections.get(user_id, {})
+            connections.pop(connection_id, None)
+            if not self._live(connections):
+                self._connections.pop(user_id, None)
+                self._pending_last_seen[user_id] = timezone.now()
+
+    def online(self, user_ids):
+        with self._lock:
+            return {user_id for user_id in user_ids if self._live(self._connections.get(user_id, {}))}
+
+    def take_pending(self, force=False):
+        with self._lock:
+            if not force and time.monotonic() - self._last_flush < self.flush_interval:
+                return {}
+            self._last_flush = time.monotonic()
+            pending, self._pending_last_seen = self._pending_last_seen, {}
+            return pending
+
+    def _live(self, connections):
+        now = time.monotonic()
+        return any(expires_at > now for expires_at in connections.values())
+
+
+class RedisPresenceBackend:
+    """
+    One sorted set per user (``presence:<user_id>``) mapping connection id to
+    expiry epoch seconds, plus a ``presence:last_seen`` hash of pending
+    last-seen times.
+    """
+
+    LAST_SEEN_KEY = 'presence:last_seen'
+    FLUSH_LOCK_KEY = 'presence:flush_lock'
+
+    def __init__(self, ttl, flush_interval, url):
+        import redis
+
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.redis = redis.Redis.from_url(url)
+
+    def _key(self, user_id):
+        return f'presence:{user_id}'
+
+    def connect(self, user_id, connection_id):
+        pipe = self.redis.pipeline()
+        pipe.zadd(self._key(user_id), {connection_id: time.time() + self.ttl})
+        pipe.expire(self._key(user_id), self.ttl)
+        pipe.hdel(self.LAST_SEEN_KEY, user_id)
+        pipe.execute()
+
+    def heartbeat(self, user_id, connection_id):
+        pipe = self.redis.pipeline()
+        pipe.zadd(self._key(user_id), {connection_id: time.time() + self.ttl})
+        pipe.expire(self._key(user_id), self.ttl)
+        pipe.execute()
+
+    def disconnect(self, user_id, connection_id):
+        key = self._key(user_id)
+        pipe = self.redis.pipeline()
+        pipe.zrem(key, connection_id)
+        pipe.zremrangebyscore(key, '-inf', time.time())
+        pipe.zcard(key)
+        remaining = pipe.execute()[-1]
+        if not remaining:
+            self.redis.hset(self.LAST_SEEN_KEY, user_id, timezone.now().isoformat())
+
+    def online(self, user_ids):
+        user_ids = list(user_ids)
+        now = time.time()
+        pipe = self.redis.pipeline()
+        for user_id in user_ids:
+            pipe.zcount(self._key(user_id), now, '+inf')
+        return {user_id for user_id, count in zip(user_ids, pipe.execute()) if count}
+
+    def take_pending(self, force=False):
+        # Only one worker flushes per interval
+        if not force and not self.redis.set(self.FLUSH_LOCK_KEY, 1, nx=True, ex=self.flush_interval):
+            return {}
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.LAST_SEEN_KEY)
+        pipe.delete(self.LAST_SEEN_KEY)
+        pending = pipe.execute()[0]
+        return {
+            int(user_id): datetime.fromisoformat(seen.decode()).astimezone(dt_timezone.utc)
+            for user_id, seen in pending.items()
+        }
+
+
+_backend = None
+
+
+def get_presence():
+    global _backend
+    if _backend is None:
+        ttl = settings.CHAT_PRESENCE_TTL
+        flush_interval = settings.CHAT_PRESENCE_FLUSH_SECONDS
+        if settings.CHAT_PRESENCE_BACKEND == 'redis':
+            _backend = RedisPresenceBackend(ttl, flush_interval, settings.CHAT_PRESENCE_REDIS_URL)
+        else:
+            _backend = InMemoryPresenceBackend(ttl, flush_interval)
+    return _backend
+
+
+def user_connected(user_id, connection_id):
+    get_presence().connect(user_id, connection_id)
+    flush_pending()
+
+
+def user_heartbeat(user_id, connection_id):
+    get_presence().heartbeat(user_id, connection_id)
+    flush_pending()
+
+
+def user_disconnected(user_id, connection_id):
+    get_presence().disconnect(user_id, connection_id)
+    flush_pending()
+
+
+def online_user_ids(user_ids):
+    """Bulk presence lookup: the subset of user_ids currently online"""
+    return get_presence().online(user_ids)
+
+
+def is_online(user_id):
+    return user_id in online_user_ids([user_id])
+
+
+def flush_pending(force=False):
+    """Write parked last-seen times to the DB if the flush interval elapsed"""
+    return flush_last_seen(get_presence().take_pending(force=force))
+
+
+_flusher = None
+
+
+def start_periodic_flush():
+    """Flush on a daemon thread every flush interval, and force a last flush at exit"""
+    global _flusher
+    if _flusher is not None:
+        return
+    _flusher = threading.Thread(target=_flush_periodically, name='presence-flush', daemon=True)
+    _flusher.start()
+    atexit.register(_flush_at_exit)
+
+
+def _flush_periodically():
+    while True:
+        time.sleep(settings.CHAT_PRESENCE_FLUSH_SECONDS)
+        try:
+            flush_pending()
+        except Exception as e:
+            print(f"Error flushing last seen times: {str(e)}")
+        finally:
+            # This thread's own connection; don't hold it between ticks
+            connections.close_all()
+
+
+def _flush_at_exit():
+    try:
+        flush_pending(force=True)
+    except Exception as e:
+        print(f"Error flushing last seen times at exit: {str(e)}")
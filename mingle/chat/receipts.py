@@ -0,0 +1,91 @@
+"""
+Read receipts.
+
+A receipt says "reader has seen peer's messages up to message id ``upto``".
+Socket receipts are coalesced per (reader, peer) for
+``CHAT_READ_RECEIPT_WINDOW_MS``, keeping the highest watermark, and then
+applied as one UPDATE bounded by id. The peer's sockets are told with a
+compact ``read_upto`` event rather than re-fetching history.
+
+The HTTP endpoint applies its receipt directly: it answers with the applied
+watermark, and a request-scoped event loop would not outlive the window.
+"""
+import asyncio
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from .models import Message, Conversation
+from .rooms import dm_room_name
+
+ReadReceipt = namedtuple('ReadReceipt', ['upto', 'read_at', 'updated'])
+
+
+def apply_read_receipt(reader_id, peer_id, upto=None):
+    """
+    Mark peer's messages to reader with id <= upto as read.
+
+    Without a watermark everything received so far is marked. Returns
+    a ``ReadReceipt`` or None if the pair has no messages.
+    """
+    received = Message.objects.filter(sender_id=peer_id, receiver_id=reader_id)
+    with transaction.atomic():
+        if upto is None:
+            upto = received.aggregate(upto=models.Max('id'))['upto']
+            if upto is None:
+                return None
+        read_at = timezone.now()
+        updated = received.filter(read=False, id__lte=upto).update(read=True, read_at=read_at)
+        if updated:
+            Conversation.mark_read(reader_id, peer_id, count=updated)
+    return ReadReceipt(upto, read_at, updated)
+
+
+async def broadcast_read_upto(reader_id, peer_id, upto, read_at):
+    await get_channel_layer().group_send(
+        dm_room_name(reader_id, peer_id),
+        {
+            "type": "read_upto",
+            "reader_id": reader_id,
+            "peer_id": peer_id,
+            "upto": upto,
+            "read_at": read_at.isoformat()
+        }
+    )
+
+
+class ReadReceiptCoalescer:
+    def __init__(self, window_ms=None):
+        self.window_ms = window_ms
+        self._pending = {}  # (reader_id, peer_id) -> watermark, None meaning "everything"
+        self._tasks = set()
+
+    async def submit(self, reader_id, peer_id, upto=None):
+        key = (reader_id, peer_id)
+        if key in self._pending:
+            current = self._pending[key]
+            self._pending[key] = None if None in (current, upto) else max(current, upto)
+            return
+        self._pending[key] = upto
+
+        task = asyncio.ensure_future(self._flush_later(key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush_later(self, key):
+        window_ms = self.window_ms if self.window_ms is not None else settings.CHAT_READ_RECEIPT_WINDOW_MS
+        await asyncio.sleep(window_ms / 1000)
+        upto = self._pending.pop(key)
+        try:
+            result = await sync_to_async(apply_read_receipt)(*key, upto)
+            if result and result.updated:
+                await broadcast_read_upto(key[0], key[1], result.upto, result.read_at)
+        except Exception as e:
+            print(f"Error applying read receipt {key}: {str(e)}")
+
+
+read_receipts = ReadReceiptCoalescer()
@@ -0,0 +1,16 @@
+"""Channel-layer group names shared by the consumers and background jobs"""
+
+
+def dm_room_name(user_a_id, user_b_id):
+    user_ids = sorted([user_a_id, user_b_id])
+    return f"chat_{user_ids[0]}_{user_ids[1]}"
+
+
+def group_room_name(group_id):
+    """Keyed by id, so renaming a group doesn't move its sockets"""
+    return f'group_{group_id}'
+
+
+def user_room_name(user_id):
+    """Per-user room every stream socket of that user joins"""
+    return f"user_{user_id}"
@@ -1,7 +1,8 @@
 from django.urls import path
-from .consumers import ChatConsumer, GroupChatConsumer
+from .consumers import ChatConsumer, GroupChatConsumer, StreamConsumer
 
 websocket_urlpatterns = [
     path("ws/chat/<int:user_id>/", ChatConsumer.as_asgi()),
     path('ws/group/<slug:group_slug>/', GroupChatConsumer.as_asgi()),
+    path('ws/stream/', StreamConsumer.as_asgi()),
 ]
\ No newline at end of file
@@ -0,0 +1,248 @@
+"""
+Full-text message search.
+
+Searches both Message and GroupMessage and only returns rows from
+conversations the caller is part of. The backend follows the database
+vendor unless ``CHAT_SEARCH_BACKEND`` names one:
+
+* ``sqlite``: FTS5 external-content tables kept in sync by triggers, so
+  bulk inserts and queryset deletes are indexed too. Install with
+  ``install_sqlite_fts`` (done by migration, redone by
+  ``manage.py rebuild_search_index`` if a schema change dropped the
+  triggers).
+* ``postgres``: a stored generated ``search_vector`` column with a GIN
+  index on each table, matched with ``@@`` and ranked with ``ts_rank``;
+  ``ts_headline`` snippets via django.contrib.postgres. Install with
+  ``install_postgres_search`` (done by migration, also redone by
+  ``rebuild_search_index``). The columns are not on the models, so the
+  ORM never reads or writes them.
+"""
+import html
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections, models
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import Message, Group, GroupMessage, GroupMember
+from .serializers import usernames_for
+
+# Snippet markers that can't occur in user text; swapped for <mark> after escaping
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+
+def highlight(snippet):
+    return html.escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+
+FTS_TABLES = {
+    'chat_message_fts': Message._meta.db_table,
+    'chat_groupmessage_fts': GroupMessage._meta.db_table,
+}
+
+
+def install_sqlite_fts(connection, rebuild=True):
+    with connection.cursor() as cursor:
+        for fts, source in FTS_TABLES.items():
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                f"content, content='{source}', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2')"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {source} BEGIN "
+                f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {source} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); END"
+            )
+            cursor.execute(
+                f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF content ON {source} BEGIN "
+                f"INSERT INTO {fts}({fts}, rowid, content) VALUES ('delete', old.id, old.content); "
+                f"INSERT INTO {fts}(rowid, content) VALUES (new.id, new.content); END"
+            )
+            if rebuild:
+                cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def uninstall_sqlite_fts(connection):
+    with connection.cursor() as cursor:
+        for fts in FTS_TABLES:
+            for suffix in ('ai', 'ad', 'au'):
+                cursor.execute(f"DROP TRIGGER IF EXISTS {fts}_{suffix}")
+            cursor.execute(f"DROP TABLE IF EXISTS {fts}")
+
+
+# Generated columns need an explicit, immutable text search configuration
+POSTGRES_SEARCH_CONFIG = 'english'
+
+
+def install_postgres_search(connection):
+    with connection.cursor() as cursor:
+        for source in FTS_TABLES.values():
+            cursor.execute(
+                f"ALTER TABLE {source} ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                f"GENERATED ALWAYS AS (to_tsvector('{POSTGRES_SEARCH_CONFIG}', content)) STORED"
+            )
+            cursor.execute(
+                f"CREATE INDEX IF NOT EXISTS {source}_search_idx ON {source} USING GIN (search_vector)"
+            )
+
+
+def uninstall_postgres_search(connection):
+    with connection.cursor() as cursor:
+        for source in FTS_TABLES.values():
+            cursor.execute(f"DROP INDEX IF EXISTS {source}_search_idx")
+            cursor.execute(f"ALTER TABLE {source} DROP COLUMN IF EXISTS search_vector")
+
+
+def build_match_query(text):
+    """Quote each term so user input can't inject FTS syntax; prefix-match the last one"""
+    terms = [term.replace('"', '""') for term in text.split()]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+class SQLiteSearchBackend:
+    SQL = """
+        SELECT 'dm', m.id, m.sender_id, m.receiver_id, NULL, m.timestamp,
+               snippet(chat_message_fts, 0, %(start)s, %(end)s, '...', 12),
+               bm25(chat_message_fts) AS rank
+        FROM chat_message_fts
+        JOIN {message} m ON m.id = chat_message_fts.rowid
+        WHERE chat_message_fts MATCH %(match)s
+          AND (m.sender_id = %(user)s OR m.receiver_id = %(user)s)
+        UNION ALL
+        SELECT 'group', g.id, g.sender_id, NULL, g.group_id, g.timestamp,
+               snippet(chat_groupmessage_fts, 0, %(start)s, %(end)s, '...', 12),
+               bm25(chat_groupmessage_fts) AS rank
+        FROM chat_groupmessage_fts
+        JOIN {group_message} g ON g.id = chat_groupmessage_fts.rowid
+        WHERE chat_groupmessage_fts MATCH %(match)s
+          AND g.group_id IN (
+              SELECT gm.group_id FROM {group_member} gm
+              JOIN {group} gr ON gr.id = gm.group_id
+              WHERE gm.user_id = %(user)s AND NOT gr.pending_delete
+          )
+        ORDER BY rank
+        LIMIT %(limit)s OFFSET %(offset)s
+    """.format(
+        message=Message._meta.db_table,
+        group_message=GroupMessage._meta.db_table,
+        group_member=GroupMember._meta.db_table,
+        group=Group._meta.db_table,
+    )
+
+    def search(self, user, text, limit, offset=0, using='default'):
+        match = build_match_query(text)
+        if match is None:
+            return []
+        with connections[using].cursor() as cursor:
+            cursor.execute(self.SQL, {
+                'match': match, 'user': user.id, 'limit': limit, 'offset': offset,
+                'start': HIGHLIGHT_START, 'end': HIGHLIGHT_END,
+            })
+            rows = cursor.fetchall()
+        return [{
+            'type': kind,
+            'id': message_id,
+            'sender_id': sender_id,
+            'receiver_id': receiver_id,
+            'group_id': group_id,
+            'timestamp': self._parse_timestamp(timestamp),
+            'snippet': snippet,
+            'rank': -rank,  # bm25 is lower-is-better
+        } for kind, message_id, sender_id, receiver_id, group_id, timestamp, snippet, rank in rows]
+
+    def _parse_timestamp(self, value):
+        # Raw cursors skip Django's converters; SQLite hands back UTC text
+        parsed = parse_datetime(value) if isinstance(value, str) else value
+        if parsed is not None and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed, dt_timezone.utc)
+        return parsed
+
+
+class PostgresSearchBackend:
+    def search(self, user, text, limit, offset=0, using='default'):
+        from django.contrib.postgres.search import SearchHeadline, SearchQuery
+
+        if not text.split():
+            return []
+        query = SearchQuery(text, search_type='websearch', config=POSTGRES_SEARCH_CONFIG)
+        headline = SearchHeadline(
+            'content', query, config=POSTGRES_SEARCH_CONFIG,
+            start_sel=HIGHLIGHT_START, stop_sel=HIGHLIGHT_END
+        )
+        window = offset + limit
+
+        direct = self._matches(Message, query, using).filter(
+            models.Q(sender=user) | models.Q(receiver=user)
+        ).annotate(snippet=headline).order_by('-rank').values(
+            'id', 'sender_id', 'receiver_id', 'timestamp', 'snippet', 'rank'
+        )[:window]
+        grouped = self._matches(GroupMessage, query, using).filter(
+            group__members__user=user, group__pending_delete=False
+        ).annotate(snippet=headline).order_by('-rank').values(
+            'id', 'sender_id', 'group_id', 'timestamp', 'snippet', 'rank'
+        )[:window]
+
+        hits = [dict(row, type='dm', group_id=None) for row in direct] + \
+            [dict(row, type='group', receiver_id=None) for row in grouped]
+        hits.sort(key=lambda hit: hit['rank'], reverse=True)
+        return hits[offset:window]
+
+    def _matches(self, model, query, using):
+        """Rows whose stored search_vector matches, so the GIN index does the filtering"""
+        from django.contrib.postgres.search import SearchRank, SearchVectorField
+
+        document = models.expressions.RawSQL(
+            f'{connections[using].ops.quote_name(model._meta.db_table)}.search_vector', [],
+            output_field=SearchVectorField()
+        )
+        return model.objects.using(using).annotate(document=document).filter(document=query) \
+            .annotate(rank=SearchRank(models.F('document'), query))
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgres': PostgresSearchBackend,
+}
+
+
+def get_search_backend(using='default'):
+    name = getattr(settings, 'CHAT_SEARCH_BACKEND', None) or {
+        'sqlite': 'sqlite',
+        'postgresql': 'postgres',
+    }[connections[using].vendor]
+    return BACKENDS[name]()
+
+
+def search_messages(user, text, limit, offset=0, using='default'):
+    """Ranked, permission-filtered hits with highlighted snippets"""
+    hits = get_search_backend(using).search(user, text, limit, offset, using=using)
+    usernames = usernames_for((hit['sender_id'] for hit in hits), using=using)
+    results = []
+    for hit in hits:
+        if hit['type'] == 'dm':
+            other_id = hit['receiver_id'] if hit['sender_id'] == user.id else hit['sender_id']
+            conversation = f"dm:{other_id}"
+        else:
+            conversation = f"group:{hit['group_id']}"
+        timestamp = hit['timestamp']
+        results.append({
+            'type': hit['type'],
+            'id': hit['id'],
+            'conversation': conversation,
+            'sender': usernames.get(hit['sender_id']),
+            'sender_id': hit['sender_id'],
+            'snippet': highlight(hit['snippet']),
+            'rank': hit['rank'],
+            'timestamp': timestamp.isoformat(),
+        })
+    return results
@@ -0,0 +1,69 @@
+from datetime import timezone as dt_timezone
+
+from django.contrib.auth import get_user_model
+
+User = get_user_model()
+
+MESSAGE_FIELDS = ('id', 'sender_id', 'receiver_id', 'content', 'timestamp')
+GROUP_MESSAGE_FIELDS = ('id', 'sender_id', 'sender__username', 'content', 'timestamp')
+
+
+def usernames_for(user_ids, using='default'):
+    """Resolve a set of user ids to usernames in a single query"""
+    return dict(User.objects.using(using).filter(id__in=set(user_ids)).values_list('id', 'username'))
+
+
+def serialize_messages(rows):
+    """
+    Serialize ``Message`` rows fetched with ``values(*MESSAGE_FIELDS)``.
+
+    Ids come straight from the ``_id`` columns, so no User rows are loaded
+    per message; sender usernames are looked up once for the whole page.
+    """
+    usernames = usernames_for(row['sender_id'] for row in rows)
+    return [{
+        'id': row['id'],
+        'sender': usernames.get(row['sender_id']),
+        'sender_id': row['sender_id'],
+        'receiver_id': row['receiver_id'],
+        'content': row['content'],
+        'timestamp': row['timestamp'].isoformat()
+    } for row in rows]
+
+
+def serialize_group_messages(rows, group):
+    """Serialize ``GroupMessage`` rows fetched with ``values(*GROUP_MESSAGE_FIELDS)``"""
+    return [{
+        'id': row['id'],
+        'sender': row['sender__username'],
+        'sender_id': row['sender_id'],
+        'group_slug': group.slug,
+        'group_id': group.id,
+        'content': row['content'],
+        'timestamp': row['timestamp'].isoformat()
+    } for row in rows]
+
+
+def serialize_message(message):
+    """Same shape as ``serialize_messages`` for a freshly saved ``Message``"""
+    return {
+        'id': message.id,
+        'sender': message.sender.username,
+        'sender_id': message.sender_id,
+        'receiver_id': message.receiver_id,
+        'content': message.content,
+        'timestamp': message.timestamp.astimezone(dt_timezone.utc).isoformat()
+    }
+
+
+def serialize_group_message(message):
+    """Same shape as ``serialize_group_messages`` for a freshly saved ``GroupMessage``"""
+    return {
+        'id': message.id,
+        'sender': message.sender.username,
+        'sender_id': message.sender_id,
+        'group_slug': message.group.slug,
+        'group_id': message.group_id,
+        'content': message.content,
+        'timestamp': message.timestamp.astimezone(dt_timezone.utc).isoformat()
+    }
@@ -17,6 +17,7 @@ const memberSelection = document.getElementById('memberSelection');
 let currentUser = null;
 let selectedChat = null;
 let chatSocket = null;
+let heartbeatTimer = null;
 let activeTab = 'private';
 let currentModalView = 'details';
 let unreadCounts = {
@@ -42,6 +43,9 @@ document.addEventListener('DOMContentLoaded', () => {
     loadPrivateChats();
     loadGroups();
 
+    // One socket carries every conversation
+    connectWebSocket();
+
     // Event listeners
     document.querySelectorAll('.chat-tabs button').forEach(button => {
         button.addEventListener('click', switchTab);
@@ -163,7 +167,7 @@ async function loadGroups() {
                     <h4>${group.name}</h4>
                 </div>
             `;
-            groupItem.addEventListener('click', () => selectGroupChat(group.slug, group.name));
+            groupItem.addEventListener('click', () => selectGroupChat(group.slug, group.name, group.id));
             groupChatsList.appendChild(groupItem);
         });
     } catch (error) {
@@ -178,32 +182,27 @@ async function selectPrivateChat(userId, username, isOnline) {
     updateChatItemBadge(userId, 0);
     localStorage.setItem(`unread_${userId}`, '0');
 
-    // 2. Server update (with retry)
-    let retries = 3;
-    while (retries > 0) {
-        if (await markMessagesAsRead(userId)) break;
-        retries--;
-        await new Promise(resolve => setTimeout(resolve, 1000));
-    }
-
-    // 3. Proceed with chat opening
+    // 2. Open the chat
     const container = document.querySelector('#chatBox .message-container');
     if (container) container.innerHTML = '<div class="message-spacer"></div>';
 
     selectedChat = { type: 'private', id: userId };
     updateActiveChatUI(username, isOnline ? 'Online' : 'Offline', isOnline);
 
-    if (chatSocket) {
-        chatSocket.onclose = null;
-        chatSocket.close();
-    }
+    const messages = await loadChatMessages();
 
-    await loadChatMessages();
-    connectWebSocket();
+    // 3. Server update up to the newest loaded message (with retry)
+    const upto = messages.length ? messages[0].id : null;
+    let retries = 3;
+    while (retries > 0) {
+        if (await markMessagesAsRead(userId, upto)) break;
+        retries--;
+        await new Promise(resolve => setTimeout(resolve, 1000));
+    }
 }
 
 // Select group chat
-async function selectGroupChat(groupSlug, groupName) {
+async function selectGroupChat(groupSlug, groupName, groupId) {
     // Clear existing state
     unreadCounts.groups[groupSlug] = 0;
     updateChatItemBadge(groupSlug, 0);
@@ -214,7 +213,7 @@ async function selectGroupChat(groupSlug, groupName) {
         container.innerHTML = '<div class="message-spacer"></div>';
     }
 
-    selectedChat = { type: 'group', slug: groupSlug };
+    selectedChat = { type: 'group', slug: groupSlug, id: groupId };
     updateActiveChatUI(groupName, 'Group', false);
 
     // Make group name clickable
@@ -223,15 +222,8 @@ async function selectGroupChat(groupSlug, groupName) {
         openGroupDetailsModal(groupSlug, groupName);
     };
 
-    // Close existing socket
-    if (chatSocket) {
-        chatSocket.onclose = null;
-        chatSocket.close();
-    }
-
-    // Load messages and connect socket
+    // Load messages
     await loadChatMessages();
-    connectWebSocket();
 }
 
 // Update active chat UI
@@ -284,17 +276,20 @@ function updateActiveChatUI(title, status, isOnline, profilePicture = null) {
     }
 }
 
+// History endpoint of the open chat; pages are newest-first with a next_cursor
+function messagesUrl(chat, before = null) {
+    const base = chat.type === 'private'
+        ? `/chat/get_messages/${chat.id}/`
+        : `/chat/get_group_messages/${chat.slug}/`;
+    return before ? `${base}?${new URLSearchParams({ before })}` : base;
+}
+
 // Load chat messages
 async function loadChatMessages() {
-    if (!selectedChat) return;
+    if (!selectedChat) return [];
 
     try {
-        let response;
-        if (selectedChat.type === 'private') {
-            response = await fetch(`/chat/get_messages/${selectedChat.id}/`);
-        } else {
-            response = await fetch(`/chat/get_group_messages/${selectedChat.slug}/`);
-        }
+        const response = await fetch(messagesUrl(selectedChat));
 
         if (!response.ok) throw new Error('Failed to load messages');
 
@@ -304,7 +299,8 @@ async function loadChatMessages() {
             const container = document.querySelector('.message-container');
             const previousScrollHeight = container ? container.scrollHeight : 0;
 
-            renderMessages(data.messages);
+            // Pages arrive newest-first; render oldest-first
+            renderMessages(data.messages.slice().reverse());
 
             // Immediately set scroll to bottom without animation
             if (container) {
@@ -313,12 +309,50 @@ async function loadChatMessages() {
                     container.scrollTop = container.scrollHeight;
                 }, 10);
             }
+            showLoadOlder(data.next_cursor);
         } else {
             showEmptyChatState();
         }
+        return data.messages || [];
     } catch (error) {
         console.error('Error loading messages:', error);
         showEmptyChatState();
+        return [];
+    }
+}
+
+// Older pages go at the top: the end of the DOM, as the container is column-reverse
+function showLoadOlder(cursor) {
+    const container = document.querySelector('#chatBox .message-container');
+    if (!container) return;
+    container.querySelector('.btn-load-older')?.remove();
+    if (!cursor) return;
+
+    const chat = selectedChat;
+    const button = document.createElement('button');
+    button.type = 'button';
+    button.className = 'btn-load-more btn-load-older';
+    button.textContent = 'Load older messages';
+    button.addEventListener('click', () => loadOlderMessages(chat, cursor, button));
+    container.appendChild(button);
+}
+
+async function loadOlderMessages(chat, cursor, button) {
+    button.disabled = true;
+    try {
+        const response = await fetch(messagesUrl(chat, cursor));
+        if (!response.ok) throw new Error('Failed to load older messages');
+        const data = await response.json();
+        if (chat !== selectedChat) return;  // Switched chats meanwhile
+
+        const container = document.querySelector('#chatBox .message-container');
+        const fragment = document.createDocumentFragment();
+        (data.messages || []).forEach(message => fragment.appendChild(messageElement(message)));
+        container.insertBefore(fragment, button);
+        showLoadOlder(data.next_cursor);
+    } catch (error) {
+        console.error('Error loading older messages:', error);
+        button.disabled = false;
     }
 }
 
@@ -370,15 +404,7 @@ function renderMessages(messages) {
         const originalIndex = messages.length - 1 - reversedIndex;
 
 
-        const isSelf = message.sender === currentUser.username;
-        const messageDiv = document.createElement('div');
-        messageDiv.className = `message ${isSelf ? 'sent' : 'received'}`;
-        messageDiv.innerHTML = `
-            ${!isSelf ? `<div class="sender">${message.sender}</div>` : ''}
-            <div class="content">${message.content}</div>
-            <div class="timestamp">${formatTime(message.timestamp)}</div>
-        `;
-        fragment.appendChild(messageDiv);
+        fragment.appendChild(messageElement(message));
     });
 
     container.appendChild(fragment);
@@ -388,6 +414,19 @@ function renderMessages(messages) {
     container.scrollTop = previousScrollTop + heightDifference;
 }
 
+function messageElement(message) {
+    const isSelf = message.sender === currentUser.username;
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `message ${isSelf ? 'sent' : 'received'}`;
+    if (message.id) messageDiv.dataset.messageId = message.id;
+    messageDiv.innerHTML = `
+        ${!isSelf ? `<div class="sender">${message.sender}</div>` : ''}
+        <div class="content">${message.content}</div>
+        <div class="timestamp">${formatTime(message.timestamp)}</div>
+    `;
+    return messageDiv;
+}
+
 function isNearBottom() {
     const container = document.querySelector('.message-container');
     if (!container) return true;
@@ -413,6 +452,54 @@ function scrollToBottom() {
     }, 50);
 }
 
+// Conversation key used to route frames on the shared socket
+function conversationKey(chat) {
+    if (!chat) return null;
+    return chat.type === 'private' ? `dm:${chat.id}` : `group:${chat.id}`;
+}
+
+// Apply a group control frame from the server
+function handleGroupControl(data) {
+    const isActiveChat = data.conversation === conversationKey(selectedChat);
+
+    if (isActiveChat && (data.type === 'membership_revoked' || data.type === 'group_deleted')) {
+        selectedChat = null;
+        activeChatTitle.textContent = 'Select a chat';
+        activeChatTitle.onclick = null;
+        document.querySelector('#chatBox .message-container').innerHTML = `
+            <div class="empty-chat">
+                <i class="fas fa-comments"></i>
+                <p>Select a chat to start messaging</p>
+            </div>
+        `;
+    } else if (isActiveChat && data.type === 'group_renamed') {
+        selectedChat.slug = data.group_slug;
+        activeChatTitle.textContent = data.name;
+        activeChatTitle.onclick = () => {
+            openGroupDetailsModal(data.group_slug, data.name);
+        };
+    }
+
+    loadGroups();
+}
+
+// A DM peer deleted their account
+function handleAccountDeleted(data) {
+    if (data.conversation === conversationKey(selectedChat)) {
+        selectedChat = null;
+        activeChatTitle.textContent = 'Select a chat';
+        activeChatTitle.onclick = null;
+        document.querySelector('#chatBox .message-container').innerHTML = `
+            <div class="empty-chat">
+                <i class="fas fa-comments"></i>
+                <p>Select a chat to start messaging</p>
+            </div>
+        `;
+    }
+
+    loadPrivateChats();
+}
+
 // Connect WebSocket
 function connectWebSocket() {
     if (chatSocket) {
@@ -420,23 +507,21 @@ function connectWebSocket() {
         chatSocket.close();
     }
 
-    if (!selectedChat) return;
-
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    let socketUrl;
-
-    if (selectedChat.type === 'private') {
-        socketUrl = `${protocol}//${window.location.host}/ws/chat/${selectedChat.id}/`;
-    } else {
-        socketUrl = `${protocol}//${window.location.host}/ws/group/${selectedChat.slug}/`;
-    }
-
-    chatSocket = new WebSocket(socketUrl);
+    chatSocket = new WebSocket(`${protocol}//${window.location.host}/ws/stream/`);
 
     chatSocket.onopen = () => {
-        console.log('WebSocket connected for', selectedChat.type);
+        console.log('Stream WebSocket connected');
     };
 
+    // Keep presence alive while the tab is open but idle
+    clearInterval(heartbeatTimer);
+    heartbeatTimer = setInterval(() => {
+        if (chatSocket.readyState === WebSocket.OPEN) {
+            chatSocket.send(JSON.stringify({ type: 'heartbeat' }));
+        }
+    }, 20000);
+
     chatSocket.onmessage = (e) => {
     try {
         const data = JSON.parse(e.data);
@@ -444,22 +529,51 @@ function connectWebSocket() {
         // Debug log to see raw WebSocket data
         console.log("WebSocket data received:", data);
 
+        // Persistence result for an optimistically delivered message
+        if (data.type === 'ack' || data.type === 'persist_failed') {
+            reconcileMessage(data);
+            return;
+        }
+
+        // The peer read our messages up to data.upto
+        if (data.type === 'read_upto') {
+            markReadUpTo(data.upto);
+            return;
+        }
+
+        // Group membership changed while connected
+        if (['membership_revoked', 'group_deleted', 'group_renamed', 'membership_granted'].includes(data.type)) {
+            handleGroupControl(data);
+            return;
+        }
+
+        if (data.type === 'account_deleted') {
+            handleAccountDeleted(data);
+            return;
+        }
+
         // Check if this message belongs to the currently active chat
-        const isActiveChat = (
-            (selectedChat?.type === 'private' &&
-            (data.sender_id == selectedChat.id || data.receiver_id == selectedChat.id)) ||
-            (selectedChat?.type === 'group' && data.group_slug === selectedChat.slug)
-        );
+        const isActiveChat = data.conversation === conversationKey(selectedChat);
 
         // Handle unread counts for non-active chats
-        if (!isActiveChat && data.sender_id !== currentUser.id) {
-            // ... (keep your existing unread count logic)
+        if (!isActiveChat && data.sender_id != currentUser.id) {
+            if (data.conversation.startsWith('dm:')) {
+                const count = (unreadCounts.private[data.sender_id] || 0) + 1;
+                unreadCounts.private[data.sender_id] = count;
+                updateChatItemBadge(data.sender_id, count);
+            } else {
+                const count = (unreadCounts.groups[data.group_slug] || 0) + 1;
+                unreadCounts.groups[data.group_slug] = count;
+                updateChatItemBadge(data.group_slug, count);
+            }
         }
 
         // Handle message display
         if (isActiveChat) {
             // Transform data to match what appendNewMessage expects
             const messageData = {
+                message_id: data.message_id,
+                client_msg_id: data.client_msg_id,
                 sender: data.sender || data.username || 'Unknown',
                 sender_id: data.sender_id,
                 message: data.message || data.content,
@@ -475,6 +589,15 @@ function connectWebSocket() {
             console.log("Processed message data:", messageData);
             appendNewMessage(messageData);
 
+            // Reading it as it arrives; the server coalesces these
+            if (selectedChat.type === 'private' && data.sender_id != currentUser.id && data.message_id) {
+                chatSocket.send(JSON.stringify({
+                    type: 'read_receipt',
+                    conversation: data.conversation,
+                    upto: data.message_id
+                }));
+            }
+
             // For group chats, still keep your refresh logic
             if (selectedChat.type === 'group') {
                 setTimeout(() => {
@@ -519,6 +642,7 @@ function appendNewMessage(data) {
     const isSelf = data.sender === currentUser.username;
     const messageDiv = document.createElement('div');
     messageDiv.className = `message ${isSelf ? 'sent' : 'received'}`;
+    if (data.message_id) messageDiv.dataset.messageId = data.message_id;
     messageDiv.innerHTML = `
         ${!isSelf ? `<div class="sender">${data.sender}</div>` : ''}
         <div class="content">${data.message}</div>
@@ -531,12 +655,30 @@ function appendNewMessage(data) {
     container.insertBefore(messageDiv, container.firstChild);
 }
 
+// Flag our sent messages with id <= upto as read
+function markReadUpTo(upto) {
+    document.querySelectorAll('.message.sent[data-message-id]').forEach(messageDiv => {
+        if (Number(messageDiv.dataset.messageId) <= upto) {
+            messageDiv.classList.add('read');
+        }
+    });
+}
+
+// Mark a delivered message as saved or failed once the server reports back
+function reconcileMessage(data) {
+    const messageDiv = document.querySelector(`.message[data-message-id="${data.message_id}"]`);
+    if (!messageDiv) return;
+    messageDiv.classList.toggle('failed', data.type === 'persist_failed');
+}
+
 // Send message
 function sendMessage() {
     if (!selectedChat || !messageInput.value.trim()) return;
 
     const message = {
         type: selectedChat.type,
+        conversation: conversationKey(selectedChat),
+        client_msg_id: crypto.randomUUID(),
         content: messageInput.value.trim(),
         timestamp: new Date().toISOString()
     };
@@ -737,6 +879,7 @@ function switchModalView(view) {
         modal.querySelector('form').innerHTML = `
             <div class="form-group">
                 <label>Select Members to Add</label>
+                <input type="text" id="nonMemberSearch" placeholder="Search users..." autocomplete="off">
                 <div class="member-list" id="memberSelection">
                     <!-- Non-members will load here -->
                 </div>
@@ -750,6 +893,12 @@ function switchModalView(view) {
                 </button>
             </div>
         `;
+        selectedNewMembers.clear();
+        let searchTimer = null;
+        document.getElementById('nonMemberSearch').addEventListener('input', (e) => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(() => loadNonMembers(selectedChat.slug, e.target.value.trim()), 250);
+        });
         loadNonMembers(selectedChat.slug);
     } else {
         openGroupDetailsModal(selectedChat.slug, activeChatTitle.textContent);
@@ -799,8 +948,8 @@ async function loadGroupDetails(groupSlug) {
 
 async function addSelectedMembers() {
     const groupSlug = selectedChat.slug;
-    const members = Array.from(document.querySelectorAll('input[name="new_members"]:checked'))
-                         .map(el => el.value);
+    // Picks survive new searches, so they aren't read back from the checkboxes
+    const members = Array.from(selectedNewMembers);
 
     try {
         const response = await fetch(`/chat/add_members/${groupSlug}/`, {
@@ -989,19 +1138,29 @@ async function createGroup(e) {
     }
 }
 
-async function loadNonMembers(groupSlug) {
+const selectedNewMembers = new Set();
+let nonMemberRequest = 0;
+
+// One page of non-members; the server filters and pages, so large user tables stay server-side
+async function loadNonMembers(groupSlug, query = '', cursor = null) {
+    const request = ++nonMemberRequest;
     try {
-        const response = await fetch(`/chat/get_non_members/${groupSlug}/`);
+        const params = new URLSearchParams({ query });
+        if (cursor) params.set('cursor', cursor);
+        const response = await fetch(`/chat/get_non_members/${groupSlug}/?${params}`);
         const data = await response.json();
+        if (request !== nonMemberRequest) return;  // A newer keystroke superseded this one
 
         const container = document.getElementById('memberSelection');
-        container.innerHTML = '';
+        if (!cursor) container.innerHTML = '';
+        container.querySelector('.btn-load-more')?.remove();
 
         data.users.forEach(user => {
             const memberItem = document.createElement('div');
             memberItem.className = 'member-item';
             memberItem.innerHTML = `
-                <input type="checkbox" name="new_members" value="${user.id}" id="new-member-${user.id}">
+                <input type="checkbox" name="new_members" value="${user.id}" id="new-member-${user.id}"
+                    ${selectedNewMembers.has(String(user.id)) ? 'checked' : ''}>
                 <label for="new-member-${user.id}">
                     <div class="avatar">
                         <i class="fas fa-user"></i>
@@ -1009,8 +1168,21 @@ async function loadNonMembers(groupSlug) {
                     <span>${user.username}</span>
                 </label>
             `;
+            memberItem.querySelector('input').addEventListener('change', (e) => {
+                if (e.target.checked) selectedNewMembers.add(e.target.value);
+                else selectedNewMembers.delete(e.target.value);
+            });
             container.appendChild(memberItem);
         });
+
+        if (data.next_cursor) {
+            const more = document.createElement('button');
+            more.type = 'button';
+            more.className = 'btn-load-more';
+            more.textContent = 'Load more';
+            more.addEventListener('click', () => loadNonMembers(groupSlug, query, data.next_cursor));
+            container.appendChild(more);
+        }
     } catch (error) {
         console.error('Error loading non-members:', error);
     }
@@ -1059,7 +1231,7 @@ function updateUnreadBadge(chatElement, count) {
     }
 }
 
-async function markMessagesAsRead(userId) {
+async function markMessagesAsRead(userId, upto = null) {
     try {
         const response = await fetch(`/chat/mark_messages_read/${userId}/`, {
             method: 'POST',
@@ -1067,7 +1239,7 @@ async function markMessagesAsRead(userId) {
                 'Content-Type': 'application/json',
                 'X-CSRFToken': getCookie('csrftoken'),
             },
-            body: JSON.stringify({}),
+            body: JSON.stringify({ upto }),
             credentials: 'include'  // Ensure cookies are sent
         });
 
@@ -1,3 +1,1529 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import zlib
 
-# Create your tests here.
+import msgpack
+from io import BytesIO, StringIO
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.contrib.auth.models import User
+from django.db import connection
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Message, Conversation, Profile, Group, GroupMember, GroupMessage, DeletionJob
+from .persistence import WriteBehindQueue, write_messages, write_group_messages
+from .ids import SnowflakeGenerator, NODE_BITS, SEQUENCE_BITS
+from .presence import InMemoryPresenceBackend, flush_last_seen
+from .receipts import ReadReceiptCoalescer, apply_read_receipt
+from .routing import websocket_urlpatterns
+from .user_index import user_index
+from .message_cache import InMemoryMessageCache, get_message_cache, reset_message_cache
+from .consumers import ChatConsumer, GroupChatConsumer, StreamConsumer
+from .rooms import dm_room_name, user_room_name
+from .wire import SUBPROTOCOL_MSGPACK, MSGPACK_CODEC
+from .layers import HybridChannelLayer
+from .membership import group_access, add_group_members, check_shared_cache
+from .loadtest import run_load
+from .avatars import process_picture
+from .deletion import run_job
+
+IN_MEMORY_CHANNEL_LAYERS = {'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}}
+
+
+class MessagePaginationTests(TestCase):
+    def setUp(self):
+        reset_message_cache()
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        for i in range(5):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f"m{i}")
+        self.client.login(username='alice', password='pass')
+
+    def test_pages_newest_first_with_cursor(self):
+        url = reverse('chat:get_messages', args=[self.bob.id])
+
+        first = self.client.get(url, {'limit': 2}).json()
+        self.assertEqual([m['content'] for m in first['messages']], ['m4', 'm3'])
+        self.assertIsNotNone(first['next_cursor'])
+
+        second = self.client.get(url, {'limit': 2, 'before': first['next_cursor']}).json()
+        self.assertEqual([m['content'] for m in second['messages']], ['m2', 'm1'])
+
+        last = self.client.get(url, {'limit': 2, 'before': second['next_cursor']}).json()
+        self.assertEqual([m['content'] for m in last['messages']], ['m0'])
+        self.assertIsNone(last['next_cursor'])
+
+    def test_after_cursor_returns_newer_messages(self):
+        url = reverse('chat:get_messages', args=[self.bob.id])
+        page = self.client.get(url, {'limit': 2}).json()
+        oldest_cursor = self.client.get(url, {'limit': 4}).json()['next_cursor']
+
+        newer = self.client.get(url, {'limit': 10, 'after': oldest_cursor}).json()
+        self.assertEqual([m['content'] for m in newer['messages']], ['m4', 'm3', 'm2'])
+        self.assertEqual(newer['messages'][:2], page['messages'])
+
+    def test_invalid_cursor(self):
+        url = reverse('chat:get_messages', args=[self.bob.id])
+        response = self.client.get(url, {'before': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_group_messages_paginated(self):
+        group = Group.objects.create(name='Team', created_by=self.alice)
+        GroupMember.objects.create(group=group, user=self.alice, is_admin=True)
+        for i in range(3):
+            GroupMessage.objects.create(group=group, sender=self.bob, content=f"g{i}")
+
+        url = reverse('chat:get_group_messages', args=[group.slug])
+        data = self.client.get(url, {'limit': 2}).json()
+        self.assertEqual([m['content'] for m in data['messages']], ['g2', 'g1'])
+        self.assertIsNotNone(data['next_cursor'])
+
+
+class MessageQueryCountTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.client.login(username='alice', password='pass')
+        self.url = reverse('chat:get_messages', args=[self.bob.id])
+
+    def _count_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(self.url, {'limit': 200})
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries), response.json()
+
+    def test_query_count_is_flat_as_history_grows(self):
+        Message.objects.create(sender=self.alice, receiver=self.bob, content='hi')
+        Message.objects.create(sender=self.bob, receiver=self.alice, content='hey')
+        small_count, _ = self._count_queries()
+
+        Message.objects.bulk_create([
+            Message(sender=self.alice if i % 2 else self.bob,
+                    receiver=self.bob if i % 2 else self.alice,
+                    content=f"m{i}")
+            for i in range(100)
+        ])
+        large_count, data = self._count_queries()
+
+        self.assertEqual(small_count, large_count)
+        self.assertEqual(len(data['messages']), 102)
+        self.assertEqual({m['sender'] for m in data['messages']}, {'alice', 'bob'})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ConversationInboxTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.carol = User.objects.create_user('carol', password='pass')
+        self.client.login(username='alice', password='pass')
+
+    def send(self, sender, receiver, content):
+        message = Message.objects.create(sender=sender, receiver=receiver, content=content)
+        Conversation.record_message(message)
+        return message
+
+    def test_record_message_tracks_last_message_and_unread(self):
+        self.send(self.bob, self.alice, 'one')
+        last = self.send(self.bob, self.alice, 'two')
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_message, last)
+        self.assertEqual(conversation.last_message_preview, 'two')
+        self.assertEqual(conversation.unread_for(self.alice), 2)
+        self.assertEqual(conversation.unread_for(self.bob), 0)
+
+        Conversation.mark_read(self.alice.id, self.bob.id)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.unread_for(self.alice), 0)
+
+    def test_inbox_ordered_by_last_activity(self):
+        self.send(self.alice, self.bob, 'to bob')
+        self.send(self.carol, self.alice, 'from carol')
+
+        data = self.client.get(reverse('chat:get_users')).json()
+        self.assertEqual([u['username'] for u in data['users']], ['carol', 'bob'])
+        self.assertEqual(data['unread_counts'], {str(self.carol.id): 1})
+        self.assertEqual(data['users'][0]['last_message'], 'from carol')
+        self.assertEqual(data['users'][0]['last_seen'], 'Offline')  # carol was never seen
+
+    def test_mark_messages_read_resets_counter(self):
+        self.send(self.bob, self.alice, 'hello')
+        self.client.post(reverse('chat:mark_messages_read', args=[self.bob.id]))
+
+        self.assertEqual(Conversation.objects.get().unread_for(self.alice), 0)
+        self.assertFalse(Message.objects.filter(read=False).exists())
+
+    def test_older_message_does_not_replace_newer(self):
+        now = timezone.now()
+        newer = Message.objects.create(sender=self.bob, receiver=self.alice, content='newer', timestamp=now)
+        older = Message.objects.create(
+            sender=self.bob, receiver=self.alice, content='older', timestamp=now - timezone.timedelta(seconds=1)
+        )
+        Conversation.record_message(newer)
+        Conversation.record_messages([older])
+
+        conversation = Conversation.objects.get()
+        self.assertEqual(conversation.last_message, newer)
+        self.assertEqual(conversation.last_activity, now)
+        self.assertEqual(conversation.unread_for(self.alice), 2)
+
+
+class GroupListTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.client.login(username='alice', password='pass')
+
+    def test_group_list_reads_denormalized_columns(self):
+        response = self.client.post(
+            reverse('chat:create_group'),
+            json.dumps({'name': 'Team', 'members': [str(self.bob.id)]}),
+            content_type='application/json'
+        )
+        group = Group.objects.get(slug=response.json()['group']['slug'])
+        message = GroupMessage.objects.create(group=group, sender=self.bob, content='hello team')
+        group.record_message(message)
+
+        with self.assertNumQueries(3):  # session, user, groups
+            data = self.client.get(reverse('chat:get_groups')).json()
+
+        entry = data['groups'][0]
+        self.assertEqual(entry['member_count'], 2)
+        self.assertEqual(entry['last_message']['content'], 'hello team')
+        self.assertEqual(entry['last_message']['sender'], 'bob')
+
+    def test_older_message_does_not_replace_newer(self):
+        group = Group.objects.create(name='Team', created_by=self.alice)
+        now = timezone.now()
+        newer = GroupMessage.objects.create(group=group, sender=self.bob, content='newer', timestamp=now)
+        tied = GroupMessage.objects.create(group=group, sender=self.alice, content='tied', timestamp=now)
+        group.record_message(tied)
+        group.record_message(newer)  # same time, lower id
+        group.record_message(GroupMessage.objects.create(
+            group=group, sender=self.alice, content='older', timestamp=now - timezone.timedelta(seconds=1)
+        ))
+
+        group.refresh_from_db()
+        self.assertEqual(group.last_message, tied)
+        self.assertEqual(group.last_message_preview, 'tied')
+
+    def test_backfill_command(self):
+        group = Group.objects.create(name='Team', created_by=self.alice)
+        GroupMember.objects.create(group=group, user=self.alice, is_admin=True)
+        GroupMember.objects.create(group=group, user=self.bob)
+        GroupMessage.objects.create(group=group, sender=self.alice, content='first')
+        GroupMessage.objects.create(group=group, sender=self.bob, content='second')
+
+        call_command('backfill_group_stats', stdout=StringIO())
+
+        group.refresh_from_db()
+        self.assertEqual(group.member_count, 2)
+        self.assertEqual(group.last_message_preview, 'second')
+        self.assertEqual(group.last_message_sender, 'bob')
+
+
+class WriteBehindQueueTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+
+    async def test_concurrent_submits_share_a_batch(self):
+        queue = WriteBehindQueue(write_messages, batch_size=10, flush_interval=20, max_pending=10)
+        saved = await asyncio.gather(*(
+            queue.submit(Message(sender=self.alice, receiver=self.bob, content=f"m{i}"))
+            for i in range(3)
+        ))
+
+        self.assertTrue(all(message.pk for message in saved))
+        self.assertEqual(await Message.objects.acount(), 3)
+        conversation = await Conversation.objects.aget()
+        self.assertEqual(conversation.unread_for(self.bob), 3)
+        self.assertEqual(conversation.last_message_id, saved[-1].pk)
+
+    def test_loop_change_writes_what_the_old_loop_left(self):
+        queue = WriteBehindQueue(write_messages, batch_size=10, flush_interval=60000, max_pending=10)
+
+        async def abandon_loop():
+            # The worker picks these up and waits for the batch to fill; the loop then closes
+            for i in range(2):
+                asyncio.ensure_future(queue.submit(Message(sender=self.alice, receiver=self.bob, content=f"old {i}")))
+            await asyncio.sleep(0.05)
+
+        async def submit_on_new_loop():
+            return await asyncio.wait_for(
+                queue.submit(Message(sender=self.alice, receiver=self.bob, content="new")), 5
+            )
+
+        async_to_sync(abandon_loop)()
+        self.assertEqual(Message.objects.count(), 0)
+        queue.flush_interval = 0.01
+        async_to_sync(submit_on_new_loop)()
+
+        self.assertEqual(
+            sorted(Message.objects.values_list('content', flat=True)), ['new', 'old 0', 'old 1']
+        )
+
+    def test_group_batch_keeps_newest_as_last_message(self):
+        group = Group.objects.create(name='Team', slug='team', created_by=self.alice)
+        now = timezone.now()
+        newer = GroupMessage(group=group, sender=self.alice, content='newer', timestamp=now)
+        older = GroupMessage(group=group, sender=self.bob, content='older', timestamp=now - timezone.timedelta(seconds=1))
+        write_group_messages([newer, older])
+
+        group.refresh_from_db()
+        self.assertEqual(group.last_message, newer)
+        self.assertEqual(group.last_message_preview, 'newer')
+
+
+class SnowflakeGeneratorTests(TestCase):
+    def test_ids_strictly_increase(self):
+        generator = SnowflakeGenerator(node_id=3)
+        ids = [generator.next_id() for _ in range(10000)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertEqual((ids[0] >> SEQUENCE_BITS) & ((1 << NODE_BITS) - 1), 3)
+        self.assertLess(ids[-1], 2 ** 53)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_OPTIMISTIC_DELIVERY=True)
+class OptimisticDeliveryTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+
+    async def test_broadcast_then_ack(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{self.bob.id}/")
+        communicator.scope['user'] = self.alice
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'content': 'hi', 'client_msg_id': 'c-1'})
+        delivered = await communicator.receive_json_from()
+        status = await communicator.receive_json_from()
+
+        self.assertEqual(delivered['client_msg_id'], 'c-1')
+        self.assertEqual(status['type'], 'ack')
+        self.assertEqual(status['client_msg_id'], 'c-1')
+        self.assertEqual(status['message_id'], delivered['message_id'])
+        self.assertTrue(await Message.objects.filter(id=delivered['message_id'], content='hi').aexists())
+
+        await communicator.disconnect()
+
+    async def test_ids_stay_in_order_after_turning_optimistic_off(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{self.bob.id}/")
+        communicator.scope['user'] = self.alice
+        await communicator.connect()
+
+        await communicator.send_json_to({'content': 'optimistic', 'client_msg_id': 'c-1'})
+        first = await communicator.receive_json_from()
+        await communicator.receive_json_from()  # ack
+        with self.settings(CHAT_OPTIMISTIC_DELIVERY=False, CHAT_SNOWFLAKE_IDS=True):
+            await communicator.send_json_to({'content': 'saved first', 'client_msg_id': 'c-2'})
+            second = await communicator.receive_json_from()
+            [third] = await sync_to_async(write_messages)([
+                Message(sender=self.alice, receiver=self.bob, content='write-behind')
+            ])
+
+        self.assertLess(first['message_id'], second['message_id'])
+        self.assertLess(second['message_id'], third.id)
+        self.assertGreaterEqual(second['message_id'], 1 << (NODE_BITS + SEQUENCE_BITS))
+
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class StreamConsumerTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.group = Group.objects.create(name='Team', created_by=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice, is_admin=True)
+        GroupMember.objects.create(group=self.group, user=self.bob)
+
+    async def connect(self, user):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/stream/")
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_routes_dm_and_group_frames_by_conversation(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+
+        # First DM between the pair reaches alice without a pre-existing room
+        await bob.send_json_to({'conversation': f"dm:{self.alice.id}", 'content': 'hi alice'})
+        received = await alice.receive_json_from()
+        self.assertEqual(received['conversation'], f"dm:{self.bob.id}")
+        self.assertEqual(received['message'], 'hi alice')
+        echoed = await bob.receive_json_from()
+        self.assertEqual(echoed['conversation'], f"dm:{self.alice.id}")
+
+        # Replies flow over the pair room both sockets now share
+        await alice.send_json_to({'conversation': f"dm:{self.bob.id}", 'content': 'hi bob'})
+        self.assertEqual((await bob.receive_json_from())['message'], 'hi bob')
+        self.assertEqual((await alice.receive_json_from())['message'], 'hi bob')
+
+        await alice.send_json_to({'conversation': f"group:{self.group.id}", 'content': 'team'})
+        for communicator in (alice, bob):
+            frame = await communicator.receive_json_from()
+            self.assertEqual(frame['conversation'], f"group:{self.group.id}")
+            self.assertEqual(frame['content'], 'team')
+
+        self.assertTrue(await alice.receive_nothing())
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_stream_sockets_forward_pre_encoded_frames(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+
+        with mock.patch.object(StreamConsumer, 'send_payload') as send_payload:
+            await bob.send_json_to({'conversation': f"dm:{self.alice.id}", 'content': 'first'})
+            self.assertEqual((await alice.receive_json_from())['conversation'], f"dm:{self.bob.id}")
+            self.assertEqual((await bob.receive_json_from())['conversation'], f"dm:{self.alice.id}")
+
+            await alice.send_json_to({'conversation': f"dm:{self.bob.id}", 'content': 'reply'})
+            self.assertEqual((await bob.receive_json_from())['conversation'], f"dm:{self.alice.id}")
+            self.assertEqual((await alice.receive_json_from())['conversation'], f"dm:{self.bob.id}")
+
+            await alice.send_json_to({'conversation': f"group:{self.group.id}", 'content': 'team'})
+            for communicator in (alice, bob):
+                self.assertEqual((await communicator.receive_json_from())['content'], 'team')
+        send_payload.assert_not_called()
+
+        await alice.disconnect()
+        await bob.disconnect()
+
+    async def test_ignores_groups_user_is_not_in(self):
+        outsider = await User.objects.acreate(username='eve')
+        eve = await self.connect(outsider)
+        await eve.send_json_to({'conversation': f"group:{self.group.id}", 'content': 'let me in'})
+        self.assertTrue(await eve.receive_nothing())
+        self.assertFalse(await GroupMessage.objects.aexists())
+        await eve.disconnect()
+
+
+class PresenceTests(TestCase):
+    def test_connections_are_reference_counted(self):
+        backend = InMemoryPresenceBackend(ttl=60, flush_interval=0)
+        backend.connect(1, 'tab-a')
+        backend.connect(1, 'tab-b')
+        backend.connect(2, 'tab-c')
+
+        backend.disconnect(1, 'tab-a')
+        self.assertEqual(backend.online([1, 2, 3]), {1, 2})
+        self.assertEqual(backend.take_pending(), {})
+
+        backend.disconnect(1, 'tab-b')
+        self.assertEqual(backend.online([1, 2, 3]), {2})
+        self.assertEqual(set(backend.take_pending()), {1})
+
+    def test_missed_heartbeats_expire(self):
+        backend = InMemoryPresenceBackend(ttl=-1, flush_interval=0)
+        backend.connect(1, 'crashed')
+        self.assertEqual(backend.online([1]), set())
+
+    def test_flush_writes_last_seen_without_save(self):
+        alice = User.objects.create_user('alice', password='pass')
+        bob = User.objects.create_user('bob', password='pass')
+        seen = timezone.now()
+
+        with self.assertNumQueries(1):
+            flush_last_seen({alice.id: seen, bob.id: seen})
+
+        self.assertEqual(Profile.objects.filter(last_seen=seen).count(), 2)
+
+    def test_heartbeats_and_exit_flush_parked_times(self):
+        from . import presence
+
+        alice = User.objects.create_user('alice', password='pass')
+        backend = InMemoryPresenceBackend(ttl=60, flush_interval=3600)
+        with mock.patch.object(presence, '_backend', backend):
+            presence.user_connected(alice.id, 'tab')
+            presence.user_disconnected(alice.id, 'tab')
+            self.assertIsNone(Profile.objects.get(user=alice).last_seen)  # interval not up
+
+            backend.flush_interval = 0
+            presence.user_heartbeat(2, 'other-tab')
+            self.assertIsNotNone(Profile.objects.get(user=alice).last_seen)
+
+            backend.flush_interval = 3600
+            presence.user_connected(alice.id, 'tab')
+            presence.user_disconnected(alice.id, 'tab')
+            presence._flush_at_exit()
+            self.assertEqual(backend.take_pending(force=True), {})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ReadReceiptTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.messages = []
+        for i in range(4):
+            message = Message.objects.create(sender=self.bob, receiver=self.alice, content=f"m{i}")
+            Conversation.record_message(message)
+            self.messages.append(message)
+
+    def test_receipt_is_bounded_by_watermark(self):
+        receipt = apply_read_receipt(self.alice.id, self.bob.id, self.messages[1].id)
+
+        self.assertEqual(receipt.upto, self.messages[1].id)
+        self.assertEqual(receipt.updated, 2)
+        self.assertEqual(
+            list(Message.objects.filter(read=True).values_list('id', flat=True).order_by('id')),
+            [self.messages[0].id, self.messages[1].id]
+        )
+        self.assertFalse(Message.objects.filter(read=True, read_at__isnull=True).exists())
+        self.assertEqual(Conversation.objects.get().unread_for(self.alice), 2)
+
+    async def test_coalesces_to_highest_watermark(self):
+        coalescer = ReadReceiptCoalescer(window_ms=10)
+        for message in self.messages[:3]:
+            await coalescer.submit(self.alice.id, self.bob.id, message.id)
+        await asyncio.gather(*coalescer._tasks)
+
+        self.assertEqual(await Message.objects.filter(read=True).acount(), 3)
+
+    def test_non_object_body_is_rejected(self):
+        self.client.force_login(self.alice)
+        for body in ('[]', '5'):
+            response = self.client.post(
+                reverse('chat:mark_messages_read', args=[self.bob.id]),
+                body,
+                content_type='application/json'
+            )
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Message.objects.filter(read=True).exists())
+
+    async def test_sender_socket_gets_read_upto(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{self.alice.id}/")
+        communicator.scope['user'] = self.bob
+        await communicator.connect()
+
+        await self.async_client.aforce_login(self.alice)
+        response = await self.async_client.post(
+            reverse('chat:mark_messages_read', args=[self.bob.id]),
+            json.dumps({'upto': self.messages[-1].id}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 200)
+
+        event = await communicator.receive_json_from()
+        self.assertEqual(event['type'], 'read_upto')
+        self.assertEqual(event['reader_id'], self.alice.id)
+        self.assertEqual(event['upto'], self.messages[-1].id)
+        await communicator.disconnect()
+
+
+class MessageSearchTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pw')
+        self.bob = User.objects.create_user('bob', password='pw')
+        self.carol = User.objects.create_user('carol', password='pw')
+        self.group = Group.objects.create(name='Team', slug='team', created_by=self.carol)
+        GroupMember.objects.create(group=self.group, user=self.carol)
+
+        self.own = Message.objects.create(sender=self.alice, receiver=self.bob, content="launch <b>plan</b> tomorrow")
+        Message.objects.create(sender=self.bob, receiver=self.carol, content="launch party secret")
+        GroupMessage.objects.create(group=self.group, sender=self.carol, content="launch checklist")
+
+    def search(self, user, q, **params):
+        self.client.force_login(user)
+        return self.client.get(reverse('chat:search_messages'), {'q': q, **params}).json()
+
+    def test_only_own_conversations_are_searched(self):
+        results = self.search(self.alice, 'launch')['results']
+
+        self.assertEqual([r['id'] for r in results], [self.own.id])
+        self.assertEqual(results[0]['conversation'], f'dm:{self.bob.id}')
+
+        GroupMember.objects.create(group=self.group, user=self.alice)
+        conversations = {r['conversation'] for r in self.search(self.alice, 'launch')['results']}
+        self.assertEqual(conversations, {f'dm:{self.bob.id}', f'group:{self.group.id}'})
+
+    def test_snippet_is_escaped_and_highlighted(self):
+        snippet = self.search(self.alice, 'pla')['results'][0]['snippet']
+
+        self.assertIn('<mark>plan</mark>', snippet)
+        self.assertIn('&lt;b&gt;', snippet)
+
+    def test_index_follows_updates_and_deletes(self):
+        Message.objects.filter(id=self.own.id).update(content="rescheduled")
+        self.assertEqual(self.search(self.alice, 'launch')['results'], [])
+        self.assertEqual(len(self.search(self.alice, 'rescheduled')['results']), 1)
+
+        Message.objects.filter(id=self.own.id).delete()
+        self.assertEqual(self.search(self.alice, 'rescheduled')['results'], [])
+
+    def test_paginates_with_offset(self):
+        for i in range(3):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f"launch {i}")
+
+        first = self.search(self.alice, 'launch', limit=3)
+        second = self.search(self.alice, 'launch', limit=3, offset=first['next_offset'])
+
+        self.assertEqual(first['next_offset'], 3)
+        self.assertIsNone(second['next_offset'])
+        ids = [r['id'] for r in first['results'] + second['results']]
+        self.assertEqual(len(set(ids)), 4)
+
+
+class UserSearchIndexTests(TestCase):
+    def setUp(self):
+        user_index.reset()
+        self.me = User.objects.create_user('me', password='pw')
+        for name in ['sam', 'samantha', 'isam', 'Samuel', 'bob']:
+            User.objects.create_user(name, password='pw')
+        self.client.force_login(self.me)
+
+    def tearDown(self):
+        user_index.reset()
+
+    def search(self, query, **params):
+        return self.client.get(reverse('chat:search_users'), {'query': query, **params}).json()
+
+    def test_ranks_exact_then_prefix_then_substring(self):
+        names = [u['username'] for u in self.search('sam')['users']]
+        self.assertEqual(names, ['sam', 'Samuel', 'samantha', 'isam'])
+
+    def test_search_does_not_scan_users_table(self):
+        self.search('sam')  # warm
+        with CaptureQueriesContext(connection) as ctx:
+            self.search('sam')
+        self.assertFalse(any('LIKE' in q['sql'] for q in ctx.captured_queries))
+
+    def test_index_follows_user_signals(self):
+        self.search('sam')
+        sammy = User.objects.create_user('sammy', password='pw')
+        self.assertIn('sammy', [u['username'] for u in self.search('samm')['users']])
+
+        sammy.username = 'robert'
+        sammy.save()
+        self.assertEqual(self.search('samm')['users'], [])
+        self.assertEqual([u['username'] for u in self.search('rob')['users']], ['robert'])
+
+        sammy.delete()
+        self.assertEqual(self.search('rob')['users'], [])
+
+    def test_cursor_pages_through_results(self):
+        first = self.search('sam', limit=2)
+        second = self.search('sam', limit=2, cursor=first['next_cursor'])
+
+        self.assertEqual([u['username'] for u in first['users']], ['sam', 'Samuel'])
+        self.assertEqual([u['username'] for u in second['users']], ['samantha', 'isam'])
+        self.assertIsNone(second['next_cursor'])
+
+    def test_never_seen_user_is_not_shown_online(self):
+        user = self.search('bob')['users'][0]
+        self.assertFalse(user['is_online'])
+        self.assertEqual(user['last_seen'], 'Offline')
+
+
+class HotConversationCacheTests(TestCase):
+    def setUp(self):
+        reset_message_cache()
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        for i in range(3):
+            message = Message.objects.create(sender=self.alice, receiver=self.bob, content=f"m{i}")
+            Conversation.record_message(message)
+        self.url = reverse('chat:get_messages', args=[self.bob.id])
+        self.key = dm_room_name(self.alice.id, self.bob.id)
+
+    def tearDown(self):
+        reset_message_cache()
+
+    def test_first_page_served_from_memory(self):
+        self.client.force_login(self.alice)
+        cold = self.client.get(self.url, {'limit': 2}).json()
+
+        with CaptureQueriesContext(connection) as ctx:
+            warm = self.client.get(self.url, {'limit': 2}).json()
+
+        self.assertEqual(warm, cold)
+        self.assertFalse(any('chat_message' in q['sql'] for q in ctx.captured_queries))
+        self.assertEqual(get_message_cache().stats()['hits'], 1)
+        self.assertEqual(get_message_cache().stats()['misses'], 1)
+
+    async def test_consumer_writes_through(self):
+        await self.async_client.aforce_login(self.alice)
+        await self.async_client.get(self.url)
+
+        await ChatConsumer().persist_message(self.alice, self.bob, 'fresh')
+        data = (await self.async_client.get(self.url, {'limit': 2})).json()
+
+        self.assertEqual([m['content'] for m in data['messages']], ['fresh', 'm2'])
+        self.assertEqual(get_message_cache().stats()['misses'], 1)
+
+    def test_account_deletion_invalidates(self):
+        self.client.force_login(self.alice)
+        self.client.get(self.url)
+        self.assertIsNotNone(get_message_cache().get(self.key))
+
+        self.client.force_login(self.bob)
+        self.client.post(reverse('chat:delete_account'), {'password': 'pass'})
+        self.assertIsNone(get_message_cache().get(self.key))
+
+    def test_fill_racing_an_append_is_dropped(self):
+        cache = InMemoryMessageCache(size=10, max_conversations=1)
+        version = cache.version('chat_1_2')
+        cache.append('chat_1_2', {'id': 9})
+        cache.fill('chat_1_2', [{'id': 8}], version)
+        self.assertIsNone(cache.get('chat_1_2'))
+
+        cache.fill('chat_1_2', [{'id': 9}, {'id': 8}], cache.version('chat_1_2'))
+        cache.fill('group_x', [{'id': 1}], cache.version('group_x'))
+        self.assertIsNone(cache.get('chat_1_2'))  # evicted by the LRU bound
+
+    def test_append_after_fill_that_saw_the_message(self):
+        # The fill ran after the message committed but before the consumer wrote it through
+        cache = InMemoryMessageCache(size=10, max_conversations=1)
+        cache.fill('chat_1_2', [{'id': 9}, {'id': 8}], cache.version('chat_1_2'))
+        cache.append('chat_1_2', {'id': 9})
+        cache.append('chat_1_2', {'id': 10})
+        self.assertEqual(cache.get('chat_1_2'), [{'id': 10}, {'id': 9}, {'id': 8}])
+
+    def test_versions_stay_bounded(self):
+        cache = InMemoryMessageCache(size=10, max_conversations=2)
+        for i in range(100):
+            cache.append(f'chat_{i}_{i + 1}', {'id': i})  # never cached
+            cache.invalidate(f'group_{i}')
+        self.assertEqual(cache._versions, {})
+
+        for i in range(10):
+            cache.fill(f'group_{i}', [{'id': i}], cache.version(f'group_{i}'))
+        cache.version('chat_1_2')
+        cache.abandon('chat_1_2')
+        self.assertEqual(set(cache._versions), {'group_8', 'group_9'})
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class WireProtocolTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.group = Group.objects.create(name='Team', slug='team', created_by=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice)
+
+    async def connect(self, path, subprotocols=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path, subprotocols=subprotocols)
+        communicator.scope['user'] = self.alice
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_msgpack_frames_are_compact(self):
+        communicator, subprotocol = await self.connect(f"/ws/group/{self.group.slug}/", [SUBPROTOCOL_MSGPACK])
+        self.assertEqual(subprotocol, SUBPROTOCOL_MSGPACK)
+
+        await communicator.send_to(bytes_data=msgpack.packb({'m': 'hello', 'k': 'c-1'}))
+        frame = msgpack.unpackb(await communicator.receive_from())
+
+        self.assertEqual(frame['m'], 'hello')
+        self.assertEqual(frame['k'], 'c-1')
+        self.assertNotIn('c', frame)  # content isn't duplicated
+        self.assertIsInstance(frame['ts'], int)
+        self.assertEqual(MSGPACK_CODEC.expand(frame)['content'], 'hello')
+        await communicator.disconnect()
+
+    async def test_json_remains_the_default(self):
+        communicator, subprotocol = await self.connect(f"/ws/chat/{self.bob.id}/")
+        self.assertIsNone(subprotocol)
+
+        await communicator.send_json_to({'content': 'hi'})
+        frame = await communicator.receive_json_from()
+        self.assertEqual(frame['message'], 'hi')
+        await communicator.disconnect()
+
+    async def test_handlers_forward_pre_encoded_frames(self):
+        consumer = GroupChatConsumer()
+        sent = []
+
+        async def send(**frame):
+            sent.append(frame)
+
+        consumer.send = send
+        frames = {'json': {'text_data': 'ready'}, 'msgpack': {'bytes_data': b'ready'}}
+        await consumer.group_message({'frames': frames})
+        consumer.codec = MSGPACK_CODEC
+        await consumer.group_message({'frames': frames})
+
+        self.assertEqual(sent, [{'text_data': 'ready'}, {'bytes_data': b'ready'}])
+
+
+class HybridChannelLayerTests(TestCase):
+    async def test_local_only_mode_needs_no_redis(self):
+        layer = HybridChannelLayer(hosts=[])
+        a, b = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add('room', a)
+        await layer.group_add('room', b)
+        await layer.group_discard('room', b)
+
+        await layer.group_send('room', {'type': 'chat.message', 'text': 'hi'})
+        await layer.send(b, {'type': 'direct'})
+
+        self.assertEqual(await layer.receive(a), {'type': 'chat.message', 'text': 'hi'})
+        self.assertEqual(await layer.receive(b), {'type': 'direct'})
+
+    async def test_group_send_many_reaches_each_channel_once(self):
+        layer = HybridChannelLayer(hosts=[])
+        a, b = await layer.new_channel(), await layer.new_channel()
+        await layer.group_add('one', a)
+        await layer.group_add('two', a)
+        await layer.group_add('two', b)
+
+        await layer.group_send_many(['one', 'two'], {'type': 'control'})
+
+        self.assertEqual(await layer.receive(a), {'type': 'control'})
+        self.assertEqual(await layer.receive(b), {'type': 'control'})
+        self.assertTrue(layer.receive_buffer[a].empty())
+
+    async def test_local_members_skip_redis(self):
+        layer = HybridChannelLayer(hosts=[('127.0.0.1', 1)])  # nothing listens here
+        local = await layer.new_channel()
+        remote = 'specific.elsewhere!abc'
+        self.assertTrue(layer.is_local(local))
+        self.assertFalse(layer.is_local(remote))
+
+        async def group_members(group):
+            return [local]
+
+        layer.group_members = group_members
+        await layer.group_send('room', {'type': 'chat.message'})
+        self.assertEqual(await layer.receive(local), {'type': 'chat.message'})
+
+    async def test_remote_members_share_one_script_call(self):
+        layer = HybridChannelLayer(hosts=[('127.0.0.1', 1)])
+        local = await layer.new_channel()
+        remote = ['specific.one!a', 'specific.one!b', 'specific.two!c']
+        calls = []
+
+        class Pipeline:
+            def zremrangebyscore(self, key, min, max):
+                calls.append(('zremrangebyscore', key))
+
+            async def execute(self):
+                calls.append(('execute',))
+
+        class Connection:
+            def pipeline(self):
+                return Pipeline()
+
+            async def eval(self, script, numkeys, *args):
+                calls.append(('eval', args[:numkeys]))
+                return 0
+
+        async def group_members(group):
+            return [local, *remote]
+
+        layer.group_members = group_members
+        layer.connection = lambda index: Connection()
+        await layer.group_send('room', {'type': 'chat.message'})
+
+        self.assertEqual(await layer.receive(local), {'type': 'chat.message'})
+        evals = [call for call in calls if call[0] == 'eval']
+        # One call for the whole shard, one key (and one copy) per remote process
+        self.assertEqual(len(evals), 1)
+        self.assertEqual(sorted(evals[0][1]), [layer.prefix + 'specific.one!', layer.prefix + 'specific.two!'])
+
+    def parked_layer(self):
+        """A Redis-mode layer whose Redis reads never return, as on a quiet node"""
+        layer = HybridChannelLayer(hosts=[('127.0.0.1', 1)])  # nothing listens here
+
+        async def brpop_forever(index, channel, timeout):
+            await asyncio.Event().wait()
+
+        layer._brpop_with_clean = brpop_forever
+        return layer
+
+    async def test_waiting_receiver_gets_local_send(self):
+        layer = self.parked_layer()
+        a, b = await layer.new_channel(), await layer.new_channel()
+        # a takes the receive lock and parks in Redis; b waits on its buffer
+        receive_a = asyncio.ensure_future(layer.receive(a))
+        await asyncio.sleep(0.01)
+        receive_b = asyncio.ensure_future(layer.receive(b))
+        await asyncio.sleep(0.01)
+
+        await layer.send(a, {'type': 'to.a'})
+        await layer.send(b, {'type': 'to.b'})
+        self.assertEqual(await asyncio.wait_for(receive_a, 1), {'type': 'to.a'})
+        self.assertEqual(await asyncio.wait_for(receive_b, 1), {'type': 'to.b'})
+        self.assertEqual(layer.local_wakeups, {})
+
+    async def test_waiting_receiver_gets_local_group_send(self):
+        layer = self.parked_layer()
+        a = await layer.new_channel()
+
+        async def group_members(group):
+            return [a]
+
+        layer.group_members = group_members
+        receive_a = asyncio.ensure_future(layer.receive(a))
+        await asyncio.sleep(0.01)
+        await layer.group_send('room', {'type': 'chat.message'})
+        self.assertEqual(await asyncio.wait_for(receive_a, 1), {'type': 'chat.message'})
+
+    @override_settings(CHANNEL_LAYERS={'default': {
+        'BACKEND': 'chat.layers.HybridChannelLayer', 'CONFIG': {'hosts': []}
+    }})
+    async def test_chat_round_trip(self):
+        alice = await User.objects.acreate(username='alice')
+        bob = await User.objects.acreate(username='bob')
+        sending = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{bob.id}/")
+        sending.scope['user'] = alice
+        receiving = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{alice.id}/")
+        receiving.scope['user'] = bob
+        await sending.connect()
+        await receiving.connect()
+
+        await sending.send_json_to({'content': 'ping'})
+        self.assertEqual((await receiving.receive_json_from())['message'], 'ping')
+        await sending.disconnect()
+        await receiving.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MembershipCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.group = Group.objects.create(name='Team', slug='team', created_by=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice, is_admin=True)
+
+    def test_second_lookup_is_served_from_cache(self):
+        self.assertTrue(group_access('team', self.alice).is_admin)
+        with self.assertNumQueries(0):
+            access = group_access('team', self.bob)
+        self.assertFalse(access.is_member)
+        self.assertEqual(access.id, self.group.id)
+
+    def test_several_workers_need_a_shared_cache(self):
+        check_shared_cache()
+        with self.settings(CHAT_WORKER_PROCESSES=4):
+            with self.assertRaises(ImproperlyConfigured):
+                check_shared_cache()
+        with self.settings(CHAT_WORKER_PROCESSES=4, CHAT_MEMBERSHIP_CACHE='shared', CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+            'shared': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                       'LOCATION': tempfile.gettempdir()},
+        }):
+            check_shared_cache()
+
+    def test_membership_changes_invalidate(self):
+        self.assertFalse(group_access('team', self.bob).is_member)
+
+        self.client.force_login(self.alice)
+        self.client.post(
+            reverse('chat:add_members', args=['team']),
+            json.dumps({'members': [self.bob.id]}),
+            content_type='application/json'
+        )
+        self.assertTrue(group_access('team', self.bob).is_member)
+
+        self.client.post(
+            reverse('chat:remove_member', args=['team']),
+            json.dumps({'user_id': self.bob.id}),
+            content_type='application/json'
+        )
+        self.assertFalse(group_access('team', self.bob).is_member)
+
+    def test_renamed_and_deleted_groups(self):
+        group_access('team', self.alice)
+        self.group.slug = 'crew'
+        self.group.save()
+        self.assertIsNone(group_access('team', self.alice))
+        self.assertTrue(group_access('crew', self.alice).is_admin)
+
+        self.group.delete()
+        self.assertIsNone(group_access('crew', self.alice))
+
+    async def test_consumer_rejects_non_members(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/group/team/")
+        communicator.scope['user'] = self.bob
+        connected, code = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertEqual(code, 4003)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_DELETION_WORKERS=0)
+class LiveMembershipTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.group = Group.objects.create(name='Team', slug='team', created_by=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice, is_admin=True)
+        GroupMember.objects.create(group=self.group, user=self.bob)
+
+    async def connect(self, user, path):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope['user'] = user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    @sync_to_async
+    def post_as_admin(self, view, slug, payload):
+        self.client.force_login(self.alice)
+        # Control events are sent on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse(f'chat:{view}', args=[slug]), json.dumps(payload), content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+
+    async def test_removed_member_is_disconnected(self):
+        alice = await self.connect(self.alice, "/ws/group/team/")
+        bob_group = await self.connect(self.bob, "/ws/group/team/")
+        bob_stream = await self.connect(self.bob, "/ws/stream/")
+
+        await self.post_as_admin('remove_member', 'team', {'user_id': self.bob.id})
+
+        self.assertEqual(await bob_group.receive_output(), {'type': 'websocket.close', 'code': 4003})
+        revoked = await bob_stream.receive_json_from()
+        self.assertEqual(revoked, {'type': 'membership_revoked', 'conversation': f"group:{self.group.id}"})
+
+        # Later messages no longer reach either of bob's sockets
+        await alice.send_json_to({'content': 'members only'})
+        self.assertEqual((await alice.receive_json_from())['content'], 'members only')
+        self.assertTrue(await bob_stream.receive_nothing())
+        await bob_stream.send_json_to({'conversation': f"group:{self.group.id}", 'content': 'still here?'})
+        self.assertTrue(await alice.receive_nothing())
+
+        await alice.disconnect()
+        await bob_stream.disconnect()
+
+    async def test_deleting_group_closes_sockets(self):
+        bob_group = await self.connect(self.bob, "/ws/group/team/")
+        bob_stream = await self.connect(self.bob, "/ws/stream/")
+
+        await self.post_as_admin('delete_group', 'team', {})
+
+        self.assertEqual(await bob_group.receive_output(), {'type': 'websocket.close', 'code': 4004})
+        deleted = await bob_stream.receive_json_from()
+        self.assertEqual(deleted, {'type': 'group_deleted', 'conversation': f"group:{self.group.id}"})
+        await bob_stream.disconnect()
+
+    async def test_rename_keeps_sockets_in_room(self):
+        alice = await self.connect(self.alice, "/ws/group/team/")
+        bob_stream = await self.connect(self.bob, "/ws/stream/")
+
+        await self.post_as_admin('update_group', 'team', {'name': 'Crew'})
+
+        self.assertEqual(await alice.receive_json_from(), {'type': 'group_renamed', 'group_slug': 'crew', 'name': 'Crew'})
+        renamed = await bob_stream.receive_json_from()
+        self.assertEqual(renamed['type'], 'group_renamed')
+        self.assertEqual(renamed['group_slug'], 'crew')
+
+        await alice.send_json_to({'content': 'new name'})
+        self.assertEqual((await alice.receive_json_from())['group_slug'], 'crew')
+        received = await bob_stream.receive_json_from()
+        self.assertEqual(received['content'], 'new name')
+        self.assertEqual(received['group_slug'], 'crew')
+
+        await alice.disconnect()
+        await bob_stream.disconnect()
+
+    def test_new_members_get_one_batched_event(self):
+        carol = User.objects.create_user('carol', password='pass')
+        dave = User.objects.create_user('dave', password='pass')
+        layer = HybridChannelLayer(hosts=[])
+        with mock.patch('chat.membership.get_channel_layer', return_value=layer), \
+                mock.patch.object(layer, 'group_send_many', wraps=layer.group_send_many) as send_many, \
+                mock.patch.object(layer, 'group_send', wraps=layer.group_send) as send, \
+                self.captureOnCommitCallbacks(execute=True):
+            add_group_members(self.group.id, [carol.id, dave.id])
+
+        send_many.assert_called_once()
+        send.assert_not_called()
+        rooms, event = send_many.call_args.args
+        self.assertEqual(sorted(rooms), sorted([user_room_name(carol.id), user_room_name(dave.id)]))
+        self.assertEqual(event['user_ids'], sorted([carol.id, dave.id]))
+
+    async def test_added_member_stream_joins_group(self):
+        carol = await User.objects.acreate(username='carol')
+        carol_stream = await self.connect(carol, "/ws/stream/")
+
+        await self.post_as_admin('add_members', 'team', {'members': [carol.id]})
+
+        granted = await carol_stream.receive_json_from()
+        self.assertEqual(granted['type'], 'membership_granted')
+        self.assertEqual(granted['conversation'], f"group:{self.group.id}")
+
+        alice = await self.connect(self.alice, "/ws/group/team/")
+        await alice.send_json_to({'content': 'welcome'})
+        self.assertEqual((await carol_stream.receive_json_from())['content'], 'welcome')
+
+        await alice.disconnect()
+        await carol_stream.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class GroupMemberInsertionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        self.group = Group.objects.create(name='Team', slug='team', created_by=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice, is_admin=True)
+        self.client.force_login(self.alice)
+
+    def add(self, members):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('chat:add_members', args=['team']),
+                json.dumps({'members': members}),
+                content_type='application/json'
+            )
+        self.assertEqual(response.status_code, 200)
+        return response.json()['members']
+
+    def test_reports_each_id(self):
+        results = self.add([str(self.bob.id), self.alice.id, 999999, 'x', self.bob.id])
+        self.assertEqual(results, {
+            str(self.bob.id): 'added', str(self.alice.id): 'already_member', '999999': 'unknown', 'x': 'unknown',
+        })
+        self.assertEqual(self.add([self.bob.id]), {str(self.bob.id): 'already_member'})
+        self.group.refresh_from_db()
+        self.assertEqual(self.group.member_count, 2)
+        self.assertTrue(group_access('team', self.bob).is_member)
+
+    def test_query_count_does_not_grow_with_members(self):
+        users = User.objects.bulk_create([User(username=f'user{i}') for i in range(1200)])
+        ids = [user.id for user in users]
+        # A few statements per 500-id chunk (SQLite caps rows per INSERT), not one per member
+        with CaptureQueriesContext(connection) as queries:
+            results = add_group_members(self.group.id, ids + [self.alice.id])
+        self.assertLess(len(queries), 25)
+        self.assertEqual(list(results.values()).count('added'), 1200)
+        self.assertEqual(GroupMember.objects.filter(group=self.group).count(), 1201)
+
+    def test_create_group_adds_creator_as_admin(self):
+        response = self.client.post(
+            reverse('chat:create_group'),
+            json.dumps({'name': 'Crew', 'members': [str(self.bob.id), str(self.alice.id), 'nobody']}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.json()['members'], {str(self.bob.id): 'added', 'nobody': 'unknown'})
+        group = Group.objects.get(slug='crew')
+        self.assertEqual(
+            dict(GroupMember.objects.filter(group=group).values_list('user_id', 'is_admin')),
+            {self.alice.id: True, self.bob.id: False}
+        )
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class NonMemberTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        user_index.reset()
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.group = Group.objects.create(name='Team', slug='team', created_by=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice, is_admin=True)
+        for name in ('bob', 'bobby', 'carol', 'dave', 'erin'):
+            User.objects.create_user(name, password='pass')
+        GroupMember.objects.create(group=self.group, user=User.objects.get(username='carol'))
+        self.client.force_login(self.alice)
+
+    def get(self, **params):
+        response = self.client.get(reverse('chat:get_non_members', args=['team']), params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [user['username'] for user in data['users']], data['next_cursor']
+
+    def test_pages_through_non_members_in_order(self):
+        names, cursor = self.get(limit=2)
+        self.assertEqual(names, ['bob', 'bobby'])
+        names, cursor = self.get(limit=2, cursor=cursor)
+        self.assertEqual(names, ['dave', 'erin'])
+        self.assertIsNone(cursor)
+
+    def test_query_skips_members_and_self(self):
+        self.assertEqual(self.get(query='bo')[0], ['bob', 'bobby'])
+        self.assertEqual(self.get(query='carol')[0], [])
+        self.assertEqual(self.get(query='ali')[0], [])
+
+    def test_one_query_per_page(self):
+        group_access('team', self.alice)  # warm the membership cache
+        with CaptureQueriesContext(connection) as queries:
+            self.get(limit=2)
+        # Session, user, then the anti-join page; no profile rows
+        self.assertEqual(len(queries), 3)
+        self.assertIn('NOT EXISTS', queries[-1]['sql'])
+        self.assertNotIn('chat_profile', queries[-1]['sql'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS, CHAT_DELETION_WORKERS=0, CHAT_DELETION_BATCH_SIZE=2)
+class DeletionJobTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        for i in range(5):
+            sender, receiver = (self.alice, self.bob) if i % 2 == 0 else (self.bob, self.alice)
+            Conversation.record_message(Message.objects.create(sender=sender, receiver=receiver, content=f'dm {i}'))
+
+        self.own = Group.objects.create(name='Own', slug='own', created_by=self.alice)
+        self.other = Group.objects.create(name='Other', slug='other', created_by=self.bob)
+        for group in (self.own, self.other):
+            GroupMember.objects.create(group=group, user=self.alice, is_admin=group is self.own)
+            GroupMember.objects.create(group=group, user=self.bob, is_admin=group is self.other)
+            for sender in (self.bob, self.alice, self.alice):
+                group.record_message(GroupMessage.objects.create(group=group, sender=sender, content='hi'))
+            group.refresh_member_count()
+
+    def test_account_deletion_is_deferred_then_purged(self):
+        self.client.force_login(self.alice)
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('chat:delete_account'), {'password': 'pass'})
+        self.assertEqual(response.status_code, 302)
+
+        # Only marked so far: nothing was collected in the request
+        self.assertFalse(User.objects.get(id=self.alice.id).is_active)
+        self.assertEqual(Message.objects.count(), 5)
+        self.assertIsNone(group_access('own', self.bob))
+        self.assertTrue(group_access('other', self.alice).is_member)
+
+        for callback in callbacks:
+            with self.captureOnCommitCallbacks(execute=True):
+                callback()
+
+        self.assertFalse(User.objects.filter(id=self.alice.id).exists())
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(Conversation.objects.exists())
+        self.assertFalse(Group.objects.filter(id=self.own.id).exists())
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.member_count, 1)
+        self.assertEqual(self.other.last_message.sender_id, self.bob.id)
+        self.assertFalse(group_access('other', self.bob).members.get(self.alice.id))
+
+        job = DeletionJob.objects.get()
+        self.assertEqual(job.status, DeletionJob.DONE)
+        # 1 conversation, 5 DMs, own group's 3 messages + 2 members, 2 messages and 1 membership elsewhere
+        self.assertEqual(job.deleted_rows, 1 + 5 + 3 + 2 + 2 + 1)
+
+    @override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+    def test_pending_account_is_hidden_and_takes_no_dms(self):
+        carol = User.objects.create_user('carol', password='pass')
+        self.client.force_login(self.alice)
+        with self.captureOnCommitCallbacks(execute=False):
+            self.client.post(reverse('chat:delete_account'), {'password': 'pass'})
+
+        self.client.force_login(self.bob)
+        self.assertEqual(self.client.get(reverse('chat:get_users')).json()['users'], [])
+        found = self.client.get(reverse('chat:search_users'), {'query': 'alice'}).json()['users']
+        self.assertEqual(found, [])
+        self.assertEqual(add_group_members(self.other.id, [self.alice.id, carol.id]),
+                         {self.alice.id: 'already_member', carol.id: 'added'})
+
+        async def connect():
+            communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f"/ws/chat/{self.alice.id}/")
+            communicator.scope['user'] = self.bob
+            connected, code = await communicator.connect()
+            await communicator.disconnect()
+            return connected, code
+
+        self.assertEqual(async_to_sync(connect)(), (False, 4004))
+
+    async def test_group_deletion_hides_then_purges(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/group/own/")
+        communicator.scope['user'] = self.bob
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        @sync_to_async
+        def request_deletion():
+            self.client.force_login(self.alice)
+            with self.captureOnCommitCallbacks() as callbacks:
+                job_id = self.client.post(reverse('chat:delete_group', args=['own'])).json()['job_id']
+            self.assertIsNone(group_access('own', self.alice))
+            self.assertNotIn('own', [g['slug'] for g in self.client.get(reverse('chat:get_groups')).json()['groups']])
+            status = self.client.get(reverse('chat:deletion_status', args=[job_id])).json()
+            self.assertEqual((status['status'], status['deleted_rows']), ('pending', 0))
+            # Commit, but hold the job back: sockets must not wait for the purge
+            with mock.patch('chat.deletion.submit'):
+                for callback in callbacks:
+                    callback()
+            return job_id
+
+        job_id = await request_deletion()
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4004})
+        self.assertTrue(await Group.objects.filter(id=self.own.id).aexists())
+
+        @sync_to_async
+        def purge():
+            with self.captureOnCommitCallbacks(execute=True):
+                run_job(job_id)
+            self.assertFalse(Group.objects.filter(id=self.own.id).exists())
+            self.assertEqual(GroupMessage.objects.filter(group_id=self.own.id).count(), 0)
+            status = self.client.get(reverse('chat:deletion_status', args=[job_id])).json()
+            self.assertEqual((status['status'], status['deleted_rows']), ('done', 5))
+
+            self.client.force_login(self.bob)
+            response = self.client.get(reverse('chat:deletion_status', args=[job_id]))
+            self.assertEqual(response.status_code, 404)
+
+        await purge()
+
+    def test_unfinished_jobs_resume(self):
+        Group.objects.filter(id=self.own.id).update(pending_delete=True)
+        DeletionJob.objects.create(kind=DeletionJob.GROUP, target_id=self.own.id, status=DeletionJob.FAILED)
+        call_command('run_deletion_jobs', stdout=StringIO())
+        self.assertEqual(DeletionJob.objects.get().status, DeletionJob.DONE)
+        self.assertFalse(Group.objects.filter(id=self.own.id).exists())
+
+    async def test_peer_stream_is_told(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), "/ws/stream/")
+        communicator.scope['user'] = self.bob
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        @sync_to_async
+        def delete_alice():
+            self.client.force_login(self.alice)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post(reverse('chat:delete_account'), {'password': 'pass'})
+
+        await delete_alice()
+        frames = [await communicator.receive_json_from() for _ in range(2)]
+        self.assertIn({'type': 'account_deleted', 'conversation': f'dm:{self.alice.id}'}, frames)
+        self.assertIn({'type': 'group_deleted', 'conversation': f'group:{self.own.id}'}, frames)
+        await communicator.disconnect()
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class LoadHarnessTests(TestCase):
+    async def test_report_accounts_for_every_delivery(self):
+        report = await run_load(dm_pairs=2, groups=1, group_size=3, rate=10, duration=0.3, drain=5)
+
+        self.assertEqual(report['connections']['opened'], 7)
+        self.assertEqual(report['connections']['failed'], 0)
+        self.assertEqual(report['dm']['sent'], 12)
+        self.assertEqual(report['dm']['delivered'], 12)
+        self.assertEqual(report['group']['sent'], 9)
+        self.assertEqual(report['group']['delivered'], 18)  # every other member
+        self.assertEqual(report['db']['rows_written'], 21)
+        self.assertIsNotNone(report['group']['latency_ms']['p99'])
+        self.assertEqual(report['config']['target'], 'in-process')
+        json.dumps(report)
+
+        # The fleet is cleaned up
+        self.assertFalse(await User.objects.filter(username__startswith='loadtest_').aexists())
+
+
+class ReadEndpointBenchmarkTests(TestCase):
+    def test_seeds_benchmarks_and_cleans_up(self):
+        out = StringIO()
+        call_command(
+            'bench_read_endpoints', users=30, partners=3, pair_messages=5, groups=3,
+            group_size=5, group_messages=10, repeat=2, json=True, stdout=out
+        )
+        results = json.loads(out.getvalue())
+
+        self.assertEqual(set(results), {
+            'get_users', 'get_groups', 'get_messages', 'get_messages (page 2)', 'get_group_messages',
+            'get_group_messages (page 2)', 'search_users', 'get_non_members',
+        })
+        for result in results.values():
+            self.assertGreater(result['queries'], 0)
+            self.assertGreater(result['peak_kib'], 0)
+        self.assertFalse(User.objects.filter(username__startswith='bench_read_').exists())
+        self.assertFalse(Group.objects.exists())
+
+
+class ConversationExportTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.bob = User.objects.create_user('bob', password='pass')
+        now = timezone.now()
+        for i in range(5):
+            sender, receiver = (self.alice, self.bob) if i % 2 == 0 else (self.bob, self.alice)
+            Message.objects.create(
+                sender=sender, receiver=receiver, content=f'line {i}, "quoted"',
+                timestamp=now - timezone.timedelta(minutes=5 - i)
+            )
+        self.group = Group.objects.create(name='Team', slug='team', created_by=self.alice)
+        GroupMember.objects.create(group=self.group, user=self.alice, is_admin=True)
+        GroupMessage.objects.create(group=self.group, sender=self.alice, content='hello team')
+        self.client.force_login(self.alice)
+
+    def export(self, name, arg, **params):
+        response = self.client.get(reverse(f'chat:{name}', args=[arg]), params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_ndjson_is_chronological(self):
+        response, body = self.export('export_messages', self.bob.id)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        rows = [json.loads(line) for line in body.decode().splitlines()]
+        self.assertEqual([row['content'] for row in rows], [f'line {i}, "quoted"' for i in range(5)])
+        self.assertEqual(rows[1]['sender'], 'bob')
+        self.assertEqual(rows[1]['receiver_id'], self.alice.id)
+
+    def test_csv_and_gzip(self):
+        response, body = self.export('export_messages', self.bob.id, format='csv')
+        rows = list(csv.reader(body.decode().splitlines()))
+        self.assertEqual(rows[0], ['id', 'timestamp', 'sender_id', 'sender', 'receiver_id', 'content'])
+        self.assertEqual(rows[1][-1], 'line 0, "quoted"')
+
+        response, compressed = self.export('export_messages', self.bob.id, format='csv', gzip='1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertIn('chat-bob.csv.gz', response['Content-Disposition'])
+        self.assertEqual(gzip.decompress(compressed), body)
+
+    def test_group_export_requires_membership(self):
+        _, body = self.export('export_group_messages', 'team')
+        self.assertEqual(json.loads(body)['sender'], 'alice')
+
+        self.client.force_login(self.bob)
+        response = self.client.get(reverse('chat:export_group_messages', args=['team']))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('chat:export_messages', args=[self.alice.id]), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_asgi_streams_without_buffering(self):
+        client = AsyncClient()
+        await sync_to_async(client.force_login)(self.alice)
+        response = await client.get(reverse('chat:export_messages', args=[self.bob.id]))
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        self.assertEqual(len(b''.join(chunks).splitlines()), 5)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/statm'), "needs /proc to read RSS")
+    def test_million_row_export_in_constant_memory(self):
+        rows = 1_000_000
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < %s)
+                INSERT INTO {Message._meta.db_table} (sender_id, receiver_id, content, read, timestamp)
+                SELECT CASE n % 2 WHEN 0 THEN %s ELSE %s END, CASE n % 2 WHEN 0 THEN %s ELSE %s END,
+                       'synthetic message number ' || n, 1, datetime('2025-01-01', '+' || n || ' seconds')
+                FROM seq
+                """,
+                [rows, self.alice.id, self.bob.id, self.bob.id, self.alice.id]
+            )
+
+        def rss():
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+        response = self.client.get(reverse('chat:export_messages', args=[self.bob.id]), {'gzip': '1'})
+        baseline = rss()
+        peak = baseline
+        decompressor = zlib.decompressobj(31)
+        lines = 0
+        for i, chunk in enumerate(response.streaming_content):
+            lines += decompressor.decompress(chunk).count(b'\n')
+            if i % 16 == 0:
+                peak = max(peak, rss())
+        lines += decompressor.flush().count(b'\n')
+
+        self.assertEqual(lines, rows + 5)
+        self.assertLess(peak - baseline, 64 * 1024 * 1024)
+
+
+class ProfilePictureTests(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        settings = override_settings(MEDIA_ROOT=self.media_root, CHAT_AVATAR_WORKERS=0)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.alice = User.objects.create_user('alice', password='pass')
+        self.client.force_login(self.alice)
+
+    def image(self, name='me.png', size=(640, 480)):
+        from PIL import Image
+
+        buffer = BytesIO()
+        Image.new('RGB', size, 'purple').save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def upload(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('chat:edit_profile'), {
+                'username': 'alice', 'email': 'alice@example.com', 'profile_picture': self.image(),
+            })
+        self.assertEqual(response.status_code, 302)
+        return Profile.objects.get(user=self.alice)
+
+    def test_upload_makes_webp_variants(self):
+        from PIL import Image
+
+        profile = self.upload()
+        self.assertTrue(default_storage.exists(profile.profile_picture.name))
+        for size in (64, 256):
+            with default_storage.open(getattr(profile, f'avatar_{size}').name) as f:
+                image = Image.open(f)
+                self.assertEqual((image.format, image.size), ('WEBP', (size, size)))
+
+        bob = User.objects.create_user('bob', password='pass')
+        Conversation.record_message(Message.objects.create(sender=self.alice, receiver=bob, content='hi'))
+        self.client.force_login(bob)
+        users = self.client.get(reverse('chat:get_users')).json()['users']
+        alice = next(user for user in users if user['id'] == self.alice.id)
+        self.assertTrue(alice['profile_picture'].endswith(profile.avatar_64.url))
+
+    def test_replacing_removes_old_files(self):
+        first = self.upload()
+        old = [first.profile_picture.name, first.avatar_64.name, first.avatar_256.name]
+        second = self.upload()
+        self.assertNotEqual(second.profile_picture.name, old[0])
+        self.assertFalse(any(default_storage.exists(name) for name in old))
+        self.assertTrue(default_storage.exists(second.avatar_256.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(default_storage.exists(second.profile_picture.name))
+
+    def test_stale_job_discards_its_variants(self):
+        profile = self.upload()
+        # A job for an original the profile no longer points at keeps nothing
+        stale = default_storage.save('profile_pics/stale.png', self.image())
+        process_picture(profile.pk, stale)
+        profile.refresh_from_db()
+        self.assertFalse(default_storage.exists('profile_pics/thumbs/stale_64.webp'))
+        self.assertFalse(default_storage.exists(stale))
+        self.assertTrue(default_storage.exists(profile.avatar_64.name))
+
+    def test_failed_job_cleans_up(self):
+        profile = self.upload()
+        old = [profile.avatar_64.name, profile.avatar_256.name]
+        current = default_storage.save('profile_pics/current.png', self.image())
+        Profile.objects.filter(pk=profile.pk).update(profile_picture=current, avatar_64='', avatar_256='')
+        save = default_storage.save
+
+        def fail_large(name, content):
+            if name.endswith('_256.webp'):
+                raise OSError('disk full')
+            return save(name, content)
+
+        with mock.patch.object(default_storage, 'save', side_effect=fail_large):
+            with self.assertRaises(OSError):
+                process_picture(profile.pk, current, old)
+
+        self.assertFalse(any(default_storage.exists(name) for name in old))
+        self.assertFalse(default_storage.exists('profile_pics/thumbs/current_64.webp'))
+        self.assertTrue(default_storage.exists(current))  # still the profile's picture
@@ -15,6 +15,7 @@ urlpatterns = [
     path('signup/', views.register, name='signup'),
     path('edit_profile/', views.edit_profile, name='edit_profile'),
     path('search/', views.search_users, name='search_users'),
+    path('search/messages/', views.search_messages, name='search_messages'),
     path('get_users/', views.get_users, name='get_users'),
     path('get_messages/<int:user_id>/', get_messages, name='get_messages'),
     path('create-group/', views.create_group, name='create_group'),
@@ -25,7 +26,10 @@ urlpatterns = [
     path('update_group/<slug:group_slug>/', views.update_group, name='update_group'),
     path('remove_member/<slug:group_slug>/', views.remove_member, name='remove_member'),
     path('delete_group/<slug:group_slug>/', views.delete_group, name='delete_group'),
+    path('deletion_status/<int:job_id>/', views.deletion_status, name='deletion_status'),
     path('get_group_messages/<slug:group_slug>/', views.get_group_messages, name='get_group_messages'),
+    path('export/messages/<int:user_id>/', views.export_messages, name='export_messages'),
+    path('export/group/<slug:group_slug>/', views.export_group_messages, name='export_group_messages'),
     path('password-reset/', auth_views.PasswordResetView.as_view(template_name='registration/password_reset.html'), name='password_reset'),
     path('password-reset/done/', auth_views.PasswordResetDoneView.as_view(template_name='registration/password_reset_done.html'), name='password_reset_done'),
     path('reset/<uidb64>/<token>/', auth_views.PasswordResetConfirmView.as_view(template_name='registration/password_reset_confirm.html'), name='password_reset_confirm'),
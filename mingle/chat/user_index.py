@@ -0,0 +1,149 @@
+"""
+In-process username index for the user search box.
+
+Keeps every username in a sorted list (prefix lookups by bisection) and a
+trigram -> user ids map (substring lookups for queries of 3+ characters),
+so a keystroke never scans ``auth_user``. Hits are ranked exact match,
+then prefix, then substring, shorter names first.
+
+The index is loaded with one query when the ASGI app starts (or on first
+use) and kept current by ``post_save``/``post_delete`` on ``User``. Each
+worker process holds its own copy.
+"""
+import base64
+import heapq
+import threading
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from django.contrib.auth import get_user_model
+from django.db import DatabaseError
+
+from .pagination import InvalidCursor
+
+
+def trigrams(name):
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def encode_user_cursor(username):
+    return base64.urlsafe_b64encode(username.encode()).decode().rstrip('=')
+
+
+def decode_user_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return base64.urlsafe_b64decode(padded.encode()).decode()
+    except (ValueError, UnicodeDecodeError) as e:
+        raise InvalidCursor(str(e))
+
+
+class UsernameIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.warmed = False
+            self._names = {}  # user_id -> username
+            self._sorted = []  # (lowercase username, user_id)
+            self._trigrams = defaultdict(set)
+
+    def warm(self, rows):
+        """Replace the contents with (user_id, username) rows"""
+        with self._lock:
+            self.reset()
+            for user_id, username in rows:
+                self._names[user_id] = username
+                folded = username.lower()
+                self._sorted.append((folded, user_id))
+                for gram in trigrams(folded):
+                    self._trigrams[gram].add(user_id)
+            self._sorted.sort()
+            self.warmed = True
+
+    def add(self, user_id, username):
+        with self._lock:
+            if self._names.get(user_id) == username:
+                return
+            self.remove(user_id)
+            self._names[user_id] = username
+            folded = username.lower()
+            insort(self._sorted, (folded, user_id))
+            for gram in trigrams(folded):
+                self._trigrams[gram].add(user_id)
+
+    def remove(self, user_id):
+        with self._lock:
+            username = self._names.pop(user_id, None)
+            if username is None:
+                return
+            folded = username.lower()
+            position = bisect_left(self._sorted, (folded, user_id))
+            if position < len(self._sorted) and self._sorted[position] == (folded, user_id):
+                del self._sorted[position]
+            for gram in trigrams(folded):
+                ids = self._trigrams.get(gram)
+                if ids is not None:
+                    ids.discard(user_id)
+                    if not ids:
+                        del self._trigrams[gram]
+
+    def _candidates(self, query):
+        position = bisect_left(self._sorted, (query,))
+        for folded, user_id in self._sorted[position:]:
+            if not folded.startswith(query):
+                break
+            yield user_id
+        if len(query) < 3:
+            # Too short for trigrams; prefix matches only
+            return
+        grams = sorted((self._trigrams.get(gram, set()) for gram in trigrams(query)), key=len)
+        for user_id in set.intersection(*grams):
+            if not self._names[user_id].lower().startswith(query):
+                yield user_id
+
+    def _rank(self, query, username):
+        folded = username.lower()
+        tier = 0 if folded == query else 1 if folded.startswith(query) else 2
+        return tier, len(folded), folded, username
+
+    def search(self, query, limit, after=None, exclude=()):
+        """
+        Top ``limit`` user ids matching ``query`` in rank order, plus a cursor
+        for the next page (None on the last page). ``after`` is the
+        username the previous page ended on.
+        """
+        query = query.lower()
+        with self._lock:
+            ranked = (
+                (self._rank(query, self._names[user_id]), user_id)
+                for user_id in self._candidates(query)
+                if user_id not in exclude and query in self._names[user_id].lower()
+            )
+            if after is not None:
+                floor = self._rank(query, after)
+                ranked = (hit for hit in ranked if hit[0] > floor)
+            hits = heapq.nsmallest(limit + 1, ranked)
+
+        next_cursor = encode_user_cursor(hits[limit - 1][0][3]) if len(hits) > limit else None
+        return [user_id for _, user_id in hits[:limit]], next_cursor
+
+
+user_index = UsernameIndex()
+
+
+def warm_user_index():
+    User = get_user_model()
+    try:
+        user_index.warm(User.objects.filter(is_active=True).values_list('id', 'username').iterator())
+    except DatabaseError as e:
+        # e.g. before the first migrate; retried on first search
+        print(f"Could not warm user index: {str(e)}")
+
+
+def get_user_index():
+    if not user_index.warmed:
+        warm_user_index()
+    return user_index
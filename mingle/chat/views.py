@@ -9,9 +9,27 @@ from django.views.decorators.http import require_http_methods, require_POST
 from django.db import models
 from django.utils.text import slugify
 import json
-from .models import Message, Profile, Group, GroupMember, GroupMessage
+from asgiref.sync import async_to_sync
+from .models import Message, Conversation, Profile, Group, GroupMember, GroupMessage, DeletionJob
 from .forms import RegistrationForm, ProfileForm, LoginForm
-from django.db.models import Count
+from .pagination import paginate_by_timestamp, page_size, is_cursor_request, InvalidCursor
+from .presence import online_user_ids
+from .receipts import apply_read_receipt, broadcast_read_upto
+from .search import search_messages as run_message_search
+from .avatars import avatar_url, picture_names, replace_picture
+from .deletion import request_account_deletion, request_group_deletion
+from .export import (
+    FORMATS as EXPORT_FORMATS, DM_FIELDS, GROUP_FIELDS, direct_message_rows, group_message_rows, export_response
+)
+from .user_index import get_user_index, decode_user_cursor, encode_user_cursor
+from .message_cache import first_page, get_message_cache
+from .rooms import dm_room_name, group_room_name
+from .membership import (
+    group_access_or_404, add_group_members, membership_revoked, group_renamed
+)
+from .serializers import (
+    MESSAGE_FIELDS, GROUP_MESSAGE_FIELDS, serialize_messages, serialize_group_messages
+)
 from django.contrib.auth import get_user_model
 from django.contrib import messages
 from django.db import IntegrityError, transaction
@@ -89,67 +107,44 @@ def chat_home(request):
 def get_users(request):
     """Get users with existing conversations and unread counts"""
     try:
-        # Get distinct user IDs from messages
-        sent_users = Message.objects.filter(
-            sender=request.user
-        ).values_list('receiver', flat=True).distinct()
-
-        received_users = Message.objects.filter(
-            receiver=request.user
-        ).values_list('sender', flat=True).distinct()
-
-        user_ids = set(sent_users) | set(received_users)
-
-        # Get users with their profiles
-        users = User.objects.filter(
-            id__in=user_ids
-        ).exclude(
-            id=request.user.id
-        ).select_related('profile')
-
-        # Get unread counts
-        unread_counts = Message.objects.filter(
-            receiver=request.user,
-            read=False,
-            sender__in=user_ids
-        ).values('sender').annotate(count=Count('id'))
-
-        # Convert to dictionary {user_id: count}
-        unread_counts_dict = {
-            item['sender']: item['count']
-            for item in unread_counts
-        }
+        conversations = Conversation.for_user(request.user).exclude(
+            user_low=models.F('user_high')
+        ).filter(
+            # Hide accounts pending deletion
+            user_low__is_active=True, user_high__is_active=True
+        ).select_related('user_low__profile', 'user_high__profile')
+        conversations = list(conversations)
+        online_ids = online_user_ids(
+            conversation.other_user(request.user).id for conversation in conversations
+        )
 
         # Prepare response data
         data = {
             'users': [],
-            'unread_counts': unread_counts_dict
+            'unread_counts': {}
         }
 
-        for user in users:
+        for conversation in conversations:
+            user = conversation.other_user(request.user)
+            unread = conversation.unread_for(request.user)
+            if unread:
+                data['unread_counts'][user.id] = unread
+
             # Default values
-            is_online = False
-            last_seen_str = "Online"
+            is_online = user.id in online_ids
+            # A null last_seen means the user was never seen
+            last_seen_str = "Online" if is_online else "Offline"
             profile_picture_url = None  # Initialize as None
 
             # Safely handle profile
             try:
                 if hasattr(user, 'profile'):
                     profile = user.profile
-                    is_online = profile.is_online()
-                    if profile.last_seen:
+                    if not is_online and profile.last_seen:
                         last_seen_str = profile.last_seen.strftime("%Y-%m-%d %H:%M")
 
-                    # Only set URL if profile_picture exists and has valid URL
-                    if profile.profile_picture:
-                        try:
-                            if profile.profile_picture.url:  # Check if URL exists
-                                profile_picture_url = request.build_absolute_uri(profile.profile_picture.url)
-                                # Additional validation for empty URLs
-                                if not profile_picture_url.strip():
-                                    profile_picture_url = None
-                        except:
-                            profile_picture_url = None  # Fallback to None if any error occurs
+                    # The inbox only needs the smallest variant
+                    profile_picture_url = avatar_url(profile, request)
             except Exception as e:
                 print(f"Error processing profile for user {user.id}: {str(e)}")
                 profile_picture_url = None  # Explicitly set to None on error
@@ -159,7 +154,9 @@ def get_users(request):
                 'username': user.username,
                 'is_online': is_online,
                 'last_seen': last_seen_str,
-                'profile_picture': profile_picture_url  # Will be None if no valid picture
+                'profile_picture': profile_picture_url,  # Will be None if no valid picture
+                'last_message': conversation.last_message_preview,
+                'last_activity': conversation.last_activity.isoformat()
             }
             data['users'].append(user_data)
 
@@ -177,23 +174,50 @@ def get_users(request):
 @login_required
 @require_http_methods(["GET"])
 def get_messages(request, user_id):
-    """Get messages between current user and another user"""
+    """Get a page of messages between current user and another user, newest first"""
     try:
         other_user = get_object_or_404(User, id=user_id)
         messages = Message.objects.filter(
             models.Q(sender=request.user, receiver=other_user) |
             models.Q(sender=other_user, receiver=request.user)
-        ).order_by('timestamp')
+        ).values(*MESSAGE_FIELDS)
+
+        cached = None
+        if not is_cursor_request(request):
+            cached = first_page(
+                dm_room_name(request.user.id, other_user.id),
+                page_size(request),
+                lambda n: serialize_messages(messages.order_by('-timestamp', '-id')[:n])
+            )
+        if cached:
+            data, next_cursor = cached
+        else:
+            page, next_cursor = paginate_by_timestamp(messages, request)
+            data = serialize_messages(page)
 
-        data = [{
-            'sender': msg.sender.username,
-            'sender_id': msg.sender.id,
-            'receiver_id': msg.receiver.id,
-            'content': msg.content,
-            'timestamp': msg.timestamp.isoformat()
-        } for msg in messages]
+        return JsonResponse({'messages': data, 'next_cursor': next_cursor})
+
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
 
-        return JsonResponse({'messages': data})
+
+@login_required
+@require_http_methods(["GET"])
+def export_messages(request, user_id):
+    """Stream the full history with another user as NDJSON or CSV, optionally gzipped"""
+    try:
+        other_user = get_object_or_404(User, id=user_id)
+        fmt = request.GET.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            return JsonResponse({'error': 'Unsupported format'}, status=400)
+
+        return export_response(
+            request, f"chat-{other_user.username}", DM_FIELDS,
+            direct_message_rows(request.user, other_user),
+            fmt, gzip=request.GET.get('gzip') == '1'
+        )
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
@@ -205,23 +229,8 @@ def get_messages(request, user_id):
 def get_groups(request):
     """Get all groups the user belongs to"""
     try:
-        groups = Group.objects.filter(members__user=request.user).annotate(
-            member_count=models.Count('members__user', distinct=True),
-            last_message=models.Subquery(
-                GroupMessage.objects.filter(
-                    group=models.OuterRef('pk')
-                ).order_by('-timestamp').values('content')[:1]
-            ),
-            last_message_time=models.Subquery(
-                GroupMessage.objects.filter(
-                    group=models.OuterRef('pk')
-                ).order_by('-timestamp').values('timestamp')[:1]
-            ),
-            last_message_sender=models.Subquery(
-                GroupMessage.objects.filter(
-                    group=models.OuterRef('pk')
-                ).order_by('-timestamp').values('sender__username')[:1]
-            )
+        groups = Group.objects.filter(members__user=request.user, pending_delete=False).order_by(
+            models.F('last_message_time').desc(nulls_last=True)
         )
 
         data = [{
@@ -230,8 +239,8 @@ def get_groups(request):
             'slug': g.slug,
             'member_count': g.member_count,
             'last_message': {
-                'content': g.last_message,
-                'sender': g.last_message_sender,
+                'content': g.last_message_preview or None,
+                'sender': g.last_message_sender or None,
                 'timestamp': g.last_message_time.strftime("%Y-%m-%d %H:%M") if g.last_message_time else None
             }
         } for g in groups]
@@ -245,26 +254,51 @@ def get_groups(request):
 @login_required
 @require_http_methods(["GET"])
 def get_group_messages(request, group_slug):
-    """Get messages for a specific group"""
+    """Get a page of messages for a specific group, newest first"""
     try:
-        group = get_object_or_404(Group, slug=group_slug)
-        if not GroupMember.objects.filter(group=group, user=request.user).exists():
+        group = group_access_or_404(group_slug, request.user)
+        if not group.is_member:
             return JsonResponse({'error': 'Not a group member'}, status=403)
 
-        messages = GroupMessage.objects.filter(group=group) \
-            .select_related('sender', 'group')\
-            .order_by('timestamp')
+        messages = GroupMessage.objects.filter(group_id=group.id).values(*GROUP_MESSAGE_FIELDS)
 
-        data = [{
-            'sender': msg.sender.username,
-            'sender_id': msg.sender.id,
-            'group_slug': group.slug,
-            'group_id': group.id,
-            'content': msg.content,
-            'timestamp': msg.timestamp.isoformat()
-        } for msg in messages]
+        cached = None
+        if not is_cursor_request(request):
+            cached = first_page(
+                group_room_name(group.id),
+                page_size(request),
+                lambda n: serialize_group_messages(messages.order_by('-timestamp', '-id')[:n], group)
+            )
+        if cached:
+            data, next_cursor = cached
+        else:
+            page, next_cursor = paginate_by_timestamp(messages, request)
+            data = serialize_group_messages(page, group)
+
+        return JsonResponse({'messages': data, 'next_cursor': next_cursor})
+
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
 
-        return JsonResponse({'messages': data})
+
+@login_required
+@require_http_methods(["GET"])
+def export_group_messages(request, group_slug):
+    """Stream a group's full history as NDJSON or CSV, optionally gzipped"""
+    try:
+        group = group_access_or_404(group_slug, request.user)
+        if not group.is_member:
+            return JsonResponse({'error': 'Not a group member'}, status=403)
+        fmt = request.GET.get('format', 'ndjson')
+        if fmt not in EXPORT_FORMATS:
+            return JsonResponse({'error': 'Unsupported format'}, status=400)
+
+        return export_response(
+            request, f"group-{group.slug}", GROUP_FIELDS, group_message_rows(group.id),
+            fmt, gzip=request.GET.get('gzip') == '1'
+        )
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=500)
@@ -302,26 +336,10 @@ def create_group(request):
             slug=slug
         )
 
-        # Add creator as admin member
-        GroupMember.objects.create(
-            group=group,
-            user=request.user,
-            is_admin=True
-        )
-
-        # Add other members if provided
-        if 'members' in data and isinstance(data['members'], list):
-            # Remove duplicates and exclude creator
-            member_ids = list(set(data['members']))
-            if str(request.user.id) in member_ids:
-                member_ids.remove(str(request.user.id))
-
-            # Add members in bulk for efficiency
-            GroupMember.objects.bulk_create([
-                GroupMember(group=group, user_id=user_id)
-                for user_id in member_ids
-                if User.objects.filter(id=user_id).exists()
-            ])
+        # Creator as admin, plus any other members, validated and inserted in bulk
+        members = data.get('members') if isinstance(data.get('members'), list) else []
+        results = add_group_members(group.id, [request.user.id] + members, admin_ids=[request.user.id])
+        results.pop(request.user.id)
 
         return JsonResponse({
             'status': 'success',
@@ -329,7 +347,8 @@ def create_group(request):
                 'id': group.id,
                 'name': group.name,
                 'slug': group.slug
-            }
+            },
+            'members': results
         })
 
     except json.JSONDecodeError:
@@ -341,22 +360,52 @@ def create_group(request):
 # Utility Views
 @login_required
 def search_users(request):
-    """Search users by username"""
+    """Search users by username, best matches first"""
     query = request.GET.get("query", "").strip()
-    users = User.objects.filter(
-        username__icontains=query
-    ).exclude(
-        id=request.user.id
-    ).select_related('profile')
+    limit = page_size(request)
+    try:
+        cursor = request.GET.get("cursor")
+        after = decode_user_cursor(cursor) if cursor else None
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
+
+    ids, next_cursor = get_user_index().search(query, limit, after=after, exclude={request.user.id})
+    # Other processes' indexes may still list accounts pending deletion
+    found = User.objects.filter(is_active=True).select_related('profile').in_bulk(ids)
+    users = [found[user_id] for user_id in ids if user_id in found]
+    online_ids = online_user_ids(u.id for u in users)
 
     data = [{
         'id': u.id,
         'username': u.username,
-        'is_online': u.profile.is_online(),
-        'last_seen': u.profile.last_seen.strftime("%Y-%m-%d %H:%M") if u.profile.last_seen else "Online"
+        'is_online': u.id in online_ids,
+        'last_seen': "Online" if u.id in online_ids
+        else u.profile.last_seen.strftime("%Y-%m-%d %H:%M") if u.profile.last_seen else "Offline"
     } for u in users]
 
-    return JsonResponse({'users': data})
+    return JsonResponse({'users': data, 'next_cursor': next_cursor})
+
+
+@login_required
+@require_http_methods(["GET"])
+def search_messages(request):
+    """Ranked full-text search over the user's direct and group messages"""
+    try:
+        query = request.GET.get('q', '').strip()
+        limit = page_size(request)
+        try:
+            offset = max(0, int(request.GET.get('offset', 0)))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid offset'}, status=400)
+
+        # One extra row tells us whether there is another page
+        results = run_message_search(request.user, query, limit + 1, offset)
+        next_offset = offset + limit if len(results) > limit else None
+
+        return JsonResponse({'results': results[:limit], 'next_offset': next_offset})
+
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=500)
 
 
 @login_required
@@ -367,6 +416,7 @@ def edit_profile(request):
         profile = Profile.objects.create(user=request.user)
 
     if request.method == 'POST':
+        previous_pictures = picture_names(profile)
         form = ProfileForm(request.POST, request.FILES, instance=profile)
         if form.is_valid():
             # First handle non-file fields
@@ -376,35 +426,22 @@ def edit_profile(request):
                     messages.error(request, 'Username already exists')
                     return render(request, 'chat/edit_profile.html', {'form': form})
 
-            # Handle profile picture separately with file content caching
-            if 'profile_picture' in request.FILES:
-                try:
-                    # Read the file content into memory first
-                    uploaded_file = request.FILES['profile_picture']
-                    file_content = uploaded_file.read()
-
-                    # Delete old image if it exists (except default)
-                    if (profile.profile_picture and
-                            not profile.profile_picture.name.endswith('profile_pics/default.png')):
-                        profile.profile_picture.delete(save=False)
-
-                    # Create a ContentFile from the cached content
-                    from django.core.files.base import ContentFile
-                    profile.profile_picture.save(
-                        uploaded_file.name,
-                        ContentFile(file_content),
-                        save=False
-                    )
-                except Exception as e:
-                    messages.error(request, f"Error processing image: {str(e)}")
-                    return redirect('chat:edit_profile')
-
-            # Save all changes
-            profile.save()
-            user = profile.user
-            user.username = form.cleaned_data['username']
-            user.email = form.cleaned_data['email']
-            user.save()
+            # The thumbnail job starts when this commits, once the profile points at the upload
+            with transaction.atomic():
+                # Streamed to storage; thumbnails are made by a worker
+                if 'profile_picture' in request.FILES:
+                    try:
+                        replace_picture(profile, request.FILES['profile_picture'], previous_pictures)
+                    except Exception as e:
+                        messages.error(request, f"Error processing image: {str(e)}")
+                        return redirect('chat:edit_profile')
+
+                # Save all changes
+                profile.save()
+                user = profile.user
+                user.username = form.cleaned_data['username']
+                user.email = form.cleaned_data['email']
+                user.save()
 
             return redirect('chat:chat_home')
     else:
@@ -416,21 +453,46 @@ def edit_profile(request):
 @login_required
 @require_http_methods(["GET"])
 def get_non_members(request, group_slug):
-    """Get users not in group"""
+    """
+    A page of users not in the group. With ``query``, ranked username
+    matches from the search index, skipping the cached member set;
+    without, users in username order via an anti-join on GroupMember.
+    """
+    query = request.GET.get("query", "").strip()
+    limit = page_size(request)
     try:
-        group = get_object_or_404(Group, slug=group_slug)
-        current_members = group.members.values_list('user_id', flat=True)
+        cursor = request.GET.get("cursor")
+        after = decode_user_cursor(cursor) if cursor else None
+    except InvalidCursor:
+        return JsonResponse({'error': 'Invalid cursor'}, status=400)
 
-        users = User.objects.exclude(id__in=current_members) \
-            .exclude(id=request.user.id) \
-            .select_related('profile')
+    try:
+        group = group_access_or_404(group_slug, request.user)
+
+        if query:
+            exclude = set(group.members)
+            exclude.add(request.user.id)
+            ids, next_cursor = get_user_index().search(query, limit, after=after, exclude=exclude)
+            names = dict(User.objects.filter(id__in=ids, is_active=True).values_list('id', 'username'))
+            rows = [(user_id, names[user_id]) for user_id in ids if user_id in names]
+        else:
+            # NOT EXISTS probes the (group, user) unique index once per user,
+            # walking auth_user in username order
+            users = User.objects.filter(
+                ~models.Exists(GroupMember.objects.filter(group_id=group.id, user_id=models.OuterRef('pk')))
+            ).filter(is_active=True).exclude(id=request.user.id)
+            if after is not None:
+                users = users.filter(username__gt=after)
+            rows = list(users.order_by('username').values_list('id', 'username')[:limit + 1])
+            next_cursor = encode_user_cursor(rows[limit - 1][1]) if len(rows) > limit else None
+            rows = rows[:limit]
 
         data = [{
-            'id': u.id,
-            'username': u.username
-        } for u in users]
+            'id': user_id,
+            'username': username
+        } for user_id, username in rows]
 
-        return JsonResponse({'users': data})
+        return JsonResponse({'users': data, 'next_cursor': next_cursor})
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
@@ -443,21 +505,18 @@ def add_members(request, group_slug):
     """Add members to existing group"""
     try:
         data = json.loads(request.body)
-        group = get_object_or_404(Group, slug=group_slug)
+        access = group_access_or_404(group_slug, request.user)
 
         # Verify request.user is group admin
-        if not group.members.filter(user=request.user, is_admin=True).exists():
+        if not access.is_admin:
             return JsonResponse({'error': 'Only admins can add members'}, status=403)
 
         # Add new members
+        results = {}
         if 'members' in data and isinstance(data['members'], list):
-            GroupMember.objects.bulk_create([
-                GroupMember(group=group, user_id=user_id)
-                for user_id in data['members']
-                if User.objects.filter(id=user_id).exists()
-            ])
+            results = add_group_members(access.id, data['members'])
 
-        return JsonResponse({'status': 'success'})
+        return JsonResponse({'status': 'success', 'members': results})
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
@@ -468,17 +527,12 @@ def add_members(request, group_slug):
 def group_details(request, group_slug):
     """Get group details including members"""
     try:
-        group = get_object_or_404(Group, slug=group_slug)
-        is_admin = GroupMember.objects.filter(
-            group=group,
-            user=request.user,
-            is_admin=True
-        ).exists()
+        group = group_access_or_404(group_slug, request.user)
 
-        if not is_admin:
+        if not group.is_admin:
             return JsonResponse({'error': 'Only admins can view details'}, status=403)
 
-        members = GroupMember.objects.filter(group=group).select_related('user')
+        members = GroupMember.objects.filter(group_id=group.id, user__is_active=True).select_related('user')
 
         data = {
             'name': group.name,
@@ -504,15 +558,12 @@ def remove_member(request, group_slug):
     """Remove a member from group"""
     try:
         data = json.loads(request.body)
-        group = get_object_or_404(Group, slug=group_slug)
+        access = group_access_or_404(group_slug, request.user)
 
         # Verify request.user is group admin
-        if not GroupMember.objects.filter(
-                group=group,
-                user=request.user,
-                is_admin=True
-        ).exists():
+        if not access.is_admin:
             return JsonResponse({'error': 'Only admins can remove members'}, status=403)
+        group = access.instance()
 
         user_id = data.get('user_id')
         if not user_id:
@@ -522,10 +573,14 @@ def remove_member(request, group_slug):
         if int(user_id) == request.user.id:
             return JsonResponse({'error': 'Cannot remove yourself'}, status=400)
 
-        GroupMember.objects.filter(
+        removed, _ = GroupMember.objects.filter(
             group=group,
             user_id=user_id
         ).delete()
+        group.refresh_member_count()
+        if removed:
+            # Drop the user's open sockets from the group room
+            membership_revoked(group.id, [int(user_id)])
 
         return JsonResponse({'status': 'success'})
 
@@ -539,15 +594,12 @@ def remove_member(request, group_slug):
 def update_group(request, group_slug):
     """Update existing group information"""
     try:
-        group = get_object_or_404(Group, slug=group_slug)
+        access = group_access_or_404(group_slug, request.user)
 
         # Verify request.user is group admin
-        if not GroupMember.objects.filter(
-                group=group,
-                user=request.user,
-                is_admin=True
-        ).exists():
+        if not access.is_admin:
             return JsonResponse({'error': 'Only admins can edit group'}, status=403)
+        group = Group.objects.get(id=access.id)
 
         data = json.loads(request.body)
         new_name = data.get('name')
@@ -568,7 +620,13 @@ def update_group(request, group_slug):
         if new_description:
             group.description = new_description
 
+        renamed = group.name != access.name or group.slug != group_slug
         group.save()
+        if group.slug != group_slug:
+            # Cached messages carry the old slug
+            get_message_cache().invalidate(group_room_name(group.id))
+        if renamed:
+            group_renamed(group.id, group.slug, group.name)
 
         return JsonResponse({
             'status': 'success',
@@ -587,34 +645,55 @@ def update_group(request, group_slug):
 def delete_group(request, group_slug):
     """Delete an existing group"""
     try:
-        group = get_object_or_404(Group, slug=group_slug)
+        access = group_access_or_404(group_slug, request.user)
 
         # Verify request.user is group admin
-        if not GroupMember.objects.filter(
-                group=group,
-                user=request.user,
-                is_admin=True
-        ).exists():
+        if not access.is_admin:
             return JsonResponse({'error': 'Only admins can delete group'}, status=403)
 
-        group.delete()
-        return JsonResponse({'status': 'success'})
+        # Hidden now; messages and members are purged in the background
+        job = request_group_deletion(access.id, access.slug, request.user)
+        return JsonResponse({'status': 'success', 'job_id': job.id})
 
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
 
+@login_required
+@require_http_methods(["GET"])
+def deletion_status(request, job_id):
+    """Progress of a deletion the user requested"""
+    job = DeletionJob.objects.filter(id=job_id, requested_by=request.user).first()
+    if job is None:
+        return JsonResponse({'error': 'Deletion job not found'}, status=404)
+    return JsonResponse({
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'stage': job.stage,
+        'deleted_rows': job.deleted_rows,
+        'error': job.error or None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    })
+
+
 # views.py
 @login_required
+@require_POST
 def mark_messages_read(request, user_id):
-    print(f"Marking messages as read from {user_id}")  # Debug log
-    updated = Message.objects.filter(
-        sender_id=user_id,
-        receiver=request.user,
-        read=False
-    ).update(read=True)
-    print(f"Updated {updated} messages")  # Debug log
-    return JsonResponse({'status': 'success'})
+    """Mark messages from user_id as read, up to the optional 'upto' message id"""
+    try:
+        data = json.loads(request.body) if request.content_type == 'application/json' else request.POST
+        if not isinstance(data, dict):
+            raise TypeError('Read receipt body must be an object')
+        upto = data.get('upto')
+        result = apply_read_receipt(request.user.id, user_id, int(upto) if upto is not None else None)
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return JsonResponse({'error': 'Invalid read receipt'}, status=400)
+
+    if result and result.updated:
+        async_to_sync(broadcast_read_upto)(request.user.id, user_id, result.upto, result.read_at)
+    return JsonResponse({'status': 'success', 'upto': result.upto if result else None})
 
 @login_required
 def get_unread_count(request, user_id):
@@ -640,8 +719,9 @@ def delete_account(request):
         return redirect('chat:edit_profile')
 
     try:
-        # Delete user and related data
-        request.user.delete()
+        # Deactivated now; messages and memberships are purged in the background
+        with transaction.atomic():
+            request_account_deletion(request.user)
         logout(request)
         messages.success(request, "Your account has been permanently deleted")
         return redirect('chat:login')  # Make sure this matches your login URL name
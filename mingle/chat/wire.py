@@ -0,0 +1,119 @@
+"""
+WebSocket frame encodings.
+
+JSON text frames are the default. A client that offers the
+``mingle.msgpack.v1`` subprotocol gets binary msgpack frames instead,
+which are smaller in three ways:
+
+* keys are shortened through ``SHORT_KEYS``; unknown keys pass through
+  unchanged;
+* ``content`` is dropped when it only repeats ``message``;
+* ``timestamp`` and ``read_at`` are sent as integer epoch milliseconds.
+
+Inbound msgpack frames use the same short keys. The sender's text may
+come as either ``message`` (``m``) or ``content`` (``c``).
+"""
+import json
+from datetime import datetime
+
+import msgpack
+
+SUBPROTOCOL_MSGPACK = 'mingle.msgpack.v1'
+
+SHORT_KEYS = {
+    'type': 't',
+    'message_id': 'i',
+    'client_msg_id': 'k',
+    'message': 'm',
+    'content': 'c',
+    'sender': 's',
+    'sender_id': 'u',
+    'receiver_id': 'r',
+    'group_id': 'gi',
+    'group_slug': 'g',
+    'timestamp': 'ts',
+    'conversation': 'cv',
+    'reader_id': 'rd',
+    'upto': 'up',
+    'read_at': 'ra',
+}
+LONG_KEYS = {short: long for long, short in SHORT_KEYS.items()}
+TIMESTAMP_KEYS = ('timestamp', 'read_at')
+
+
+class InvalidFrame(ValueError):
+    pass
+
+
+class JsonCodec:
+    name = 'json'
+    subprotocol = None
+
+    def encode(self, payload):
+        return {'text_data': json.dumps(payload)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        try:
+            data = json.loads(text_data if text_data is not None else bytes_data)
+        except (TypeError, ValueError) as e:
+            raise InvalidFrame(str(e))
+        if not isinstance(data, dict):
+            raise InvalidFrame("Frame must be an object")
+        return data
+
+
+class MsgpackCodec:
+    name = 'msgpack'
+    subprotocol = SUBPROTOCOL_MSGPACK
+
+    def encode(self, payload):
+        return {'bytes_data': msgpack.packb(self.compact(payload))}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # Text frames are still accepted as JSON on a msgpack socket
+            return JsonCodec().decode(text_data)
+        try:
+            data = msgpack.unpackb(bytes_data)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise InvalidFrame(str(e))
+        if not isinstance(data, dict):
+            raise InvalidFrame("Frame must be a map")
+        return self.expand(data)
+
+    def compact(self, payload):
+        frame = {}
+        for key, value in payload.items():
+            if key == 'content' and value == payload.get('message'):
+                continue
+            if key in TIMESTAMP_KEYS and isinstance(value, str):
+                value = int(datetime.fromisoformat(value).timestamp() * 1000)
+            frame[SHORT_KEYS.get(key, key)] = value
+        return frame
+
+    def expand(self, frame):
+        data = {LONG_KEYS.get(key, key): value for key, value in frame.items()}
+        if 'content' not in data and 'message' in data:
+            data['content'] = data['message']
+        return data
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec()
+CODECS = (JSON_CODEC, MSGPACK_CODEC)
+
+
+def encode_frames(payload):
+    """
+    Encode a payload once per codec, keyed by codec name. Senders put the
+    result in the channel-layer event so each recipient forwards ready
+    frames instead of re-encoding the same payload.
+    """
+    return {codec.name: codec.encode(payload) for codec in CODECS}
+
+
+def negotiate(scope):
+    """Pick the codec for a connection from the subprotocols the client offered"""
+    if SUBPROTOCOL_MSGPACK in scope.get('subprotocols', []):
+        return MSGPACK_CODEC
+    return JSON_CODEC
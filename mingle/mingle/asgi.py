@@ -4,7 +4,6 @@ from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from channels.security.websocket import AllowedHostsOriginValidator
 from django.core.asgi import get_asgi_application
-from chat import routing
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mingle.settings')
 
@@ -12,6 +11,14 @@ django.setup()
 
 django_asgi_app = get_asgi_application()
 
+from chat import routing  # noqa: E402  needs the app registry
+from chat.user_index import warm_user_index  # noqa: E402
+from chat.presence import start_periodic_flush  # noqa: E402
+from chat.membership import check_shared_cache  # noqa: E402
+check_shared_cache()
+warm_user_index()
+start_periodic_flush()
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AllowedHostsOriginValidator(
@@ -75,12 +75,56 @@ TEMPLATES = [
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DATABASE_ENGINE=postgres switches to PostgreSQL configured from the
+# POSTGRES_* variables. Connections are kept open for DATABASE_CONN_MAX_AGE
+# seconds, or with DATABASE_POOL=1 (PostgreSQL only) borrowed from a psycopg3
+# pool instead, since Django doesn't allow both.
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite')
+DATABASE_CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
+if DATABASE_ENGINE == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('POSTGRES_DB', 'mingle'),
+            'USER': os.environ.get('POSTGRES_USER', 'mingle'),
+            'PASSWORD': os.environ.get('POSTGRES_PASSWORD', ''),
+            'HOST': os.environ.get('POSTGRES_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('POSTGRES_PORT', '5432'),
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {},
+        }
+    }
+    if os.environ.get('DATABASE_POOL', '0') == '1':
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get('DATABASE_POOL_MIN_SIZE', 2)),
+            'max_size': int(os.environ.get('DATABASE_POOL_MAX_SIZE', 20)),
+            'timeout': 10,
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'CONN_MAX_AGE': DATABASE_CONN_MAX_AGE,
+            # Take the write lock at BEGIN so writers queue on busy_timeout
+            # rather than failing to upgrade a read lock mid-transaction
+            'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+        }
     }
+
+# Applied to every new SQLite connection (see chat/database.py)
+CHAT_SQLITE_PRAGMAS = {
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
 }
+# WAL is persisted in the database file, so turning it on rewrites the
+# db.sqlite3 checked into the repo; opt in with CHAT_SQLITE_WAL=1 where
+# the database is not tracked.
+if os.environ.get('CHAT_SQLITE_WAL', '0') == '1':
+    CHAT_SQLITE_PRAGMAS.update(journal_mode='WAL', synchronous='NORMAL')
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -132,15 +176,90 @@ LOGIN_URL = 'chat:login'
 
 ASGI_APPLICATION = 'mingle.asgi.application'
 
+# Channels on this process are delivered in memory and only remote ones go
+# through Redis (see chat/layers.py). CHANNEL_LAYER_REDIS=0 runs without Redis,
+# which only works for a single process.
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': 'chat.layers.HybridChannelLayer',
         'CONFIG': {
-            "hosts": [('127.0.0.1', 6379)],
+            "hosts": [('127.0.0.1', 6379)] if os.environ.get('CHANNEL_LAYER_REDIS', '1') == '1' else [],
         },
     },
 }
 
+# Write-behind message persistence (see chat/persistence.py). When enabled,
+# incoming messages are batched into bulk inserts and broadcast once their
+# batch commits.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BATCH_SIZE = 100
+CHAT_WRITE_FLUSH_MS = 5
+CHAT_WRITE_QUEUE_SIZE = 1000
+
+# Broadcast messages before they are written, acking once persisted
+# (see OptimisticDeliveryMixin). CHAT_NODE_ID must be unique per process
+# as it is baked into the Snowflake message ids.
+CHAT_OPTIMISTIC_DELIVERY = False
+# Give every new message a Snowflake id, optimistic or not (implied by
+# CHAT_OPTIMISTIC_DELIVERY). Snowflake and autoincrement ids share the
+# primary key space and don't sort together, so once either setting has
+# been on for a database, keep this on for good (see chat/ids.py).
+CHAT_SNOWFLAKE_IDS = os.environ.get('CHAT_SNOWFLAKE_IDS', '0') == '1'
+CHAT_NODE_ID = int(os.environ.get('CHAT_NODE_ID', 0))
+
+# Presence (see chat/presence.py). 'memory' only sees sockets on this
+# process; use 'redis' when running more than one worker.
+CHAT_PRESENCE_BACKEND = 'memory'
+CHAT_PRESENCE_REDIS_URL = 'redis://127.0.0.1:6379/1'
+CHAT_PRESENCE_TTL = 60
+CHAT_PRESENCE_FLUSH_SECONDS = 30
+
+# Socket read receipts for the same pair are merged over this window
+CHAT_READ_RECEIPT_WINDOW_MS = 250
+
+# Newest messages of recently opened conversations, served for first-page loads.
+# 'memory' is per process; 'redis' is shared between workers.
+CHAT_MESSAGE_CACHE_BACKEND = 'memory'
+CHAT_MESSAGE_CACHE_REDIS_URL = 'redis://127.0.0.1:6379/2'
+CHAT_MESSAGE_CACHE_SIZE = 100
+CHAT_MESSAGE_CACHE_CONVERSATIONS = 10000
+CHAT_MESSAGE_CACHE_TTL = 3600
+
+# Worker processes serving the app; WEB_CONCURRENCY is what gunicorn and
+# uvicorn read too.
+CHAT_WORKER_PROCESSES = int(os.environ.get('WEB_CONCURRENCY', 1))
+
+# Group metadata and membership cache (see chat/membership.py). It decides
+# who may read a group, so with more than one worker it must be shared, or
+# a removed member stays authorized on other workers until the TTL; the
+# ASGI app refuses to start on a per-process backend then.
+if CHAT_WORKER_PROCESSES > 1:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ.get('CHAT_CACHE_REDIS_URL', 'redis://127.0.0.1:6379/2'),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        },
+    }
+CHAT_MEMBERSHIP_CACHE = 'default'
+CHAT_MEMBERSHIP_CACHE_TTL = 300
+
+# Profile picture thumbnails (see chat/avatars.py). Each size needs a
+# matching Profile.avatar_<size> field. Workers 0 processes inline.
+CHAT_AVATAR_SIZES = (64, 256)
+CHAT_AVATAR_WORKERS = int(os.environ.get('CHAT_AVATAR_WORKERS', 2))
+CHAT_AVATAR_QUALITY = 80
+
+# Background purge of deleted accounts and groups (see chat/deletion.py).
+# Workers 0 runs the purge inline once the request commits.
+CHAT_DELETION_WORKERS = int(os.environ.get('CHAT_DELETION_WORKERS', 1))
+CHAT_DELETION_BATCH_SIZE = 1000
+
 # Email settings for password reset
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'